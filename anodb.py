@@ -3,13 +3,28 @@
 #
 
 import re
-from typing import Any, Callable
+from typing import Any, Callable, Iterable
 import logging
 import importlib
 import functools as ft
 import datetime as dt
 import time
-from collections import deque
+import copy
+import asyncio
+import contextlib
+import inspect
+import bisect
+import itertools
+import types
+import weakref
+import threading
+import random
+import pathlib
+import pickle
+import hashlib
+import os
+import sys
+from collections import deque, OrderedDict
 import aiosql as sql  # type: ignore
 from aiosql.types import DriverAdapterProtocol, SQLOperationType as Ops
 import json
@@ -24,12 +39,982 @@ __version__ = pkg_version("anodb")
 CacheFactory = Callable[[str, Callable], Callable]
 """Type for caching cachable queries."""
 
+# explicit table dependencies in query doc string
+_TABLES_DOC = re.compile(r"\bTABLES\s*:\s*([^\n]*)")
+
+# light table extraction from SQL, comma-separated lists are only handled after FROM
+_SQL_NAME = r"(?:\"[^\"]+\"|`[^`]+`|\w+)(?:\.(?:\"[^\"]+\"|`[^`]+`|\w+))*"
+_TABLES_SQL = re.compile(
+    r"(?i)\b(?:FROM|JOIN|INTO|UPDATE|TRUNCATE(?:\s+TABLE)?|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(?:ONLY\s+)?"
+    rf"({_SQL_NAME}(?:\s+(?:AS\s+)?\w+)?(?:\s*,\s*{_SQL_NAME}(?:\s+(?:AS\s+)?\w+)?)*)"
+)
+
+# written tables of a query which tables are unknown
+_ANY_TABLE = "*"
+
+# SQL string literals
+_SQL_STRING = re.compile(r"'(?:''|[^'])*'")
+
+# query definition header, as split by aiosql
+_QUERY_DEF = re.compile(r"--\s*name\s*:\s*")
+
+# query name at the start of a header
+_QUERY_NAME = re.compile(r"[\w-]*")
+
+# streaming select marker in query doc string
+_STREAM_DOC = re.compile(r"\bSTREAM\b(?:\s+fetch\s*=\s*(\d+))?")
+
+# server-side cursor names
+_CURSOR_IDS = itertools.count(1)
+
+# columnar select marker in query doc string
+_COLUMNAR_DOC = re.compile(r"\bCOLUMNAR\b(?:\s+format\s*=\s*(\w+))?")
+
+# columnar result formats
+_COLUMNAR_FORMATS = ("numpy", "arrow", "lists")
+
+# transient transaction errors worth a replay: serialization failure and deadlock SQLSTATEs,
+# MySQL lock wait timeout and deadlock codes, and driver-specific messages
+_RETRY_SQLSTATES = ("40001", "40P01")
+_RETRY_MYSQL_CODES = (1205, 1213)
+_RETRY_MESSAGES = {
+    "sqlite3": re.compile(r"\b(locked|busy)\b", re.I),
+    "aiosqlite": re.compile(r"\b(locked|busy)\b", re.I),
+    "duckdb": re.compile(r"\bconflict\b", re.I),
+}
+
+# how to choose a read replica
+_REPLICA_POLICIES = ("round-robin", "least-loaded")
+
+# driver-specific execute options for server-side prepared statements
+_PREPARE_OPTIONS: dict[str, dict[str, Any]] = {"psycopg": {"prepare": True}}
+
+# operations which may run as prepared statements
+_PREPARE_OPS = (Ops.SELECT, Ops.SELECT_ONE, Ops.SELECT_VALUE, Ops.INSERT_RETURNING, Ops.INSERT_UPDATE_DELETE)
+
+# operations which results can be memoized within a transaction
+_MEMO_OPS = (Ops.SELECT_ONE, Ops.SELECT_VALUE)
+
+
+# live DB objects, for metrics
+_DATABASES: "weakref.WeakSet[DB]" = weakref.WeakSet()
+
+# connections inherited by a forked child, kept referenced so that their
+# finalization does not close the sessions still used by the parent
+_FORK_ORPHANS: list[Any] = []
+
+
+def _after_fork():
+    """Drop inherited connections of all databases in a forked child process."""
+    for db in list(_DATABASES):
+        db._forked()
+
+
+if hasattr(os, "register_at_fork"):  # not on Windows
+    os.register_at_fork(after_in_child=_after_fork)
+
 
 class AnoDBException(Exception):
     """Locally generated exception."""
     pass
 
 
+class CircuitOpenError(AnoDBException):
+    """Connection attempts are suspended after failures."""
+    pass
+
+
+class _CircuitBreaker:
+    """Thread-safe connection circuit breaker, shared by pooled connections.
+
+    After a failure, the circuit is *open* for an exponentially increasing
+    delay, during which connection attempts fail fast. Then it is *half-open*:
+    one caller probes the database while others keep failing fast, until the
+    probe succeeds (*closed*) or fails (*open* again).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._delay: float|None = None
+        self._until = 0.0  # monotonic end of open window or half-open probe
+        self._failures = 0
+        self._opens = 0
+        self._rejects = 0
+
+    def enter(self, max_delay: float):
+        """Allow a connection attempt, or raise ``CircuitOpenError``."""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == "closed":
+                return
+            # also allow another probe if the previous one never reported
+            if now >= self._until:
+                self._state = "half-open"
+                self._until = now + max_delay
+                return
+            self._rejects += 1
+            raise CircuitOpenError(f"connection circuit is {self._state}, retry in {self._until - now:.3f}s")
+
+    def success(self):
+        """Close the circuit after a successful connection."""
+        with self._lock:
+            self._state, self._delay = "closed", None
+
+    def failure(self, min_delay: float, max_delay: float, jitter: float):
+        """Open the circuit for an increasing delay after a failed connection."""
+        with self._lock:
+            self._failures += 1
+            self._opens += 1
+            self._delay = min_delay if self._delay is None else min(2 * self._delay, max_delay)
+            self._state = "open"
+            self._until = time.monotonic() + self._delay * (1.0 + random.uniform(0.0, jitter))
+
+    def stats(self) -> dict[str, Any]:
+        """Generate a JSON-compatible structure for statistics."""
+        with self._lock:
+            return {
+                "state": self._state,
+                "delay": self._delay,
+                "retry-in": max(self._until - time.monotonic(), 0.0) if self._state == "open" else 0.0,
+                "failures": self._failures,
+                "opens": self._opens,
+                "rejects": self._rejects,
+            }
+
+
+#
+# Built-in query cache
+#
+class QueryCache:
+    """Thread-safe LRU cache with an optional time-to-live and statistics.
+
+    - :param maxsize: maximum number of entries, default is *1024*.
+    - :param ttl: entry time-to-live in seconds, default is *None* (forever).
+    - :param stale: keep expired entries this many more seconds for ``get_stale``, default is *None*.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float|None = None, stale: float|None = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._stale = stale
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()  # key -> (expiry, value)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expired = 0
+        self._stale_hits = 0
+        self._coalesced = 0  # calls which waited for an in-flight execution
+
+    def get(self, key) -> tuple[bool, Any]:
+        """Return whether key was found and its value."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                now = time.monotonic()
+                if self._ttl is None or entry[0] > now:
+                    self._data.move_to_end(key)
+                    self._hits += 1
+                    return True, entry[1]
+                # expired entries are kept while they may be served stale
+                if self._stale is None or entry[0] + self._stale <= now:
+                    del self._data[key]
+                    self._expired += 1
+            self._misses += 1
+            return False, None
+
+    def get_stale(self, key) -> tuple[bool, Any]:
+        """Return whether key was found, possibly expired within the stale delay, and its value."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (self._ttl is None or entry[0] + (self._stale or 0.0) > time.monotonic()):
+                self._stale_hits += 1
+                return True, entry[1]
+            return False, None
+
+    def coalesce(self):
+        """Count a call which waits for an in-flight execution."""
+        with self._lock:
+            self._coalesced += 1
+
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used entries."""
+        expiry = time.monotonic() + self._ttl if self._ttl is not None else 0.0
+        with self._lock:
+            self._data[key] = (expiry, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and (self._ttl is None or entry[0] > time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict[str, Any]:
+        """Generate a JSON-compatible structure for statistics."""
+        return {
+            "size": len(self._data),
+            "maxsize": self._maxsize,
+            "ttl": self._ttl,
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "expired": self._expired,
+            "stale": self._stale,
+            "stale_hits": self._stale_hits,
+            "coalesced": self._coalesced,
+        }
+
+
+class _Flight:
+    """One in-flight execution, which result is shared by concurrent identical calls."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value: Any = None
+        self._error: BaseException|None = None
+
+    def set(self, value: Any = None, error: BaseException|None = None):
+        self._value, self._error = value, error
+        self._done.set()
+
+    def wait(self) -> Any:
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class QueryCacher:
+    """Cache factory creating a dedicated ``QueryCache`` per query.
+
+    Default settings may be overriden per query from its doc string,
+    with ``key=value`` parameters after the marker: ``-- CACHED ttl=30 maxsize=10000 stale=5``.
+
+    Concurrent identical calls on a missing entry wait for one execution and
+    share its result, unless ``single_flight`` is disabled.
+    When ``stale`` is set, expired entries are still served for this many
+    seconds to concurrent calls while one of them refreshes the entry.
+
+    - :param maxsize: default maximum number of entries per query, default is *1024*.
+    - :param ttl: default entry time-to-live in seconds, default is *None* (forever).
+    - :param marker: doc string re for the marker, default is ``r"\\bCACHED\\b"``.
+    - :param single_flight: whether to coalesce concurrent identical calls, default is *True*.
+    - :param stale: default stale-while-revalidate delay in seconds, default is *None*.
+    """
+
+    # parameters and their types
+    _PARAMS: dict[str, Callable] = {"maxsize": int, "ttl": float, "stale": float}
+
+    def __init__(self, maxsize: int = 1024, ttl: float|None = None, marker: str = r"\bCACHED\b",
+                 single_flight: bool = True, stale: float|None = None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._marker = re.compile(marker + r"(?P<params>[^\n]*)")
+        self._single_flight = single_flight
+        self._stale = stale
+
+    def _settings(self, name: str, doc: str|None) -> dict[str, Any]:
+        """Extract cache settings from query doc string."""
+        settings: dict[str, Any] = {"maxsize": self._maxsize, "ttl": self._ttl, "stale": self._stale}
+        matched = self._marker.search(doc or "")
+        if matched:
+            for key, val in re.findall(r"(\w+)\s*=\s*([^\s,]+)", matched.group("params")):
+                if key not in self._PARAMS:
+                    raise AnoDBException(f"unexpected cache parameter for {name}: {key}")
+                try:
+                    settings[key] = self._PARAMS[key](val)
+                except ValueError:
+                    raise AnoDBException(f"invalid cache parameter value for {name}: {key}={val}")
+        return settings
+
+    def _cache(self, name: str, settings: dict[str, Any]) -> QueryCache:
+        """Create the cache for one query."""
+        return QueryCache(**settings)
+
+    def _key(self, args: tuple, kwargs: dict[str, Any]) -> Any:
+        """Compute the cache key of a call, raising TypeError if it cannot be cached."""
+        key = (args, tuple(sorted(kwargs.items())))
+        hash(key)  # raise TypeError if not hashable
+        return key
+
+    def __call__(self, name: str, fun: Callable) -> Callable:
+        """Wrap fun with its own cache."""
+        cache = self._cache(name, self._settings(name, fun.__doc__))
+        key_of = self._key
+
+        if inspect.iscoroutinefunction(fun):
+            afutures: dict[Any, asyncio.Future] = {}  # key -> in-flight execution
+
+            @ft.wraps(fun)
+            async def afn(*args, **kwargs):
+                try:
+                    key = key_of(args, kwargs)
+                except TypeError:
+                    return await fun(*args, **kwargs)
+                found, val = cache.get(key)
+                if found:
+                    return val
+                if not self._single_flight:
+                    val = await fun(*args, **kwargs)
+                    cache.set(key, val)
+                    return val
+                future = afutures.get(key)
+                if future is not None:
+                    found, val = cache.get_stale(key)
+                    if found:
+                        return val
+                    cache.coalesce()
+                    return await asyncio.shield(future)
+                future = afutures[key] = asyncio.get_running_loop().create_future()
+                try:
+                    val = await fun(*args, **kwargs)
+                    cache.set(key, val)
+                    future.set_result(val)
+                    return val
+                except BaseException as e:
+                    future.set_exception(e)
+                    future.exception()  # retrieved, even without waiters
+                    raise
+                finally:
+                    del afutures[key]
+
+            cached = afn
+
+        else:
+            flights: dict[Any, _Flight] = {}  # key -> in-flight execution
+            lock = threading.Lock()
+
+            @ft.wraps(fun)
+            def fn(*args, **kwargs):
+                try:
+                    key = key_of(args, kwargs)
+                except TypeError:
+                    return fun(*args, **kwargs)
+                found, val = cache.get(key)
+                if found:
+                    return val
+                if not self._single_flight:
+                    val = fun(*args, **kwargs)
+                    cache.set(key, val)
+                    return val
+                with lock:
+                    flight = flights.get(key)
+                    leader = flight is None
+                    if leader:
+                        flight = flights[key] = _Flight()
+                assert flight is not None
+                if not leader:
+                    found, val = cache.get_stale(key)
+                    if found:
+                        return val
+                    cache.coalesce()
+                    return flight.wait()
+                try:
+                    val = fun(*args, **kwargs)
+                    cache.set(key, val)
+                    flight.set(value=val)
+                    return val
+                except BaseException as e:
+                    flight.set(error=e)
+                    raise
+                finally:
+                    with lock:
+                        del flights[key]
+
+            cached = fn
+
+        cached.cache = cache  # type: ignore
+        cached.cache_clear = cache.clear  # type: ignore
+        cached.cache_info = cache.stats  # type: ignore
+        cached.cache_in = lambda *args, **kwargs: key_of(args, kwargs) in cache  # type: ignore
+        return cached
+
+
+class _SharedStore:
+    """SQLite file shared by processes, with one connection per process."""
+
+    def __init__(self, path: str, timeout: float):
+        self._path = path
+        self._timeout = timeout
+        self._pid = os.getpid()
+        self._conn: Any = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Open and initialize a connection."""
+        import sqlite3
+        conn = sqlite3.connect(self._path, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS AnoDBCache(name TEXT NOT NULL, key BLOB NOT NULL, "
+                "expiry REAL, stored REAL NOT NULL, value BLOB NOT NULL, PRIMARY KEY (name, key))")
+            conn.execute("CREATE INDEX IF NOT EXISTS AnoDBCacheStored ON AnoDBCache(name, stored)")
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def execute(self, sql: str, params: tuple = ()) -> tuple[list[tuple], int]:
+        """Run one statement, and return its rows and row count."""
+        pid = os.getpid()
+        if self._pid != pid:
+            # forked, the connection and lock are still used by the parent
+            if self._conn is not None:
+                _FORK_ORPHANS.append(self._conn)
+            self._conn, self._pid, self._lock = None, pid, threading.Lock()
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            cur = self._conn.execute(sql, params)
+            return cur.fetchall(), cur.rowcount
+
+    def close(self):
+        """Close the connection of this process."""
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+class SharedQueryCache(QueryCache):
+    """Query cache stored in a SQLite file shared by all processes on a host.
+
+    Entries are pickled, evicted oldest first beyond ``maxsize``, and expire
+    after ``ttl`` seconds, on the wall clock. Statistics are per process but
+    for the size. Storage errors are logged and handled as cache misses.
+
+    - :param store: shared storage.
+    - :param name: query name, entries of each query are managed separately.
+    - :param maxsize: maximum number of entries, default is *1024*.
+    - :param ttl: entry time-to-live in seconds, default is *None* (forever).
+    - :param stale: keep expired entries this many more seconds for ``get_stale``, default is *None*.
+    """
+
+    def __init__(self, store: _SharedStore, name: str, maxsize: int = 1024, ttl: float|None = None,
+                 stale: float|None = None):
+        super().__init__(maxsize, ttl, stale)
+        self._store = store
+        self._name = name
+        self._errors = 0
+
+    def _execute(self, sql: str, params: tuple = ()) -> tuple[list[tuple], int]|None:
+        """Run a statement on the store, None on errors."""
+        try:
+            return self._store.execute(sql, params)
+        except Exception as error:  # sqlite3.Error, not imported at the module level
+            self._errors += 1
+            log.warning(f"shared cache {self._name} failed: {error}")
+            return None
+
+    def _entry(self, key: bytes) -> tuple[float|None, bytes]|None:
+        """Get the raw entry for key, if any."""
+        res = self._execute("SELECT expiry, value FROM AnoDBCache WHERE name = ? AND key = ?", (self._name, key))
+        return res[0][0] if res and res[0] else None
+
+    def _load(self, data: bytes) -> tuple[bool, Any]:
+        """Unpickle a value."""
+        try:
+            return True, pickle.loads(data)
+        except Exception as error:
+            self._errors += 1
+            log.warning(f"shared cache {self._name} cannot load value: {error}")
+            return False, None
+
+    def get(self, key) -> tuple[bool, Any]:
+        """Return whether key was found and its value."""
+        entry = self._entry(key)
+        if entry is not None:
+            now = time.time()
+            if entry[0] is None or entry[0] > now:
+                found, val = self._load(entry[1])
+                if found:
+                    self._hits += 1
+                    return True, val
+            elif self._stale is None or entry[0] + self._stale <= now:
+                res = self._execute("DELETE FROM AnoDBCache WHERE name = ? AND key = ? AND expiry = ?",
+                                    (self._name, key, entry[0]))
+                if res and res[1]:
+                    self._expired += 1
+        self._misses += 1
+        return False, None
+
+    def get_stale(self, key) -> tuple[bool, Any]:
+        """Return whether key was found, possibly expired within the stale delay, and its value."""
+        entry = self._entry(key)
+        if entry is not None and (entry[0] is None or entry[0] + (self._stale or 0.0) > time.time()):
+            found, val = self._load(entry[1])
+            if found:
+                self._stale_hits += 1
+                return True, val
+        return False, None
+
+    def set(self, key, value):
+        """Store value for key, evicting the oldest entries if needed."""
+        try:
+            data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as error:  # unpicklable results are not shared
+            self._errors += 1
+            log.warning(f"shared cache {self._name} cannot store value: {error}")
+            return
+        now = time.time()
+        expiry = now + self._ttl if self._ttl is not None else None
+        if self._execute("INSERT OR REPLACE INTO AnoDBCache(name, key, expiry, stored, value) VALUES (?, ?, ?, ?, ?)",
+                         (self._name, key, expiry, now, data)) is None:
+            return
+        res = self._execute(
+            "DELETE FROM AnoDBCache WHERE name = ? AND key IN "
+            "(SELECT key FROM AnoDBCache WHERE name = ? ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+            (self._name, self._name, self._maxsize))
+        if res:
+            self._evictions += res[1]
+
+    def __contains__(self, key) -> bool:
+        entry = self._entry(key)
+        return entry is not None and (entry[0] is None or entry[0] > time.time())
+
+    def __len__(self) -> int:
+        res = self._execute("SELECT COUNT(*) FROM AnoDBCache WHERE name = ?", (self._name,))
+        return res[0][0][0] if res else 0
+
+    def clear(self):
+        """Remove all entries, for all processes."""
+        self._execute("DELETE FROM AnoDBCache WHERE name = ?", (self._name,))
+
+    def stats(self) -> dict[str, Any]:
+        """Generate a JSON-compatible structure for statistics."""
+        return super().stats() | {"size": len(self), "path": self._store._path, "errors": self._errors}
+
+
+class SharedQueryCacher(QueryCacher):
+    """Cache factory for ``CACHED`` queries, shared by processes through a SQLite file.
+
+    All workers on a host share one copy of cached results, and cold misses.
+    Settings are the same as for ``QueryCacher``, concurrent identical calls
+    are only coalesced within a process.
+    Values are pickled, so the file must only be writable by trusted users.
+    Entries are keyed by query name and parameters, so that databases sharing
+    a file must use distinct namespaces.
+
+    - :param path: SQLite file path, created if needed.
+    - :param timeout: seconds to wait for a locked file, default is *1.0*.
+    - :param namespace: prefix of stored query names, e.g. the database name, default is *""*.
+    """
+
+    def __init__(self, path: str, maxsize: int = 1024, ttl: float|None = None, marker: str = r"\bCACHED\b",
+                 single_flight: bool = True, stale: float|None = None, timeout: float = 1.0,
+                 namespace: str = ""):
+        super().__init__(maxsize, ttl, marker, single_flight, stale)
+        self._store = _SharedStore(path, timeout)
+        self._namespace = namespace
+
+    def _cache(self, name: str, settings: dict[str, Any]) -> QueryCache:
+        return SharedQueryCache(self._store, f"{self._namespace}:{name}" if self._namespace else name, **settings)
+
+    def _key(self, args: tuple, kwargs: dict[str, Any]) -> Any:
+        # python hashes differ between processes, use a digest of the serialized call,
+        # with JSON when possible as pickle output depends on object identities
+        key = super()._key(args, kwargs)
+        try:
+            data = b"j" + json.dumps(key).encode()
+        except (TypeError, ValueError):
+            try:
+                data = b"p" + pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as error:
+                raise TypeError(f"cannot serialize cache key: {error}")
+        return hashlib.sha256(data).digest()
+
+    def close(self):
+        """Close the storage connection of this process."""
+        self._store.close()
+
+
+def _memo_key(q: str, args: tuple, kwargs: dict) -> tuple|None:
+    """Build a hashable memo key for a query call, if possible."""
+    key = (q, args, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return None
+
+
+def redact_params(args: tuple, kwargs: dict) -> str:
+    """Render query parameters with their types only."""
+    rendered = [type(a).__name__ for a in args]
+    rendered.extend(f"{k}: {type(v).__name__}" for k, v in kwargs.items())
+    return "(" + ", ".join(rendered) + ")"
+
+
+def _columns(names: list[str], columns: list[list], fmt: str) -> Any:
+    """Build a columnar result from column names and values.
+
+    NumPy and Arrow are only imported when needed.
+    """
+    if fmt == "lists":
+        return dict(zip(names, columns))
+    try:
+        module = importlib.import_module("numpy" if fmt == "numpy" else "pyarrow")
+    except ImportError as e:
+        raise AnoDBException(f"columnar format {fmt} requires {e.name}")
+    if fmt == "numpy":
+        return {name: module.asarray(values) for name, values in zip(names, columns)}
+    return module.table({name: module.array(values) for name, values in zip(names, columns)})
+
+
+def _fetch_result(op: Ops, cur) -> Any:
+    """Build an aiosql-like result from an executed cursor."""
+    if op == Ops.SELECT:
+        return cur.fetchall()
+    elif op == Ops.SELECT_ONE:
+        return cur.fetchone()
+    elif op == Ops.SELECT_VALUE:
+        row = cur.fetchone()
+        return row[0] if row else None
+    elif op == Ops.INSERT_RETURNING:
+        row = cur.fetchone()
+        return row[0] if row and len(row) == 1 else row
+    elif op == Ops.SCRIPT:
+        return cur.statusmessage
+    else:  # insert, update, delete, many
+        return cur.rowcount
+
+
+class PipelineResult:
+    """Deferred result of a query run within ``DB.pipeline``.
+
+    The result is fetched on the first call to ``result()``, or at the end of the block.
+    Plain selects are materialized as lists.
+    """
+
+    def __init__(self, db: "DB", query: str, cx: "DB", cur: Any = None, op: Ops|None = None, value: Any = None):
+        self._db, self._query, self._cx = db, query, cx
+        self._cur, self._op = cur, op
+        self._value = value
+        self._error: BaseException|None = None
+
+    @property
+    def done(self) -> bool:
+        """Whether the result is available, or has failed."""
+        return self._cur is None
+
+    def result(self) -> Any:
+        """Get the query result, or raise its error."""
+        if self._cur is not None:
+            self._db._pipeline_fetch(self)
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def __repr__(self):
+        state = "pending" if self._cur is not None else "failed" if self._error is not None else "done"
+        return f"<PipelineResult {self._query} {state}>"
+
+
+def _sqlstate(error: BaseException) -> str|None:
+    """Get the SQLSTATE of a database error, if available."""
+    code = getattr(error, "sqlstate", None) or getattr(error, "pgcode", None)
+    if code is None and error.args and isinstance(error.args[0], dict):  # pg8000
+        code = error.args[0].get("C")
+    return code
+
+
+class Transaction:
+    """Transaction scope which may be replayed on transient failures, see ``DB.transaction``."""
+
+    def __init__(self, db: "DB", retries: int|None = None, backoff: float|None = None, max_backoff: float|None = None):
+        self._db = db
+        self._options = (retries, backoff, max_backoff) != (None, None, None)
+        self.retries = 3 if retries is None else retries
+        self.backoff = 0.01 if backoff is None else backoff
+        self.max_backoff = 1.0 if max_backoff is None else max_backoff
+        self.attempt = 0
+        self._replay = False  # only when iterated
+        self._done = False
+        self._retrying = False
+        self._primary = False  # previous read pinning of the thread
+
+    def __iter__(self):
+        """Iterate over attempts until one succeeds."""
+        self._replay = True
+        while not self._done:
+            self._retrying = False
+            yield self
+            if not self._done and not self._retrying:
+                raise AnoDBException("transaction attempts must be used as context managers")
+
+    def __enter__(self) -> "DB":
+        if self._options and not self._replay:
+            raise AnoDBException("transaction replay options require iterating on attempts")
+        if self.attempt == 0:
+            self._db._tx_count += 1
+        self._db._tx_local.failed = None
+        # reads are pinned to the primary for the scope
+        self._primary, self._db._tx_local.primary = getattr(self._db._tx_local, "primary", False), True
+        return self._db
+
+    def __exit__(self, exc_type, error, tb):
+        db = self._db
+        db._tx_local.primary = self._primary
+        if error is None:
+            try:
+                db.commit()
+                self._done = True
+                return False
+            except db._db_error as e:
+                db._log_info(f"commit failed: {e}")
+                db._tx_local.failed, error = "commit", e
+                failure = e
+        else:
+            failure = None
+        try:
+            db.rollback()
+        except db._db_error as e:  # pragma: no cover
+            db._log_warning(f"rollback failed: {e}")
+        if self._replay:
+            delay = db._tx_retry(error, self.attempt, self.retries, self.backoff, self.max_backoff)
+            if delay is not None:
+                time.sleep(delay)
+                self.attempt += 1
+                self._retrying = True
+                return True
+        if failure is not None:
+            raise failure
+        return False
+
+
+class _PreparedCursor:
+    """Cursor proxy which executes statements with prepare options."""
+
+    def __init__(self, cur, options: dict[str, Any]):
+        self._cur = cur
+        self._options = options
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def execute(self, sql, *params):
+        self._cur.execute(sql, *params, **self._options)
+        return self
+
+
+class _PreparedConnection:
+    """Connection proxy which provides cursors executing prepared statements."""
+
+    def __init__(self, conn, options: dict[str, Any]):
+        self._conn = conn
+        self._options = options
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        cur = self._conn.cursor(*args, **kwargs)
+        # named server-side cursors are left alone
+        return cur if args or kwargs.get("name") else _PreparedCursor(cur, self._options)
+
+
+#
+# Connection liveness checks
+#
+def _ping_select(conn):
+    """Check a connection with a trivial query, and end the implicit transaction."""
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT 1")
+        cur.fetchall()
+    finally:
+        cur.close()
+    conn.rollback()
+
+
+def _ping_method(conn):
+    """Check a connection with the driver ping method."""
+    conn.ping()
+
+
+def _ping_execute(conn):
+    """Check a connection which executes queries directly, without transaction."""
+    conn.execute("SELECT 1").fetchall()
+
+
+# driver-specific liveness checks, default is _ping_select
+_PINGS: dict[str, Callable[[Any], None]] = {
+    "mysqldb": _ping_method,
+    "pymysql": _ping_method,
+    "mysql-connector": _ping_method,
+    "mariadb": _ping_method,
+    "duckdb": _ping_execute,
+}
+
+
+class LatencyHistogram:
+    """Thread-safe fixed-bucket latency histogram, in seconds.
+
+    Measures are appended without locking, and folded into buckets in batches
+    or when read.
+
+    - :param bounds: sorted bucket upper bounds, the last bucket is unbounded.
+    """
+
+    # from 10 µs to 10 s
+    BOUNDS = (
+        0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+    )
+
+    # pending measures folded by the recording thread
+    BATCH = 256
+
+    def __init__(self, bounds: tuple[float, ...] = BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self._count = 0
+        self.sum = 0.0
+        self.min = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+        self._pending: deque[float] = deque()  # append is atomic
+
+    def add(self, value: float):
+        """Record one measure."""
+        self._pending.append(value)
+        if len(self._pending) >= self.BATCH:
+            self.fold()
+
+    def fold(self):
+        """Fold pending measures into buckets."""
+        with self._lock:
+            self._fold()
+
+    def _fold(self):
+        """Fold pending measures, under lock."""
+        pending = self._pending
+        while pending:
+            value = pending.popleft()
+            self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+            if self._count == 0 or value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+            self._count += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        """Number of measures."""
+        return self._count + len(self._pending)
+
+    def quantile(self, q: float) -> float:
+        """Approximate quantile as the upper bound of its bucket, within min and max."""
+        with self._lock:
+            self._fold()
+            return self._quantile(q)
+
+    def _quantile(self, q: float) -> float:
+        rank, seen = q * self._count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                bound = self.bounds[i] if i < len(self.bounds) else self.max
+                return max(self.min, min(bound, self.max))
+        return self.max
+
+    def stats(self) -> dict[str, Any]:
+        """Generate a JSON-compatible structure for statistics."""
+        with self._lock:
+            self._fold()
+            return {
+                "count": self._count,
+                "sum": self.sum,
+                "min": self.min,
+                "max": self.max,
+                "p50": self._quantile(0.50),
+                "p95": self._quantile(0.95),
+                "p99": self._quantile(0.99),
+            }
+
+
+class _BulkLoad:
+    """Chunking and statistics of a bulk execution, shared by sync and async variants."""
+
+    def __init__(self, db: "DB", query: str, rows: Iterable, chunk_size: int, commit_every: int,
+                 progress: Callable[[dict[str, Any]], None]|None):
+        self.fn, self._many = db._bulk_fn(query)
+        assert chunk_size > 0 and commit_every >= 0
+        self._db = db
+        self._query = query
+        self._rows = iter(rows)
+        self._chunk_size = chunk_size
+        self._commit_every = commit_every
+        self._progress = progress
+        self._start = time.perf_counter()
+        self.stats: dict[str, Any] = {
+            "query": query, "rows": 0, "chunks": 0, "committed": 0, "elapsed": 0.0, "rate": 0.0,
+        }
+
+    def chunks(self):
+        """Generate chunks of rows."""
+        while chunk := list(itertools.islice(self._rows, self._chunk_size)):
+            yield chunk
+
+    def calls(self, chunk: list) -> Iterable[tuple[tuple, dict[str, Any]]]:
+        """Generate query call parameters for a chunk."""
+        if self._many:
+            return [((chunk,), {})]
+        return [((), row) if isinstance(row, dict) else (tuple(row), {}) for row in chunk]
+
+    def failed(self):
+        """Report a failed chunk."""
+        self._db._log_error(f"bulk {self._query} failed on chunk {self.stats['chunks'] + 1} "
+                            f"after {self.stats['committed']} committed rows")
+
+    def done(self, chunk: list) -> bool:
+        """Account for an executed chunk, and tell whether to commit."""
+        self.stats["rows"] += len(chunk)
+        self.stats["chunks"] += 1
+        return self._commit_every > 0 and self.stats["chunks"] % self._commit_every == 0
+
+    def last(self) -> bool|None:
+        """Tell whether to commit remaining rows, *False* for only reporting, *None* for nothing."""
+        if self._commit_every:
+            return True if self.stats["committed"] < self.stats["rows"] else None
+        return False
+
+    def update(self, committed: bool):
+        """Update statistics, after a commit or not, and report progress."""
+        stats = self.stats
+        if committed:
+            stats["committed"] = stats["rows"]
+        stats["elapsed"] = time.perf_counter() - self._start
+        stats["rate"] = stats["rows"] / stats["elapsed"] if stats["elapsed"] > 0.0 else 0.0
+        if self._progress:
+            self._progress(dict(stats))
+
+    def finish(self) -> dict[str, Any]:
+        """Report and return statistics."""
+        stats = self.stats
+        self._db._log_info(f"bulk {self._query}: {stats['rows']} rows in {stats['elapsed']:.3f}s "
+                           f"({stats['rate']:.1f} rows/s)")
+        return stats
+
+
 #
 # DB (Database) class
 #
@@ -56,9 +1041,32 @@ class DB:
     - :param attribute: attribute dot access substitution, default is ``"__"``.
     - :param exception: user function to reraise database exceptions.
     - :param debug: debug mode, generate more logs through ``logging``.
-    - :param cacher: cache factory for queries marked as such.
+    - :param cacher: cache factory for queries marked as such, *True* for a ``QueryCacher``.
     - :param cached: doc string re for checking whether to cache a query, default is ``r"\\bCACHED\\b"``
     - :param last_calls: keep track of this method invocations, default is *1*.
+    - :param timing: keep track of query latencies, default is *True*.
+    - :param slow_query_threshold: log queries slower than this many seconds, default is *None*.
+    - :param slow_query_params: render parameters of slow queries, default is ``redact_params``.
+    - :param slow_queries: keep track of this many slow queries, default is *10*.
+    - :param pool_size: number of idle connections kept in pool mode, default is *0*.
+    - :param pool_max: maximum number of connections in pool mode, default is ``pool_size``.
+    - :param pool_timeout: seconds to wait for a pooled connection, default is *None* (forever).
+    - :param stream_fetch: default batch size of streaming selects, default is *1000*.
+    - :param prepare_threshold: run queries as prepared statements after this many calls, default is *None*.
+    - :param lazy_queries: only scan query files, parse and bind each query on first access, default is *False*.
+    - :param query_cache: directory for keeping parsed query files, default is *None*.
+    - :param lazy_connect: whether to delay connecting to the first use, default is *False*.
+    - :param pre_ping: check connections idle for this many seconds before using them, default is *None*.
+    - :param keepalive: check idle pooled connections every this many seconds, default is *None*.
+    - :param ping: connection liveness check, default depends on the driver.
+    - :param circuit_breaker: fail fast with ``CircuitOpenError`` instead of waiting to reconnect, default is *False*.
+    - :param connect_min_delay: first reconnection delay in seconds, default is *0.001*.
+    - :param connect_max_delay: maximum reconnection delay in seconds, default is *30.0*.
+    - :param connect_jitter: add up to this fraction of random delay, default is *0.0*.
+    - :param fast_path: whether to use lean query wrappers when optional features are disabled, default is *True*.
+    - :param replicas: read replica connection strings, or connection options overriding the primary ones.
+    - :param replica_policy: how to choose a replica, ``"round-robin"`` (default) or ``"least-loaded"``.
+    - :param tx_memo: whether to memoize ``^`` and ``$`` query results until the end of the transaction, default is *False*.
     - :param **conn_options: database-specific ``kwargs`` connection options.
     """
 
@@ -106,9 +1114,41 @@ class DB:
         auto_rollback: bool = True,
         debug: bool = False,
         exception: Callable[[BaseException], BaseException]|None = None,
-        cacher: CacheFactory|None = None,
+        cacher: CacheFactory|bool|None = None,
         cached: str = r"\bCACHED\b",
         last_calls: int = 1,
+        timing: bool = True,
+        slow_query_threshold: float|None = None,
+        slow_query_params: Callable[[tuple, dict], Any]|None = None,
+        slow_queries: int = 10,
+        # connection pool
+        pool_size: int = 0,
+        pool_max: int|None = None,
+        pool_timeout: float|None = None,
+        # streaming selects
+        stream_fetch: int = 1000,
+        # server-side prepared statements
+        prepare_threshold: int|None = None,
+        # query loading
+        lazy_queries: bool = False,
+        query_cache: str|None = None,
+        # connection
+        lazy_connect: bool = False,
+        pre_ping: float|None = None,
+        keepalive: float|None = None,
+        ping: Callable[[Any], None]|None = None,
+        # reconnection throttling
+        circuit_breaker: bool = False,
+        connect_min_delay: float|None = None,
+        connect_max_delay: float|None = None,
+        connect_jitter: float = 0.0,
+        # query wrappers
+        fast_path: bool = True,
+        # read replicas
+        replicas: list[str|dict[str, Any]] = [],
+        replica_policy: str = "round-robin",
+        # transaction-scoped memo
+        tx_memo: bool = False,
         # aiosql behavior
         kwargs_only: bool = True,
         mandatory_parameters: bool = True,
@@ -118,6 +1158,8 @@ class DB:
     ):
         DB._counter += 1
         self._id = DB._counter
+        _DATABASES.add(self)
+        self._pid = os.getpid()  # creating process, to detect forks
         self.__version__ = __version__
         self.__aiosql_version__ = pkg_version("aiosql")
         # this is the class name
@@ -128,7 +1170,6 @@ class DB:
         self._log_info("creating DB")
         self._set_db_pkg()
         # connection parameters…
-        self._conn = None
         self._conn_args = [] if conn is None else [conn]
         self._conn_args.extend(conn_args)
         self._conn_kwargs: dict[str, Any] = dict(conn_kwargs)
@@ -144,18 +1185,19 @@ class DB:
             raise AnoDBException(f"unexpected type for options: {type(options)}")
         # remaining parameters are associated to the connection
         self._conn_kwargs.update(conn_options)
+        # read replicas connection parameters, a string replaces the primary one
+        self._replica_conf: list[tuple[list[str], dict[str, Any]]] = [
+            ([replica] + list(conn_args), dict(self._conn_kwargs)) if isinstance(replica, str) else
+            (list(self._conn_args), {**self._conn_kwargs, **replica})
+            for replica in replicas
+        ]
         # adapter
         self._adapter_args = list(adapter_args)
         self._adapter_kwargs = dict(adapter_kwargs)
         # useful global stats
         self._count: dict[str, int] = {}  # name -> #calls
-        self._conn_last = None  # current connection start
-        self._conn_count: int = 0  # how many connections succeeded
-        self._conn_total: int = 0  # number of "executions" in this connection
-        self._conn_ntx: int = 0  # number of tx in this connection
-        self._conn_nstat: int = 0  # number of executions (fn, cursors) in current tx
-        self._total: int = 0  # total number of executions
-        self._ntx: int = 0  # number of tx
+        self._latency: dict[str, LatencyHistogram] = {}  # name -> latencies
+        self._init_conn()
         # various boolean flags
         self._debug = debug
         if debug:
@@ -163,28 +1205,357 @@ class DB:
             self._log_info("running in debug mode…")
         self._auto_reconnect = auto_reconnect
         self._auto_rollback = auto_rollback
+        self._lazy_connect = lazy_connect
+        # reconnection throttling, class defaults may be overriden per instance
+        if connect_min_delay is not None:
+            self._CONNECTION_MIN_DELAY = connect_min_delay
+        if connect_max_delay is not None:
+            self._CONNECTION_MAX_DELAY = connect_max_delay
+        self._connect_jitter = connect_jitter
+        self._breaker = _CircuitBreaker() if circuit_breaker else None
+        self._fast_path = fast_path
+        # connection health checks
+        self._pre_ping = pre_ping
+        self._keepalive = keepalive
+        self._ping = ping or _PINGS.get(self._db, _ping_select)
+        self._idle_check = pre_ping is not None or keepalive is not None
+        self._health: dict[str, int] = {"pings": 0, "failures": 0, "reconnects": 0}
+        self._keepalive_stop = threading.Event()
+        self._keepalive_thread: threading.Thread|None = None
         self._kwargs_only = kwargs_only
         self._mandatory_parameters = mandatory_parameters
-        self._reconn = False
         # other parameters
         self._attribute = attribute
         self._exception = exception
-        self._cacher = cacher
+        self._cacher: CacheFactory|None = QueryCacher() if cacher is True else cacher or None
+        self._caches: dict[str, Callable] = {}  # name -> cached function
+        self._table_deps: dict[str, set[str]] = {}  # table -> cached query names
+        self._invalidated: dict[str, int] = {}  # name -> #invalidations
         self._cached = cached
+        self._tx_memo = tx_memo
+        self._memo_hits: dict[str, int] = {}  # name -> #memoized results
         self._last_calls = last_calls
-        self._calls = deque()
+        self._calls: deque[str] = deque(maxlen=last_calls)
+        self._timing = timing
+        self._slow_threshold = slow_query_threshold
+        self._slow_params = slow_query_params or redact_params
+        self._slow: deque[dict[str, Any]] = deque(maxlen=slow_queries)
+        self._measure = timing or slow_query_threshold is not None
+        # connection pool, pooled connections are DB shallow copies
+        self._pool_size = pool_size
+        self._pool_max = pool_size if pool_max is None else pool_max
+        self._pool_timeout = pool_timeout
+        self._pooled = self._pool_max > 0
+        if self._pool_size < 0 or self._pool_max < self._pool_size:
+            raise AnoDBException(f"invalid pool settings: size={pool_size} max={pool_max}")
+        if keepalive is not None and not self._pooled:
+            raise AnoDBException("keepalive requires pool mode, consider pre_ping")
+        if self._replica_conf and self._pooled:
+            raise AnoDBException("replicas are not supported in pool mode")
+        if replica_policy not in _REPLICA_POLICIES:
+            raise AnoDBException(f"unexpected replica policy: {replica_policy}")
+        self._routed = self._pooled or bool(self._replica_conf)  # whether calls choose a holder
+        self._pool_all: list[DB] = []  # all pooled connection holders
+        self._pool_idle: list[DB] = []  # available holders
+        self._pool_cond = threading.Condition()
+        self._pool_local = threading.local()  # thread-bound holder
+        self._pool_waits: int = 0  # how many times a thread had to wait
+        # read replicas, connection holders are created on open
+        self._replicas: list[DB] = []
+        self._replica_policy = replica_policy
+        self._replica_next = itertools.count()  # round-robin
+        self._replica_fallbacks: int = 0  # reads sent to the primary for lack of replica
+        self._readable: set[str] = set()  # query names which may run on a replica
+        self._single_reads: set[str] = set()  # readable but streaming query names
+        # replayed transactions
+        self._tx_local = threading.local()  # last failed query and read pinning in current thread
+        self._tx_count: int = 0  # number of transaction scopes
+        self._tx_retries: dict[str, int] = {}  # failed query -> #replays
+        self._tx_exhausted: int = 0  # transactions which failed after all retries
+        # streaming selects
+        self._stream_fetch = stream_fetch
+        self._streams: dict[str, int] = {}  # name -> fetch size
+        # prepared statements for hot queries
+        self._prepare_threshold = prepare_threshold
+        self._prepare_options = _PREPARE_OPTIONS.get(self._db)
+        self._preparable: set[str] = set()  # query names which can be prepared
+        self._prepares: dict[str, int] = {}  # name -> #preparations
+        self._prepared_hits: dict[str, int] = {}  # name -> #prepared executions
+        if prepare_threshold is not None and self._prepare_options is None:
+            self._log_info(f"prepared statements are left to driver {self._db}")
         # queries… keep track of calls
         self._queries_file = [queries] if isinstance(queries, str) else queries
         self._queries: list[sql.aiosql.Queries] = []  # type: ignore
         self._available_queries: set[str] = set()
+        self._query_fns: dict[str, Callable] = {}  # name -> aiosql function
+        self._lazy_queries = lazy_queries
+        self._lazy: dict[str, tuple[str, str, list[str]]] = {}  # name -> (path, definition, names)
+        self._lazy_lock = threading.Lock()
+        self._query_cache = query_cache
+        self._query_cache_hits: int = 0
+        self._query_cache_misses: int = 0
         for fn in self._queries_file:
             self.add_queries_from_path(fn)
-        # last thing is to actually create the connection, which may fail
+        # last thing is to actually create the connection(s), which may fail
+        self._open()
+        if keepalive is not None:
+            self._keepalive_start()
+
+    def _open(self):
+        """Create initial connection(s)."""
+        self._replicas = [self._spawn_replica(args, kwargs) for args, kwargs in self._replica_conf]
+        if self._lazy_connect:
+            self._log_info("delaying connection to first use")
+            self._reconn = True
+        elif self._pooled:
+            self._pool_fill()
+        else:
+            self._do_connect()
+            # replicas failures are not fatal, they are retried on use
+            for cx in self._replicas:
+                try:
+                    cx._do_connect()
+                except self._db_error as error:
+                    self._log_warning(f"replica {cx._id} connection failed: {error}")
+
+    def _init_conn(self):
+        """Initialize connection state and statistics."""
+        self._conn = None
+        self._reconn = False
+        self._conn_lock = threading.Lock()  # serialize deferred connections
+        self._conn_used: float = 0.0  # monotonic time of last use, for health checks
+        self._conn_last: dt.datetime|None = None  # current connection start
+        self._conn_count: int = 0  # how many connections succeeded
+        self._conn_total: int = 0  # number of "executions" in this connection
+        self._conn_ntx: int = 0  # number of tx in this connection
+        self._conn_nstat: int = 0  # number of executions (fn, cursors) in current tx
+        self._inflight: int = 0  # number of single reads being executed
+        self._total: int = 0  # total number of executions
+        self._ntx: int = 0  # number of tx
+        # reconnection throttling
         self._conn_delay: float|None = None  # seconds
         self._conn_last_fail: dt.datetime|None = None
         self._conn_attempts: int = 0
         self._conn_failures: int = 0
-        self._do_connect()
+        # tables changed in current transaction
+        self._tx_dirty: set[str] = set()
+        # queries prepared on the current connection
+        self._prepared: set[str] = set()
+        # memoized results in current transaction
+        self._memo: dict[tuple, Any] = {}
+        # pipeline mode, with pending results
+        self._pipeline: list[PipelineResult]|None = None
+        self._pipe: Any = None  # psycopg pipeline
+        self._pipe_pending: bool = False  # whether queries were sent since last sync
+
+    #
+    # CONNECTION POOL
+    #
+    def _cx(self) -> "DB":
+        """Get the connection holder for the current context."""
+        return self._pool_get() if self._pooled else self
+
+    def _bound(self) -> "DB|None":
+        """Get the connection holder for the current context, without checking out a pooled one."""
+        return getattr(self._pool_local, "cx", None) if self._pooled else self
+
+    def _spawn(self) -> "DB":
+        """Create a pooled connection holder sharing settings and queries."""
+        cx = copy.copy(self)
+        DB._counter += 1
+        cx._id = DB._counter
+        cx._pooled = cx._routed = False
+        cx._pool_all, cx._pool_idle = [], []
+        cx._replicas = []
+        cx._keepalive_thread, cx._keepalive_stop = None, threading.Event()
+        cx._init_conn()
+        return cx
+
+    def _pool_fill(self):
+        """Open initial pooled connections, each available as soon as it is connected."""
+        while True:
+            with self._pool_cond:
+                if len(self._pool_all) >= self._pool_size:
+                    return
+                cx = self._spawn()
+                self._pool_all.append(cx)
+            # connect outside of the lock, the holder is kept on failure
+            try:
+                cx._do_connect()
+            finally:
+                with self._pool_cond:
+                    self._pool_idle.append(cx)
+                    self._pool_cond.notify()
+
+    def _pool_get(self, bind: bool = True) -> "DB":
+        """Get the connection holder bound to the current thread, checking out one if needed.
+
+        Unless bound to the thread, the holder must be given back with ``_pool_release``.
+        """
+        cx = getattr(self._pool_local, "cx", None)
+        if cx is not None:
+            return cx
+        with self._pool_cond:
+            while True:
+                if self._pool_idle:
+                    cx = self._pool_idle.pop()
+                    break
+                if len(self._pool_all) < self._pool_max:
+                    cx = self._spawn()
+                    self._pool_all.append(cx)
+                    break
+                self._pool_waits += 1
+                if not self._pool_cond.wait(self._pool_timeout):
+                    raise AnoDBException(f"no pooled connection available after {self._pool_timeout}s")
+        # (re)connect outside of the lock, the holder is kept on failure
+        if cx._conn is None or cx._reconn:
+            try:
+                cx._reconnect()
+            except BaseException:
+                with self._pool_cond:
+                    self._pool_idle.append(cx)
+                    self._pool_cond.notify()
+                raise
+        if bind:
+            self._pool_local.cx = cx
+        return cx
+
+    def _pool_put(self):
+        """Release the connection holder bound to the current thread."""
+        self._pool_release(self._pool_local.__dict__.pop("cx"))
+
+    def _pool_release(self, cx: "DB"):
+        """Give a connection holder back to the pool."""
+        with self._pool_cond:
+            if len(self._pool_idle) >= self._pool_size:
+                # too many idle connections, drop this one but keep its stats
+                self._pool_all.remove(cx)
+                cx._close_quietly()
+                self._total += cx._total + cx._conn_total + cx._conn_nstat
+                self._ntx += cx._ntx + cx._conn_ntx
+                self._conn_count += cx._conn_count
+                self._conn_failures += cx._conn_failures
+            else:
+                self._pool_idle.append(cx)
+            self._pool_cond.notify()
+
+    #
+    # READ REPLICAS
+    #
+    def _spawn_replica(self, args: list[str], kwargs: dict[str, Any]) -> "DB":
+        """Create a read replica connection holder, with its own reconnection state."""
+        cx = self._spawn()
+        cx._conn_args, cx._conn_kwargs = args, kwargs
+        cx._breaker = _CircuitBreaker() if self._breaker is not None else None
+        return cx
+
+    def _replica_get(self) -> "DB":
+        """Choose a replica for a read, falling back to the primary if none is available.
+
+        Replicas are skipped while waiting for their reconnection delay.
+        """
+        now = dt.datetime.now(dt.timezone.utc)
+        ready = [cx for cx in self._replicas if cx._conn_last_fail is None or
+                 (now - cx._conn_last_fail).total_seconds() >= (cx._conn_delay or 0.0)]
+        if ready:
+            first = next(self._replica_next) % len(ready)
+            if self._replica_policy == "round-robin":
+                cx = ready[first]
+            else:  # least-loaded, with the fewest reads in flight, ties in turn
+                cx = min(ready[first:] + ready[:first], key=lambda cx: cx._inflight + cx._conn_nstat)
+            try:
+                if cx._conn is None or cx._reconn and cx._auto_reconnect:
+                    cx._ensure_conn()
+                return cx
+            except (self._db_error, CircuitOpenError) as error:
+                self._log_warning(f"replica {cx._id} unavailable: {error}")
+        self._replica_fallbacks += 1
+        return self
+
+    def _read_end(self, cx: "DB"):
+        """End the transaction of a single read, and give its pooled connection back."""
+        cx._inflight -= 1
+        try:
+            if cx._conn is not None and cx._conn_nstat:
+                try:
+                    cx.rollback()
+                except self._db_error as error:
+                    self._log_warning(f"connection {cx._id} rollback failed: {error}")
+                    cx._reconn = cx._auto_reconnect
+        finally:
+            if self._pooled:
+                self._pool_release(cx)
+
+    def _replicas_end(self):
+        """End read transactions on replicas, i.e. streaming selects."""
+        for cx in self._replicas:
+            if cx._conn is not None and cx._conn_nstat:
+                try:
+                    cx.rollback()
+                except self._db_error as error:
+                    self._log_warning(f"replica {cx._id} rollback failed: {error}")
+                    cx._reconn = cx._auto_reconnect
+
+    def _replicas_stats(self):
+        """Generate per replica statistics."""
+        return {
+            "policy": self._replica_policy,
+            "fallbacks": self._replica_fallbacks,
+            "endpoints": [
+                {"id": cx._id, "info": cx._conn_args, "conn": cx._conn_stats(), "total": cx._total,
+                 "ntx": cx._ntx, "count": cx._conn_count} |
+                ({"breaker": cx._breaker.stats()} if cx._breaker is not None else {})
+                for cx in self._replicas
+            ],
+        }
+
+    def _close_quietly(self):
+        """Close current connection, ignoring errors."""
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except self._db_error as error:  # pragma: no cover
+                self._log_warning(f"close failed: {error}")
+            self._conn = None
+
+    def _orphan(self):
+        """Forget the current connection without closing it, to reconnect on next use."""
+        if self._conn is not None:
+            _FORK_ORPHANS.append(self._conn)
+        self._conn = None
+        self._reconn = True
+        self._conn_lock = threading.Lock()
+        self._conn_nstat = 0
+        self._tx_dirty = set()
+        self._prepared = set()
+        self._memo.clear()
+        self._pipeline, self._pipe, self._pipe_pending = None, None, False
+
+    def _forked(self):
+        """Reset connection state in a forked child process.
+
+        Inherited connections share their socket with the parent, so they are
+        dropped without being closed, and new ones are created lazily on first
+        use. Loaded queries and their wrappers are kept.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        self._log_info(f"forked from process {self._pid}, dropping inherited connections")
+        self._pid = pid
+        for cx in [self] + self._pool_all + self._replicas:
+            cx._orphan()
+        # pooled holders are refilled on demand
+        self._pool_all, self._pool_idle = [], []
+        self._pool_cond = threading.Condition()
+        self._pool_local = threading.local()
+        self._lazy_lock = threading.Lock()
+        self._tx_local = threading.local()
+        # threads are not inherited
+        self._keepalive_stop = threading.Event()
+        self._keepalive_thread = None
+        if self._keepalive is not None:
+            self._keepalive_start()
 
     def _possibly_reconnect(self):
         """Detect a connection error for psycopg."""
@@ -196,63 +1567,595 @@ class DB:
     def _call_fn(self, _query, _fn, *args, **kwargs):
         """Forward method call to aiosql query.
 
-        On connection failure, it will try to reconnect on the next call
-        if auto_reconnect was set.
+        On connection failure, it will try to reconnect on the next call
+        if auto_reconnect was set.
+
+        This may or may not be a good idea, but it should be: the failure
+        raises an exception which should abort the current request, so that
+        the next call should be on a different request.
+        """
+        _ = self._debug and self._log_debug(f"{_query}({args}, {kwargs})")
+        cx, single = self._route(_query) if self._routed else (self, False)
+        try:
+            if cx._reconn and (cx._auto_reconnect or cx._conn is None):
+                cx._ensure_conn()
+            if self._idle_check:
+                now = time.monotonic()
+                # only check outside of transactions, which would be lost on reconnection
+                if (self._pre_ping is not None and cx._conn is not None and not cx._conn_nstat and
+                        now - cx._conn_used >= self._pre_ping):
+                    cx._ping_conn()
+                cx._conn_used = now
+            cx._conn_nstat += 1
+            self._count[_query] += 1
+            if self._last_calls:
+                self._calls.append(_query)
+            conn = cx._conn
+            if (self._prepare_threshold is not None and _query in self._preparable and
+                    self._count[_query] > self._prepare_threshold):
+                conn = self._prepare(_query, cx)
+            start = time.perf_counter() if self._measure else 0.0
+            try:
+                if cx._pipeline is None:
+                    res = _fn(conn, *args, **kwargs)
+                    if single and isinstance(res, types.GeneratorType):
+                        res = list(res)  # fetch rows before ending the read
+                else:
+                    res = self._pipelined(_query, _fn, conn, cx, args, kwargs)
+            except self._db_error as error:
+                if self._measure:
+                    self._record(_query, time.perf_counter() - start, cx, args, kwargs)
+                raise self._query_error(_query, cx, error)
+            except Exception as e:  # pragma: no cover
+                self._log_error(f"unexpected exception: {e}")
+                raise
+            if self._measure:
+                elapsed = time.perf_counter() - start
+                if isinstance(res, types.GeneratorType):  # plain select, time iterations
+                    return self._timed_gen(res, elapsed, lambda t: self._record(_query, t, cx, args, kwargs))
+                self._record(_query, elapsed, cx, args, kwargs)
+            return res
+        finally:
+            if single:
+                self._read_end(cx)
+
+    def _route(self, _query: str) -> tuple["DB", bool]:
+        """Choose the connection holder of a query in pool mode or with replicas.
+
+        Also tell whether it is a single read, i.e. a read outside of a transaction
+        which transaction is ended right away, so that its pooled connection is
+        given back and replicas are not left idle in transaction.
+        """
+        if self._pooled:
+            cx = getattr(self._pool_local, "cx", None)
+            if cx is not None:  # within a transaction
+                return cx, False
+            single = _query in self._single_reads and not getattr(self._tx_local, "primary", False)
+            cx = self._pool_get(bind=not single)
+        elif (_query in self._readable and not self._conn_nstat and self._pipeline is None
+                and not getattr(self._tx_local, "primary", False)):
+            # reads outside of a primary transaction or scope
+            cx = self._replica_get()
+            # do not end a pending streaming read
+            single = _query in self._single_reads and not cx._conn_nstat
+        else:
+            return self, False
+        if single:
+            cx._inflight += 1
+        return cx, single
+
+    def _query_error(self, _query: str, cx: "DB", error: BaseException) -> BaseException:
+        """Cleanup after a query failure and return the exception to raise."""
+        self._log_info(f"query {_query} failed: {error}")
+        self._tx_local.failed = _query
+        self._memo.clear()
+        cx._memo.clear()
+        if self._auto_rollback:
+            try:
+                if cx._conn:
+                    cx._conn.rollback()
+            except self._db_error as rolerr:
+                self._log_warning(f"rollback failed: {rolerr}")
+        cx._possibly_reconnect()
+        # the transaction is over, give the connection back, single reads are given back anyway
+        if self._pooled and self._auto_rollback and self._bound() is cx:
+            self._pool_put()
+        return self._exception(error) if self._exception else error
+
+    def _prepare(self, q: str, cx: "DB"):
+        """Get a connection proxy for running a hot query as a prepared statement."""
+        if q in cx._prepared:
+            self._prepared_hits[q] = self._prepared_hits.get(q, 0) + 1
+        else:
+            self._log_debug(f"preparing query {q} on connection {cx._id}")
+            cx._prepared.add(q)
+            self._prepares[q] = self._prepares.get(q, 0) + 1
+        return _PreparedConnection(cx._conn, self._prepare_options)  # type: ignore
+
+    def _ping_conn(self) -> bool:
+        """Check current connection liveness, and reconnect if it is dead."""
+        self._health["pings"] += 1
+        try:
+            self._ping(self._conn)
+            self._conn_used = time.monotonic()
+            return True
+        except self._db_error as error:
+            self._health["failures"] += 1
+            self._log_warning(f"connection {self._id} check failed: {error}")
+            if not self._auto_reconnect:
+                raise self._exception(error) if self._exception else error
+            self._reconnect()
+            self._health["reconnects"] += 1
+            return False
+
+    def _keepalive_start(self):
+        """Start the background thread checking idle pooled connections."""
+        # the thread only holds a weak reference, so that the object may be collected
+        ref = weakref.ref(self)
+        interval, stop = self._keepalive, self._keepalive_stop
+
+        def keepalive():
+            while not stop.wait(interval):
+                db = ref()
+                if db is None:  # pragma: no cover
+                    return
+                db._keepalive_round()
+                del db
+
+        self._keepalive_thread = threading.Thread(target=keepalive, name=f"anodb-keepalive-{self._id}", daemon=True)
+        self._keepalive_thread.start()
+
+    def _keepalive_round(self):
+        """Check pooled connections idle for at least the keepalive interval."""
+        now = time.monotonic()
+        with self._pool_cond:
+            idle = [cx for cx in self._pool_idle
+                    if cx._conn is not None and now - cx._conn_used >= self._keepalive]  # type: ignore
+            for cx in idle:
+                self._pool_idle.remove(cx)
+        for cx in idle:
+            try:
+                cx._ping_conn()
+            except BaseException as error:
+                self._log_warning(f"keepalive failed on connection {cx._id}: {error}")
+            finally:
+                with self._pool_cond:
+                    self._pool_idle.append(cx)
+                    self._pool_cond.notify()
+
+    #
+    # PIPELINE MODE
+    #
+    @contextlib.contextmanager
+    def pipeline(self):
+        """Batch the round trips of queries run within the block.
 
-        This may or may not be a good idea, but it should be: the failure
-        raises an exception which should abort the current request, so that
-        the next call should be on a different request.
+        Query calls return a ``PipelineResult`` instead of their result.
+        With psycopg, queries are sent in pipeline mode without waiting for
+        their results, which are fetched together on the first ``result()``
+        or at the end of the block.
+        Other drivers run queries eagerly.
+        Streaming and ``*_cursor`` queries are returned as usual.
+
+        On a database error, pending results fail with it and the transaction
+        is rolled back if ``auto_rollback`` is set.
         """
-        _ = self._debug and self._log_debug(f"{_query}({args}, {kwargs})")
-        if self._reconn and self._auto_reconnect:
-            self._reconnect()
-        self._conn_nstat += 1
-        self._count[_query] += 1
-        if self._last_calls:
-            self._calls.append(_query)
-            while len(self._calls) > self._last_calls:
-                self._calls.popleft()
+        cx = self._cx()
+        if cx._pipeline is not None:
+            raise AnoDBException("pipelines cannot be nested")
+        if cx._reconn and (cx._auto_reconnect or cx._conn is None):
+            cx._ensure_conn()
+        cx._pipeline = []
+        try:
+            if self._db == "psycopg" and hasattr(cx._conn, "pipeline"):
+                with cx._conn.pipeline() as pipe:  # type: ignore
+                    cx._pipe = pipe
+                    yield self
+                    self._pipeline_sync(cx)
+                    cx._pipe = None
+                # results are all there, keep them in case
+                for res in cx._pipeline:
+                    if res._cur is not None:
+                        self._pipeline_fetch(res)
+            else:
+                yield self
+        finally:
+            # results left pending on errors in the block are lost
+            for res in cx._pipeline:
+                if res._cur is not None:
+                    res._cur.close()
+                    res._cur, res._error = None, AnoDBException(f"pipeline aborted before query {res._query}")
+            cx._pipeline, cx._pipe, cx._pipe_pending = None, None, False
+
+    def _pipelined(self, q: str, fn: Callable, conn, cx: "DB", args, kwargs):
+        """Send a query within a pipeline, or run it eagerly."""
+        if q.endswith("_cursor") or q in self._streams:  # iterated by the caller
+            return fn(conn, *args, **kwargs)
+        f = self._query_fns[q]
+        if cx._pipe is None or fn is not f:
+            res = fn(conn, *args, **kwargs)
+            return PipelineResult(self, q, cx, value=list(res) if isinstance(res, types.GeneratorType) else res)
+        queries, op = f.__self__, f.operation  # type: ignore
+        cur = queries.driver_adapter._cursor(conn)
+        try:
+            if op == Ops.INSERT_UPDATE_DELETE_MANY:
+                cur.executemany(f.sql, *args)  # type: ignore
+            elif op == Ops.SCRIPT:
+                cur.execute(f.sql)  # type: ignore
+            else:
+                cur.execute(f.sql, queries._params(f.attributes, f.parameters, args, kwargs))  # type: ignore
+        except BaseException:
+            cur.close()
+            raise
+        cx._pipe_pending = True
+        res = PipelineResult(self, q, cx, cur, op)
+        cx._pipeline.append(res)  # type: ignore
+        return res
+
+    def _pipeline_sync(self, cx: "DB"):
+        """Get pending pipeline results from the server, failing them all on errors."""
+        if not cx._pipe_pending:
+            return
         try:
-            return _fn(self._conn, *args, **kwargs)
+            cx._pipe.sync()
+            cx._pipe_pending = False
         except self._db_error as error:
-            self._log_info(f"query {_query} failed: {error}")
-            if self._auto_rollback:
+            cx._pipe_pending = False
+            pending = [res for res in cx._pipeline or [] if res._cur is not None]
+            error = self._query_error(pending[0]._query if pending else "pipeline", cx, error)
+            for res in pending:
+                res._cur.close()
+                res._cur, res._error = None, error
+            raise error
+
+    def _pipeline_fetch(self, res: PipelineResult):
+        """Fetch a pipelined query result."""
+        cx = res._cx
+        if cx._pipe is not None:
+            self._pipeline_sync(cx)
+        try:
+            res._value = _fetch_result(res._op, res._cur)  # type: ignore
+        except self._db_error as error:  # pragma: no cover
+            res._error = self._query_error(res._query, cx, error)
+        finally:
+            res._cur.close()
+            res._cur = None
+
+    def _timed_gen(self, gen, elapsed: float, done: Callable[[float], None]):
+        """Forward a generator while accumulating its execution time."""
+        try:
+            while True:
+                start = time.perf_counter()
                 try:
-                    if self._conn:
-                        self._conn.rollback()
-                except self._db_error as rolerr:
-                    self._log_warning(f"rollback failed: {rolerr}")
-            self._possibly_reconnect()
-            # re-raise error
-            raise self._exception(error) if self._exception else error
-        except Exception as e:  # pragma: no cover
-            self._log_error(f"unexpected exception: {e}")
-            raise
+                    row = next(gen)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield row
+        finally:
+            gen.close()
+            done(elapsed)
+
+    def _record(self, q: str, elapsed: float, cx: "DB", args, kwargs):
+        """Record query latency and report slow queries."""
+        if self._timing:
+            self._latency[q].add(elapsed)
+        if self._slow_threshold is not None and elapsed >= self._slow_threshold:
+            try:
+                params = self._slow_params(args, kwargs)
+            except Exception as e:
+                params = f"<cannot render parameters: {e}>"
+            self._log_warning(f"slow query {q} on connection {cx._id}: {elapsed:.6f}s with {params}")
+            self._slow.append({
+                "query": q,
+                "duration": elapsed,
+                "params": params,
+                "conn": cx._id,
+                "at": dt.datetime.now(dt.timezone.utc).isoformat(),
+            })
+
+    def _wrap_fn(self, q: str, f: Callable) -> Callable:
+        """Wrap one query so as to call it through the internal caller."""
+        if self._fast_path and not (self._debug or self._pooled or self._idle_check or
+                                    self._prepare_threshold is not None or self._replica_conf):
+            return self._timed_fast_fn(q, f) if self._measure else self._fast_fn(q, f)
 
-    def _create_fn(self, q: str, f: Callable) -> Callable:
-        """Create one wrapped method."""
-        # call internal caller
         @ft.wraps(f)
         def fn(*a, **kw):
             return self._call_fn(q, f, *a, **kw)
-        # FIXME cachability may not work on some types? lo?
-        # NOTE we skip internal *_cursor attributes
-        if self._cacher and not q.endswith("_cursor") and f.__doc__ and re.search(self._cached, f.__doc__):
-            operation = f.operation  # type: ignore
-            if operation not in self._SELECT_OPS:
-                self._log_warning(f"skip caching non select method: {q} ({operation})")
-                return fn
-            # else proceed with wrapping
-            self._log_debug(f"caching query {q}")
-            if operation == Ops.SELECT:  # materialize generator
-                @ft.wraps(fn)
-                def fx(*a, **kw):
-                    return list(fn(*a, **kw))
+        return fn
+
+    def _fast_fn(self, q: str, f: Callable) -> Callable:
+        """Wrap one query with a lean caller, when optional features are disabled.
+
+        Reconnections go through the internal caller.
+        """
+        count = self._count
+
+        @ft.wraps(f)
+        def fast(*a, **kw):
+            if self._reconn or self._pipeline is not None:
+                return self._call_fn(q, f, *a, **kw)
+            self._conn_nstat += 1
+            count[q] += 1
+            if self._last_calls:
+                self._calls.append(q)
+            try:
+                return f(self._conn, *a, **kw)
+            except self._db_error as error:
+                raise self._query_error(q, self, error)
+        return fast
+
+    def _timed_fast_fn(self, q: str, f: Callable) -> Callable:
+        """Wrap one query with a lean caller which measures its latency."""
+        count = self._count
+        if self._slow_threshold is None:
+            add = self._latency.setdefault(q, LatencyHistogram()).add
+
+            def record(t: float, a: tuple, kw: dict[str, Any]):
+                add(t)
+        else:
+            def record(t: float, a: tuple, kw: dict[str, Any]):
+                self._record(q, t, self, a, kw)
+        perf_counter = time.perf_counter
+
+        @ft.wraps(f)
+        def timed(*a, **kw):
+            if self._reconn or self._pipeline is not None:
+                return self._call_fn(q, f, *a, **kw)
+            self._conn_nstat += 1
+            count[q] += 1
+            if self._last_calls:
+                self._calls.append(q)
+            start = perf_counter()
+            try:
+                res = f(self._conn, *a, **kw)
+            except self._db_error as error:
+                record(perf_counter() - start, a, kw)
+                raise self._query_error(q, self, error)
+            elapsed = perf_counter() - start
+            if isinstance(res, types.GeneratorType):  # plain select, time iterations
+                return self._timed_gen(res, elapsed, lambda t: record(t, a, kw))
+            record(elapsed, a, kw)
+            return res
+        return timed
+
+    def _materialize(self, fn: Callable) -> Callable:
+        """Wrap a generator-returning function so that it returns a list."""
+        @ft.wraps(fn)
+        def fx(*a, **kw):
+            return list(fn(*a, **kw))
+        return fx
+
+    def _stream_fn(self, q: str, f: Callable, fetch: int) -> Callable:
+        """Create an aiosql-like select function which fetches rows by batches.
+
+        Server-side cursors are used with postgres drivers, so that the client
+        only holds one batch at a time, and ``fetchmany`` elsewhere.
+        """
+        queries = f.__self__  # type: ignore
+
+        @ft.wraps(f)
+        def stream(conn, *args, **kwargs):
+            params = queries._params(f.attributes, f.parameters, args, kwargs)  # type: ignore
+            name = f"anodb_{self._id}_{next(_CURSOR_IDS)}"
+            if self._db in ("psycopg", "psycopg2"):
+                # named cursors are server-side, keep them across commits in autocommit mode
+                cur = conn.cursor(*queries.driver_adapter._args, name=name,
+                                  withhold=bool(getattr(conn, "autocommit", False)),
+                                  **queries.driver_adapter._kwargs)
+                cur.itersize = fetch
             else:
-                fx = fn
-            return self._cacher(q, fx)
+                cur = queries.driver_adapter._cursor(conn)
+            try:
+                if self._db == "pg8000":
+                    cur.execute(f"DECLARE {name} NO SCROLL CURSOR FOR {f.sql}", params)  # type: ignore
+                    try:
+                        while True:
+                            cur.execute(f"FETCH FORWARD {fetch} FROM {name}")
+                            rows = cur.fetchall()
+                            if not rows:
+                                break
+                            yield from rows
+                    finally:
+                        cur.execute(f"CLOSE {name}")
+                else:
+                    if params:
+                        cur.execute(f.sql, params)  # type: ignore
+                    else:
+                        cur.execute(f.sql)  # type: ignore
+                    if self._db in ("psycopg", "psycopg2"):
+                        yield from cur
+                    else:
+                        while rows := cur.fetchmany(fetch):
+                            yield from rows
+            finally:
+                if cur is not conn:  # duckdb may run on the connection
+                    cur.close()
+
+        return stream
+
+    def _columnar_fn(self, q: str, f: Callable, fmt: str, fetch: int) -> Callable:
+        """Create an aiosql-like select function which returns columns.
+
+        Columns are filled by ``fetchmany`` batches, or by native fetchers with duckdb.
+        """
+        if fmt not in _COLUMNAR_FORMATS:
+            raise AnoDBException(f"unexpected columnar format for {q}: {fmt}")
+        queries = f.__self__  # type: ignore
+
+        @ft.wraps(f)
+        def columnar(conn, *args, **kwargs):
+            params = queries._params(f.attributes, f.parameters, args, kwargs)  # type: ignore
+            cur = queries.driver_adapter._cursor(conn)
+            try:
+                if params:
+                    cur.execute(f.sql, params)  # type: ignore
+                else:
+                    cur.execute(f.sql)  # type: ignore
+                if self._db == "duckdb" and fmt == "numpy":
+                    return cur.fetchnumpy()
+                if self._db == "duckdb" and fmt == "arrow":
+                    return (getattr(cur, "to_arrow_table", None) or cur.fetch_arrow_table)()
+                # NOTE description may only be available after a fetch, eg in pipeline mode
+                rows = cur.fetchmany(fetch)
+                names = [d[0] for d in cur.description or []]
+                columns: list[list] = [[] for _ in names]
+                while rows:
+                    for column, values in zip(columns, zip(*rows)):
+                        column.extend(values)
+                    rows = cur.fetchmany(fetch)
+                return _columns(names, columns, fmt)
+            finally:
+                if cur is not conn:
+                    cur.close()
+
+        return columnar
+
+    def _query_tables(self, f: Callable) -> set[str]:
+        """Tables used by a query, from its ``TABLES:`` doc annotation or its SQL."""
+        annotation = _TABLES_DOC.search(f.__doc__ or "")
+        if annotation:
+            names = annotation.group(1).split(",")
         else:
+            names = []
+            for m in _TABLES_SQL.finditer(_SQL_STRING.sub("''", f.sql)):  # type: ignore
+                names.extend(item.split()[0] for item in m.group(1).split(","))
+        # schema-qualified names are matched on their last component
+        return {name.strip().split(".")[-1].strip('"`').lower() for name in names if name.strip()}
+
+    def _track_writes(self, q: str, f: Callable, fn: Callable) -> Callable:
+        """Wrap a non-select query so as to record the tables it changes."""
+        # unknown tables invalidate all cached queries
+        tables = self._query_tables(f) or {_ANY_TABLE}
+        self._log_debug(f"query {q} writes {sorted(tables)}")
+        if inspect.iscoroutinefunction(fn):
+            @ft.wraps(fn)
+            async def afw(*a, **kw):
+                res = await fn(*a, **kw)
+                self._tx_dirty.update(tables)
+                return res
+            return afw
+        else:
+            @ft.wraps(fn)
+            def fw(*a, **kw):
+                res = fn(*a, **kw)
+                self._cx()._tx_dirty.update(tables)
+                return res
+            return fw
+
+    def _create_fn(self, q: str, f: Callable) -> Callable:
+        """Create one wrapped method."""
+        stream = f.operation == Ops.SELECT and _STREAM_DOC.search(f.__doc__ or "")  # type: ignore
+        if stream and not q.endswith("_cursor"):
+            fetch = int(stream.group(1) or self._stream_fetch)
+            self._log_debug(f"streaming query {q} by {fetch}")
+            self._streams[q] = fetch
+            f = self._stream_fn(q, f, fetch)
+        columnar = f.operation == Ops.SELECT and _COLUMNAR_DOC.search(f.__doc__ or "")  # type: ignore
+        if columnar and not stream and not q.endswith("_cursor"):
+            fmt = columnar.group(1) or "numpy"
+            self._log_debug(f"columnar query {q} as {fmt}")
+            f = self._columnar_fn(q, f, fmt, self._stream_fetch)
+        fn = self._wrap_fn(q, f)
+        if self._tx_memo and not q.endswith("_cursor"):
+            if f.operation in _MEMO_OPS:  # type: ignore
+                fn = self._memoize(q, fn)
+            elif f.operation not in self._SELECT_OPS:  # type: ignore
+                fn = self._forget(q, fn)
+        # NOTE we skip internal *_cursor attributes
+        if not self._cacher or q.endswith("_cursor"):
+            return fn
+        # FIXME cachability may not work on some types? lo?
+        is_cached = f.__doc__ and re.search(self._cached, f.__doc__)
+        operation = f.operation  # type: ignore
+        if operation not in self._SELECT_OPS:
+            if is_cached:
+                self._log_warning(f"skip caching non select method: {q} ({operation})")
+            return self._track_writes(q, f, fn)
+        if not is_cached:
             return fn
+        # else proceed with wrapping
+        self._log_debug(f"caching query {q}")
+        fx = self._materialize(fn) if operation == Ops.SELECT else fn
+        cached = self._cacher(q, fx)
+        self._caches[q] = cached
+        for table in self._query_tables(f):
+            self._table_deps.setdefault(table, set()).add(q)
+        if inspect.iscoroutinefunction(fn):  # no async pipelines
+            return cached
+
+        @ft.wraps(cached)
+        def uncached(*a, **kw):
+            # deferred results are not cached
+            return fn(*a, **kw) if self._in_pipeline() else cached(*a, **kw)
+        return uncached
+
+    def _in_pipeline(self) -> bool:
+        """Whether the current context is in pipeline mode, without checking out a pooled connection."""
+        cx = self._bound()
+        return cx is not None and cx._pipeline is not None
+
+    def _memoize(self, q: str, fn: Callable) -> Callable:
+        """Wrap a one row or value select so as to memoize its results in the current transaction."""
+        self._memo_hits[q] = 0
+        if inspect.iscoroutinefunction(fn):
+            @ft.wraps(fn)
+            async def amemo(*a, **kw):
+                key = _memo_key(q, a, kw)
+                if key is None:
+                    return await fn(*a, **kw)
+                if key in self._memo:
+                    self._memo_hits[q] += 1
+                    return self._memo[key]
+                res = self._memo[key] = await fn(*a, **kw)
+                return res
+            return amemo
+        else:
+            @ft.wraps(fn)
+            def memo(*a, **kw):
+                cx = self._bound()
+                key = _memo_key(q, a, kw)
+                # single pooled reads and deferred results are not memoized
+                if key is None or cx is None or cx._pipeline is not None:
+                    return fn(*a, **kw)
+                if key in cx._memo:
+                    self._memo_hits[q] += 1
+                    return cx._memo[key]
+                res = cx._memo[key] = fn(*a, **kw)
+                return res
+            return memo
+
+    def _forget(self, q: str, fn: Callable) -> Callable:
+        """Wrap a non-select query so as to clear memoized results."""
+        if inspect.iscoroutinefunction(fn):
+            @ft.wraps(fn)
+            async def aforget(*a, **kw):
+                self._memo.clear()
+                return await fn(*a, **kw)
+            return aforget
+        else:
+            @ft.wraps(fn)
+            def forget(*a, **kw):
+                self._cx()._memo.clear()
+                return fn(*a, **kw)
+            return forget
+
+    def _invalidate(self):
+        """Invalidate cached queries which depend on tables changed by the transaction."""
+        queries = set()
+        if _ANY_TABLE in self._tx_dirty:
+            queries.update(self._caches)
+        for table in self._tx_dirty:
+            queries.update(self._table_deps.get(table, ()))
+        self._tx_dirty.clear()
+        for q in queries:
+            cached = self._caches[q]
+            if hasattr(cached, "cache_clear"):
+                self._log_debug(f"invalidating cached query {q}")
+                cached.cache_clear()  # type: ignore
+                self._invalidated[q] = self._invalidated.get(q, 0) + 1
 
     # this could probably be done dynamically by overriding __getattribute__
     def _create_fns(self, queries: sql.aiosql.Queries):  # type: ignore
@@ -265,14 +2168,123 @@ class DB:
             f = getattr(queries, q)
             if callable(f):
                 self._log_debug(f"adding q={q}")
-                if hasattr(self, q):
+                if self._has_attr(q):
                     raise AnoDBException(f"cannot override existing method: {q}")
                 setattr(self, q, self._create_fn(q, f))
                 self._available_queries.add(q)
+                self._query_fns[q] = f
+                if self._prepare_options is not None and f.operation in _PREPARE_OPS:  # type: ignore
+                    self._preparable.add(q)
+                if f.operation in self._SELECT_OPS and not q.endswith("_cursor"):  # type: ignore
+                    self._readable.add(q)
+                    if q not in self._streams:
+                        self._single_reads.add(q)
                 self._count[q] = 0
+                self._latency.setdefault(q, LatencyHistogram())
+
+    def _has_attr(self, name: str) -> bool:
+        """Tell whether an attribute exists, without loading lazy queries."""
+        return name in self.__dict__ or hasattr(type(self), name)
+
+    def _scan_queries(self, path: str):
+        """Register queries from a file or directory for lazy loading."""
+        from aiosql.query_loader import _remove_ml_comments  # type: ignore
+
+        root = pathlib.Path(path)
+        files = sorted(f for f in root.iterdir() if f.is_file() and f.suffix == ".sql") if root.is_dir() else [root]
+        for file in files:
+            # first item is anything before the first query definition
+            for qdef in _QUERY_DEF.split(_remove_ml_comments(file.read_text()))[1:]:
+                header = qdef.split("\n", 1)[0].strip()
+                name = _QUERY_NAME.match(header).group(0).replace("-", "_")  # type: ignore
+                # plain selects also provide a cursor variant
+                names = [name] if header.endswith(("^", "$", "!", "#")) else [name, f"{name}_cursor"]
+                entry = (str(file), "-- name: " + qdef, names)
+                for q in names:
+                    self._log_debug(f"scanning q={q}")
+                    if q in self._lazy or self._has_attr(q):
+                        raise AnoDBException(f"cannot override existing method: {q}")
+                    self._lazy[q] = entry
+                    self._available_queries.add(q)
+                    self._count[q] = 0
+                    self._latency[q] = LatencyHistogram()
+
+    def _load_query(self, name: str):
+        """Parse and bind a lazily loaded query and its variants."""
+        with self._lazy_lock:
+            if name not in self._lazy:  # pragma: no cover  # loaded by another thread
+                return
+            path, qdef, names = self._lazy[name]
+            self._log_debug(f"loading q={name} from {path}")
+            self.add_queries_from_str(qdef)
+            # forget names only once bound, so that concurrent accesses wait for them
+            for q in names:
+                del self._lazy[q]
+
+    def __getattr__(self, name: str):
+        """Load lazy queries on first access."""
+        # NOTE __dict__ may be empty, eg while copying
+        lazy = self.__dict__.get("_lazy")
+        if lazy is None or name not in lazy:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        self._load_query(name)
+        return self.__dict__[name]
+
+    def _cache_key(self, path: pathlib.Path) -> str:
+        """Compute the query cache key of a file or directory."""
+        files = sorted(path.rglob("*.sql")) if path.is_dir() else [path]
+        key = {
+            "files": [(str(f.resolve()), f.stat().st_size, f.stat().st_mtime_ns) for f in files],
+            "driver": self._db,
+            "adapter": [repr(self._adapter_args), repr(sorted(self._adapter_kwargs.items()))],
+            "options": [self._kwargs_only, self._attribute, self._mandatory_parameters],
+            "versions": [__version__, self.__aiosql_version__, sys.version],
+        }
+        return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+    def _load_cached(self, fn: str) -> sql.aiosql.Queries:  # type: ignore
+        """Load queries from a file or directory through the on-disk query cache."""
+        from aiosql.query_loader import QueryLoader  # type: ignore
+        from aiosql.queries import Queries  # type: ignore
+
+        path = pathlib.Path(fn)
+        if not path.exists():
+            raise sql.SQLLoadException(f"File does not exist: {path}")
+        adapter = sql.aiosql._make_driver_adapter(self._db, *self._adapter_args, **self._adapter_kwargs)
+        cache = pathlib.Path(self._query_cache) / f"{self._cache_key(path)}.pickle"  # type: ignore
+        data = None
+        if cache.exists():
+            try:
+                data = pickle.loads(cache.read_bytes())
+                self._query_cache_hits += 1
+                self._log_debug(f"loaded {fn} from query cache {cache}")
+            except Exception as e:
+                self._log_warning(f"ignoring broken query cache {cache}: {e}")
+        if data is None:
+            self._query_cache_misses += 1
+            loader = QueryLoader(adapter, None, attribute=self._attribute,
+                                 mandatory_parameters=self._mandatory_parameters)
+            if path.is_dir():
+                data = loader.load_query_data_from_dir_path(path)
+            else:
+                data = loader.load_query_data_from_file(path)
+            try:
+                cache.parent.mkdir(parents=True, exist_ok=True)
+                # write and rename so that concurrent readers only see complete files
+                tmp = cache.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+                tmp.write_bytes(pickle.dumps(data))
+                os.replace(tmp, cache)
+            except OSError as e:
+                self._log_warning(f"cannot write query cache {cache}: {e}")
+        queries = Queries(adapter, kwargs_only=self._kwargs_only)
+        return queries.load_from_tree(data) if isinstance(data, dict) else queries.load_from_list(data)
 
     def add_queries_from_path(self, fn: str):
         """Load queries from a file or directory."""
+        if self._lazy_queries:
+            return self._scan_queries(fn)
+        if self._query_cache:
+            return self._create_fns(self._load_cached(fn))
         self._create_fns(sql.from_path(fn, self._db, *self._adapter_args,
                                        kwargs_only=self._kwargs_only, attribute=self._attribute,
                                        mandatory_parameters=self._mandatory_parameters,
@@ -325,39 +2337,67 @@ class DB:
         # PEP249 does not impose a unified signature for connect.
         return self._db_pkg.connect(*self._conn_args, **self._conn_kwargs)
 
+    def _connect_wait(self) -> float:
+        """Count a connection attempt and return how long to wait before it."""
+        self._conn_attempts += 1
+        if self._breaker is not None:
+            self._breaker.enter(self._CONNECTION_MAX_DELAY)
+            return 0.0
+        if self._conn_delay is None:
+            return 0.0
+        delay = dt.timedelta(seconds=self._conn_delay * (1.0 + random.uniform(0.0, self._connect_jitter)))
+        assert self._conn_last_fail
+        wait = (delay - (dt.datetime.now(dt.timezone.utc) - self._conn_last_fail)).total_seconds()
+        if wait > 0.0:
+            self._log_info(f"connection wait #{self._conn_attempts}: {wait}")
+        return wait
+
+    def _connect_success(self):
+        """Update stats and reset reconnection throttling on success."""
+        self._ntx += self._conn_ntx
+        self._total += self._conn_total
+        self._conn_count += 1
+        self._conn_last = dt.datetime.now(dt.timezone.utc)
+        self._conn_total = 0
+        self._conn_ntx = 0
+        self._conn_attempts = 0
+        self._conn_last_fail = None
+        self._conn_delay = None
+        self._conn_used = time.monotonic()
+        if self._breaker is not None:
+            self._breaker.success()
+        # prepared statements and transaction are lost with the previous connection
+        self._prepared = set()
+        self._memo.clear()
+
+    def _connect_failure(self, e: BaseException):
+        """Update stats and increase reconnection throttling on failure."""
+        self._conn_failures += 1
+        self._conn_last = None
+        self._conn_last_fail = dt.datetime.now(dt.timezone.utc)
+        if self._conn_delay is None:
+            self._conn_delay = self._CONNECTION_MIN_DELAY
+        else:
+            self._conn_delay = min(2 * self._conn_delay, self._CONNECTION_MAX_DELAY)
+        if self._breaker is not None:
+            self._breaker.failure(self._CONNECTION_MIN_DELAY, self._CONNECTION_MAX_DELAY, self._connect_jitter)
+        self._log_error(f"connect failed #{self._conn_attempts}: {e}")
+
     def _do_connect(self):
         """Create a connection, possibly with active throttling."""
         self._conn = None
         try:
-            self._conn_attempts += 1
-            if self._conn_delay is not None:
-                delay = dt.timedelta(seconds=self._conn_delay)
-                assert self._conn_last_fail
-                wait = (delay - (dt.datetime.now(dt.timezone.utc) - self._conn_last_fail)).total_seconds()
-                if wait > 0.0:
-                    self._log_info(f"connection wait #{self._conn_attempts}: {wait}")
-                    time.sleep(wait)
+            wait = self._connect_wait()
+            if wait > 0.0:
+                time.sleep(wait)
             self._conn = self.__connect()
-            # on success, update stats
-            self._ntx += self._conn_ntx
-            self._total += self._conn_total
-            self._conn_count += 1
-            self._conn_last = dt.datetime.now(dt.timezone.utc)
-            self._conn_total = 0
-            self._conn_ntx = 0
-            # on success, reset reconnection stuff
-            self._conn_attempts = 0
-            self._conn_last_fail = None
-            self._conn_delay = None
+            if (self._prepare_threshold is not None and hasattr(self._conn, "prepare_threshold")
+                    and "prepare_threshold" not in self._conn_kwargs):
+                # psycopg: only prepare hot queries explicitely, unless set by the user
+                self._conn.prepare_threshold = None  # type: ignore
+            self._connect_success()
         except self._db_error as e:
-            self._conn_failures += 1
-            self._conn_last = None
-            self._conn_last_fail = dt.datetime.now(dt.timezone.utc)
-            if self._conn_delay is None:
-                self._conn_delay = self._CONNECTION_MIN_DELAY
-            else:
-                self._conn_delay = min(2 * self._conn_delay, self._CONNECTION_MAX_DELAY)
-            self._log_error(f"connect failed #{self._conn_attempts}: {e}")
+            self._connect_failure(e)
             raise e
 
     def _reconnect(self):
@@ -372,18 +2412,52 @@ class DB:
         self._do_connect()
         self._reconn = False
 
+    def _ensure_conn(self):
+        """(Re)connect if needed, once for concurrent callers such as ``warmup``."""
+        with self._conn_lock:
+            if self._conn is None or self._reconn:
+                self._reconnect()
+
     def connect(self):
         """Create (if needed) and return the database connection."""
-        if "_conn" not in self.__dict__ or not self._conn:
-            self._do_connect()
+        if self._pooled:
+            return self._pool_get()._conn
+        if not self._conn:
+            self._ensure_conn()
         return self._conn
 
+    def warmup(self) -> threading.Thread:
+        """Open connection(s) in a background thread, and return the thread.
+
+        Failures are logged, the connection is attempted again on first use.
+        """
+        def warm():
+            try:
+                if self._pooled:
+                    self._pool_fill()
+                else:
+                    self._ensure_conn()
+            except self._db_error as error:
+                self._log_warning(f"warmup failed: {error}")
+            for cx in self._replicas:
+                try:
+                    cx._ensure_conn()
+                except (self._db_error, CircuitOpenError) as error:
+                    self._log_warning(f"replica {cx._id} warmup failed: {error}")
+
+        thread = threading.Thread(target=warm, name=f"anodb-warmup-{self._id}", daemon=True)
+        thread.start()
+        return thread
+
     def cursor(self):
         """Get a cursor on the current connection."""
-        if self._reconn and self._auto_reconnect:
-            self._reconnect()
+        if self._pooled:
+            return self._pool_get().cursor()
+        if self._reconn and (self._auto_reconnect or self._conn is None):
+            self._ensure_conn()
         assert self._conn is not None and self._adapter is not None
         self._conn_nstat += 1
+        self._memo.clear()  # may write
         if hasattr(self._adapter, "_cursor"):
             return self._adapter._cursor(self._conn)  # type: ignore
         else:  # pragma: no cover
@@ -391,47 +2465,279 @@ class DB:
 
     def commit(self):
         """Commit database transaction."""
-        assert self._conn is not None
+        if self._pooled:
+            return self._pool_end(DB.commit)
+        self._replicas_end()
+        self._memo.clear()
+        if self._conn is None:  # no connection, no transaction
+            return
         self._conn_ntx += 1
         self._conn_total += self._conn_nstat
         self._conn_nstat = 0
         self._conn.commit()
+        if self._tx_dirty:
+            self._invalidate()
 
     def rollback(self):
         """Rollback database transaction."""
-        assert self._conn is not None
+        if self._pooled:
+            return self._pool_end(DB.rollback)
+        self._replicas_end()
+        self._memo.clear()
+        if self._conn is None:  # no connection, no transaction
+            return
         self._conn_ntx += 1
         self._conn_total += self._conn_nstat
         self._conn_nstat = 0
-        self._conn.rollback()
+        try:
+            self._conn.rollback()
+        finally:
+            # results cached within the transaction may show rolled back writes
+            if self._tx_dirty:
+                self._invalidate()
+
+    def _retryable(self, error: BaseException|None) -> bool:
+        """Tell whether an error, or the database error it wraps, is a transient transaction failure."""
+        seen: set[int] = set()
+        while error is not None and id(error) not in seen:
+            seen.add(id(error))
+            if isinstance(error, self._db_error):
+                if _sqlstate(error) in _RETRY_SQLSTATES:
+                    return True
+                if error.args and error.args[0] in _RETRY_MYSQL_CODES:
+                    return True
+                message = _RETRY_MESSAGES.get(self._db)
+                return bool(message and message.search(str(error)))
+            # possibly mapped by the exception hook
+            error = error.__cause__ or error.__context__
+        return False
+
+    def _tx_retry(self, error: BaseException, attempt: int, retries: int, backoff: float,
+                  max_backoff: float) -> float|None:
+        """Account for a failed transaction attempt, and return the delay before its replay, if any."""
+        if not self._retryable(error):
+            return None
+        query = getattr(self._tx_local, "failed", None) or "transaction"
+        if attempt >= retries:
+            self._tx_exhausted += 1
+            self._log_warning(f"transaction failed on {query} after {attempt} retries: {error}")
+            return None
+        self._tx_retries[query] = self._tx_retries.get(query, 0) + 1
+        delay = min(max_backoff, backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        self._log_info(f"replaying transaction after {query} failed: {error} (#{attempt + 1}, {delay:.3f}s)")
+        return delay
+
+    def transaction(self, retries: int|None = None, backoff: float|None = None,
+                    max_backoff: float|None = None) -> Transaction:
+        """Transaction scope, committed on success and rolled back on errors.
+
+        - :param retries: how many times to replay on transient errors, default is *3*.
+        - :param backoff: first replay delay in seconds, doubled on each retry, default is *0.01*.
+        - :param max_backoff: maximum replay delay in seconds, default is *1.0*.
+
+        Python cannot replay a ``with`` block, so that replays require iterating on attempts,
+        and replay options given to a plain ``with`` scope are rejected:
+
+            for attempt in db.transaction(retries=5):
+                with attempt:
+                    ...
+
+        Reads within the scope are pinned to the primary even with replicas.
+
+        Serialization failures and deadlocks are detected from SQLSTATE
+        *40001* and *40P01*, MySQL errors *1213* and *1205*, and locking
+        or conflict messages with SQLite and DuckDB.
+        Delays are randomly reduced by up to half to avoid replaying in sync.
+        """
+        return Transaction(self, retries, backoff, max_backoff)
+
+    def run_in_transaction(self, fn: Callable, *args, retries: int = 3, backoff: float = 0.01,
+                           max_backoff: float = 1.0, **kwargs) -> Any:
+        """Run a function in a transaction, replaying it on transient errors, see ``transaction``."""
+        res = None
+        for attempt in self.transaction(retries, backoff, max_backoff):
+            with attempt:
+                res = fn(*args, **kwargs)
+        return res
+
+    def _pool_end(self, end: Callable):
+        """End the current thread transaction and release its pooled connection."""
+        cx = getattr(self._pool_local, "cx", None)
+        if cx is None:  # no connection, no transaction
+            return
+        try:
+            end(cx)
+        finally:
+            self._pool_put()
 
     def close(self):
         """Close underlying database connection if needed."""
+        if self._keepalive_thread is not None:
+            self._keepalive_stop.set()
+            if self._keepalive_thread is not threading.current_thread():
+                self._keepalive_thread.join()
+            self._keepalive_thread = None
+        if self._pooled:
+            # release current thread connection, then close idle ones
+            cx = getattr(self._pool_local, "cx", None)
+            if cx is not None:
+                cx._close_quietly()
+                self._pool_put()
+            with self._pool_cond:
+                for cx in self._pool_idle:
+                    cx._close_quietly()
+            return
+        for cx in self._replicas:
+            cx._close_quietly()
         if self._conn is not None:
             # NOTE only reset if close succeeded?
             self._conn.close()
             self._conn = None
+            self._memo.clear()
             # should we try to reconnect?
             self._reconn = self._auto_reconnect
 
+    def _conn_stats(self):
+        """Generate statistics about the current connection."""
+        return {
+            # current connection status
+            "nstat": self._conn_nstat,
+            "total": self._conn_total,
+            "ntx": self._conn_ntx,
+            "last": self._conn_last.isoformat() if self._conn_last else None,
+            # (re)connection attempt status
+            "attempts": self._conn_attempts,
+            "failures": self._conn_failures,
+            "delay": self._conn_delay,
+            "last-fail": self._conn_last_fail.isoformat() if self._conn_last_fail else None,
+            "prepared": len(self._prepared),
+        }
+
+    def _pool_stats(self):
+        """Generate statistics about the connection pool."""
+        with self._pool_cond:
+            holders = list(self._pool_all)
+            idle = len(self._pool_idle)
+        return {
+            "size": self._pool_size,
+            "max": self._pool_max,
+            "open": len(holders),
+            "idle": idle,
+            "busy": len(holders) - idle,
+            "waits": self._pool_waits,
+            "conns": [
+                {"id": cx._id, "conn": cx._conn_stats(), "total": cx._total, "ntx": cx._ntx, "count": cx._conn_count}
+                for cx in holders
+            ],
+        }
+
+    def _bulk_fn(self, query: str) -> tuple[Callable, bool]:
+        """Get query function for bulk execution, and whether it is a many operation."""
+        if query not in self._available_queries:
+            raise AnoDBException(f"unknown query for bulk execution: {query}")
+        fn = getattr(self, query)
+        operation = fn.operation
+        if operation not in (Ops.INSERT_UPDATE_DELETE_MANY, Ops.INSERT_UPDATE_DELETE, Ops.INSERT_RETURNING):
+            raise AnoDBException(f"unexpected operation for bulk execution: {query} ({operation})")
+        return fn, operation == Ops.INSERT_UPDATE_DELETE_MANY
+
+    def bulk(
+        self,
+        query: str,
+        rows: Iterable,
+        chunk_size: int = 1000,
+        commit_every: int = 1,
+        progress: Callable[[dict[str, Any]], None]|None = None,
+    ) -> dict[str, Any]:
+        """Stream rows into a query by chunks, committing periodically.
+
+        - :param query: name of a ``*!`` query, or of a ``!`` or ``<!`` query called once per row.
+        - :param rows: iterable of parameters, dicts or tuples.
+        - :param chunk_size: number of rows per chunk, default is *1000*.
+        - :param commit_every: commit after this many chunks, *0* for never, default is *1*.
+        - :param progress: function called with current statistics after each commit.
+
+        On errors, only the uncommitted chunks are rolled back if ``auto_rollback`` is set.
+        Return statistics about the load.
+        """
+        load = _BulkLoad(self, query, rows, chunk_size, commit_every, progress)
+        for chunk in load.chunks():
+            try:
+                for args, kwargs in load.calls(chunk):
+                    load.fn(*args, **kwargs)
+            except BaseException:
+                load.failed()
+                raise
+            if load.done(chunk):
+                self.commit()
+                load.update(True)
+        commit = load.last()
+        if commit is not None:
+            if commit:
+                self.commit()
+            load.update(commit)
+        return load.finish()
+
+    def stream(self, query: str, fetch: int|None = None) -> Callable:
+        """Get a streaming variant of a plain ``SELECT`` query.
+
+        - :param query: name of the query.
+        - :param fetch: number of rows per batch, default is ``stream_fetch``.
+
+        The returned function takes the query parameters and returns a generator
+        which only holds one batch of rows at a time.
+        """
+        f = self._select_fn(query, "stream")
+        return self._wrap_fn(query, self._stream_fn(query, f, fetch or self._stream_fetch))
+
+    def columnar(self, query: str, format: str = "numpy", fetch: int|None = None) -> Callable:
+        """Get a columnar variant of a plain ``SELECT`` query.
+
+        - :param query: name of the query.
+        - :param format: result format, ``"numpy"`` for a dict of arrays,
+          ``"arrow"`` for a table, or ``"lists"`` for a dict of lists.
+        - :param fetch: number of rows per batch, default is ``stream_fetch``.
+
+        The returned function takes the query parameters and returns the columns.
+        """
+        f = self._select_fn(query, "columnar")
+        return self._wrap_fn(query, self._columnar_fn(query, f, format, fetch or self._stream_fetch))
+
+    def _select_fn(self, query: str, what: str) -> Callable:
+        """Get the underlying function of a plain ``SELECT`` query."""
+        if query in self._lazy:
+            self._load_query(query)
+        f = self._query_fns.get(query)
+        if f is None or query.endswith("_cursor"):
+            raise AnoDBException(f"unknown query for {what}: {query}")
+        if f.operation != Ops.SELECT:  # type: ignore
+            raise AnoDBException(f"cannot {what} non select query: {query} ({f.operation})")  # type: ignore
+        return f
+
+    def _totals(self) -> dict[str, Any]:
+        """Aggregate connection counters, including pooled connections."""
+        holders = [self] + list(self._pool_all) + list(self._replicas)
+        return {
+            "connections": sum(cx._conn_count for cx in holders),
+            "attempts": sum(cx._conn_attempts for cx in holders),
+            "failures": sum(cx._conn_failures for cx in holders),
+            "delay": max(cx._conn_delay or 0.0 for cx in holders),
+            "transactions": sum(cx._ntx + cx._conn_ntx for cx in holders),
+            "executions": sum(cx._total + cx._conn_total + cx._conn_nstat for cx in holders),
+        }
+
+    def openmetrics(self) -> str:
+        """Render statistics in OpenMetrics text format."""
+        return openmetrics([self])
+
     def _stats(self):
         """Generate a JSON-compatible structure for statistics."""
-        return {
+        stats = {
             "id": self._id,
+            "pid": self._pid,
             "driver": self._db,
             "info": self._conn_args,  # _conn_kwargs?
-            "conn": {
-                # current connection status
-                "nstat": self._conn_nstat,
-                "total": self._conn_total,
-                "ntx": self._conn_ntx,
-                "last": self._conn_last.isoformat() if self._conn_last else None,
-                # (re)connection attempt status
-                "attempts": self._conn_attempts,
-                "failures": self._conn_failures,
-                "delay": self._conn_delay,
-                "last-fail": self._conn_last_fail.isoformat() if self._conn_last_fail else None,
-            },
+            "conn": self._conn_stats(),
             # life time
             "total": self._total,
             "ntx": self._ntx,
@@ -439,10 +2745,466 @@ class DB:
             "count": self._conn_count,
             "lasts": list(self._calls),
         }
+        if self._pooled:
+            stats["pool"] = self._pool_stats()
+        if self._replicas:
+            stats["replicas"] = self._replicas_stats()
+        if self._timing:
+            stats["latency"] = {q: h.stats() for q, h in self._latency.items() if h.count}
+        if self._slow_threshold is not None:
+            stats["slow"] = list(self._slow)
+        if self._breaker is not None:
+            stats["breaker"] = self._breaker.stats()
+        if self._tx_memo:
+            stats["memo"] = {"hits": self._memo_hits}
+        if self._tx_count:
+            stats["transactions"] = {
+                "count": self._tx_count,
+                "retries": self._tx_retries,
+                "exhausted": self._tx_exhausted,
+            }
+        if self._idle_check:
+            stats["health"] = dict(self._health)
+        if self._query_cache:
+            stats["query_cache"] = {"hits": self._query_cache_hits, "misses": self._query_cache_misses}
+        if self._prepare_threshold is not None:
+            stats["prepared"] = {
+                "threshold": self._prepare_threshold,
+                "prepares": self._prepares,
+                "hits": self._prepared_hits,
+            }
+        if self._caches:
+            stats["caches"] = {q: f.cache_info() for q, f in self._caches.items() if hasattr(f, "cache_info")}  # type: ignore
+            stats["invalidations"] = self._invalidated
+        return stats
 
     def __str__(self):
         return json.dumps(self._stats())
 
     def __del__(self):
+        if "_keepalive_stop" in self.__dict__:
+            self._keepalive_stop.set()
         if hasattr(self, "_conn") and self._conn:
             self.close()
+        for cx in self.__dict__.get("_pool_all", []) + self.__dict__.get("_replicas", []):
+            cx._close_quietly()
+
+
+#
+# AsyncDB (Asynchronous Database) class
+#
+class AsyncDB(DB):
+    """
+    Asynchronous variant of the DB class, for aiosql async adapters.
+
+    Query methods, ``connect``, ``cursor``, ``commit``, ``rollback`` and
+    ``close`` must be awaited, but plain ``SELECT`` queries which are
+    async generators and ``*_cursor`` queries which are async context managers.
+
+    The connection is created on the first use, or on ``await db.connect()``.
+    Reconnection throttling relies on ``asyncio.sleep``.
+
+    Constructor parameters are the same as for ``DB``, with drivers
+    ``aiosqlite``, ``asyncpg`` or ``apsycopg`` (psycopg async connections),
+    but for the pool mode, replicas, ``pre_ping`` and ``prepare_threshold``
+    which are not supported, as are pipelines, streaming, columnar results
+    and transaction scopes.
+    If provided, the ``cacher`` must handle coroutine functions.
+    """
+
+    # no sync driver aliases
+    SQLITE = ()
+    POSTGRES = ()
+
+    def _set_db_pkg(self):
+        """Load async database package."""
+        if not getattr(sql.aiosql._ADAPTERS[self._db], "is_aio_driver", False):
+            raise AnoDBException(f"not an async driver: {self._db}")
+        package = "psycopg" if self._db == "apsycopg" else self._db
+        try:
+            self._db_pkg = importlib.import_module(package)
+        except ImportError:  # pragma: no cover
+            self._log_error(f"cannot import {package} for {self._db}")
+            raise
+        try:
+            self._db_version = pkg_version(package)
+        except Exception:  # pragma: no cover
+            self._db_version = "<unknown>"
+        if hasattr(self._db_pkg, "Error"):
+            self._db_error = self._db_pkg.Error
+        elif self._db == "asyncpg":  # pragma: no cover
+            self._db_error = (self._db_pkg.PostgresError, self._db_pkg.InterfaceError)
+        else:  # pragma: no cover
+            self._log_error(f"missing Error class in {package}, falling back to Exception")
+            self._db_error = Exception
+
+    def _open(self):
+        """Delay connection to first use, as it must be awaited."""
+        if self._pooled:
+            raise AnoDBException("pool mode is not supported with AsyncDB")
+        if self._replica_conf:
+            raise AnoDBException("replicas are not supported with AsyncDB")
+        if self._pre_ping is not None:
+            raise AnoDBException("pre_ping is not supported with AsyncDB")
+        if self._prepare_threshold is not None:
+            raise AnoDBException("prepare_threshold is not supported with AsyncDB")
+        self._conn_alock = asyncio.Lock()  # serialize deferred connections
+        self._reconn = True
+
+    def _possibly_reconnect(self):
+        """Detect a connection error for apsycopg and asyncpg."""
+        self._reconn = self._auto_reconnect and self._conn is not None and (
+            (self._db == "apsycopg" and self._conn.closed) or         # type: ignore
+            (self._db == "asyncpg" and self._conn.is_closed()))       # type: ignore
+
+    async def __connect(self):
+        """Create an async database connection (internal)."""
+        self._log_info(f"{self._db}: connecting")
+        connect = self._db_pkg.AsyncConnection.connect if self._db == "apsycopg" else self._db_pkg.connect
+        return await connect(*self._conn_args, **self._conn_kwargs)
+
+    async def _do_connect(self):  # type: ignore
+        """Create a connection, possibly with active asynchronous throttling."""
+        self._conn = None
+        try:
+            wait = self._connect_wait()
+            if wait > 0.0:
+                await asyncio.sleep(wait)
+            self._conn = await self.__connect()
+            self._connect_success()
+        except self._db_error as e:
+            self._connect_failure(e)
+            raise e
+
+    async def _reconnect(self):  # type: ignore
+        """Try to reconnect to database, possibly with some cleanup."""
+        self._log_info(f"{self._db}: reconnecting")
+        if self._conn:
+            try:
+                await self._conn.close()
+            except self._db_error as error:  # pragma: no cover
+                self._log_error(f"DB {self._db} close: {error}")
+        await self._do_connect()
+        self._reconn = False
+
+    async def _pre_call(self, _query, args, kwargs):
+        """Bookkeeping before calling a query."""
+        _ = self._debug and self._log_debug(f"{_query}({args}, {kwargs})")
+        if self._reconn:
+            await self._ensure_conn()
+        self._conn_nstat += 1
+        self._count[_query] += 1
+        if self._last_calls:
+            self._calls.append(_query)
+
+    async def _on_error(self, _query, error):
+        """Cleanup on query errors and return the exception to raise."""
+        self._log_info(f"query {_query} failed: {error}")
+        self._tx_local.failed = _query
+        self._memo.clear()
+        if self._auto_rollback and self._conn and hasattr(self._conn, "rollback"):
+            try:
+                await self._conn.rollback()
+            except self._db_error as rolerr:  # pragma: no cover
+                self._log_warning(f"rollback failed: {rolerr}")
+        self._possibly_reconnect()
+        return self._exception(error) if self._exception else error
+
+    async def _call_fn(self, _query, _fn, *args, **kwargs):
+        """Forward method call to aiosql async query."""
+        await self._pre_call(_query, args, kwargs)
+        start = time.perf_counter()
+        try:
+            return await _fn(self._conn, *args, **kwargs)
+        except self._db_error as error:
+            raise await self._on_error(_query, error)
+        finally:
+            if self._measure:
+                self._record(_query, time.perf_counter() - start, self, args, kwargs)
+
+    async def _call_gen(self, _query, _fn, *args, **kwargs):
+        """Forward method call to aiosql async generator query."""
+        await self._pre_call(_query, args, kwargs)
+        elapsed, agen = 0.0, _fn(self._conn, *args, **kwargs)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    row = await agen.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield row
+        except self._db_error as error:
+            raise await self._on_error(_query, error)
+        finally:
+            await agen.aclose()
+            if self._measure:
+                self._record(_query, elapsed, self, args, kwargs)
+
+    @contextlib.asynccontextmanager
+    async def _call_ctx(self, _query, _fn, *args, **kwargs):
+        """Forward method call to aiosql async cursor query."""
+        await self._pre_call(_query, args, kwargs)
+        async with _fn(self._conn, *args, **kwargs) as cur:
+            yield cur
+
+    def _wrap_fn(self, q: str, f: Callable) -> Callable:
+        """Wrap one async query depending on its kind."""
+        if q.endswith("_cursor") and f.operation == Ops.SELECT:  # type: ignore
+            def ctx_fn(*a, **kw):
+                return self._call_ctx(q, f, *a, **kw)
+            return ft.wraps(f)(ctx_fn)
+        elif f.operation == Ops.SELECT:  # type: ignore
+            def gen_fn(*a, **kw):
+                return self._call_gen(q, f, *a, **kw)
+            return ft.wraps(f)(gen_fn)
+        else:
+            async def fn(*a, **kw):
+                return await self._call_fn(q, f, *a, **kw)
+            return ft.wraps(f)(fn)
+
+    def _materialize(self, fn: Callable) -> Callable:
+        """Wrap an async generator function so that it returns a list."""
+        @ft.wraps(fn)
+        async def fx(*a, **kw):
+            return [row async for row in fn(*a, **kw)]
+        return fx
+
+    def _stream_fn(self, q: str, f: Callable, fetch: int) -> Callable:
+        """Asynchronous selects already iterate on their cursor, keep them as is."""
+        self._log_info(f"ignoring streaming for async query {q}")
+        return f
+
+    def transaction(self, retries: int|None = None, backoff: float|None = None,
+                    max_backoff: float|None = None) -> Transaction:
+        """Transaction scopes are not available with asynchronous drivers, see ``run_in_transaction``."""
+        raise AnoDBException(f"transaction scopes are not supported by async driver {self._db}")
+
+    async def run_in_transaction(self, fn: Callable, *args, retries: int = 3, backoff: float = 0.01,  # type: ignore
+                                 max_backoff: float = 1.0, **kwargs) -> Any:
+        """Await a coroutine function in a transaction, replaying it on transient errors."""
+        self._tx_count += 1
+        attempt = 0
+        while True:
+            self._tx_local.failed = None
+            try:
+                res = await fn(*args, **kwargs)
+                self._tx_local.failed = "commit"
+                await self.commit()
+                return res
+            except BaseException as error:
+                try:
+                    await self.rollback()
+                except self._db_error as e:  # pragma: no cover
+                    self._log_warning(f"rollback failed: {e}")
+                delay = self._tx_retry(error, attempt, retries, backoff, max_backoff)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def pipeline(self):  # type: ignore
+        """Pipeline mode is not available with asynchronous drivers."""
+        raise AnoDBException(f"pipeline mode is not supported by async driver {self._db}")
+
+    def stream(self, query: str, fetch: int|None = None) -> Callable:
+        """Streaming is not available with asynchronous drivers."""
+        raise AnoDBException(f"streaming is not supported by async driver {self._db}: {query}")
+
+    def _columnar_fn(self, q: str, f: Callable, fmt: str, fetch: int) -> Callable:
+        """Columnar results are not available with asynchronous drivers, keep rows."""
+        self._log_info(f"ignoring columnar mode for async query {q}")
+        return f
+
+    def columnar(self, query: str, format: str = "numpy", fetch: int|None = None) -> Callable:
+        """Columnar results are not available with asynchronous drivers."""
+        raise AnoDBException(f"columnar mode is not supported by async driver {self._db}: {query}")
+
+    async def bulk(  # type: ignore
+        self,
+        query: str,
+        rows: Iterable,
+        chunk_size: int = 1000,
+        commit_every: int = 1,
+        progress: Callable[[dict[str, Any]], None]|None = None,
+    ) -> dict[str, Any]:
+        """Stream rows into a query by chunks, committing periodically, see ``DB.bulk``."""
+        load = _BulkLoad(self, query, rows, chunk_size, commit_every, progress)
+        for chunk in load.chunks():
+            try:
+                for args, kwargs in load.calls(chunk):
+                    await load.fn(*args, **kwargs)
+            except BaseException:
+                load.failed()
+                raise
+            if load.done(chunk):
+                await self.commit()
+                load.update(True)
+        commit = load.last()
+        if commit is not None:
+            if commit:
+                await self.commit()
+            load.update(commit)
+        return load.finish()
+
+    async def _ensure_conn(self):  # type: ignore
+        """(Re)connect if needed, once for concurrent callers such as ``warmup``."""
+        async with self._conn_alock:
+            if self._conn is None or self._reconn:
+                await self._reconnect()
+
+    async def connect(self):
+        """Create (if needed) and return the database connection."""
+        if not self._conn or self._reconn:
+            await self._ensure_conn()
+        return self._conn
+
+    def warmup(self) -> asyncio.Task:  # type: ignore
+        """Open the connection in a background task, and return the task.
+
+        Failures are logged, the connection is attempted again on first use.
+        """
+        async def warm():
+            try:
+                await self._ensure_conn()
+            except self._db_error as error:
+                self._log_warning(f"warmup failed: {error}")
+
+        return asyncio.ensure_future(warm())
+
+    async def cursor(self):
+        """Get a cursor on the current connection."""
+        await self.connect()
+        self._conn_nstat += 1
+        self._memo.clear()  # may write
+        cur = self._conn.cursor()  # type: ignore
+        return await cur if inspect.isawaitable(cur) else cur
+
+    async def _end_tx(self, method: str):
+        """End current transaction, if the driver has such a method."""
+        self._memo.clear()
+        if self._conn is None:  # no connection, no transaction
+            return
+        self._conn_ntx += 1
+        self._conn_total += self._conn_nstat
+        self._conn_nstat = 0
+        try:
+            # asyncpg runs in autocommit mode outside of explicit transactions
+            if hasattr(self._conn, method):
+                await getattr(self._conn, method)()
+        finally:
+            # also on rollback, as results cached within the transaction may show its writes
+            if self._tx_dirty:
+                self._invalidate()
+
+    async def commit(self):  # type: ignore
+        """Commit database transaction."""
+        await self._end_tx("commit")
+
+    async def rollback(self):  # type: ignore
+        """Rollback database transaction."""
+        await self._end_tx("rollback")
+
+    async def close(self):  # type: ignore
+        """Close underlying database connection if needed."""
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+            self._memo.clear()
+            self._reconn = self._auto_reconnect
+
+    def __del__(self):
+        # closing cannot be awaited here
+        if self.__dict__.get("_conn"):
+            self._log_warning("AsyncDB object deleted without being closed")
+
+
+#
+# OpenMetrics exporter
+#
+_METRICS: dict[str, tuple[str, str]] = {
+    "anodb_connections": ("counter", "Number of successful database connections."),
+    "anodb_connection_attempts": ("gauge", "Number of current consecutive connection attempts."),
+    "anodb_connection_failures": ("counter", "Number of failed connection attempts."),
+    "anodb_connection_delay_seconds": ("gauge", "Current reconnection backoff delay."),
+    "anodb_transactions": ("counter", "Number of transactions, i.e. commits and rollbacks."),
+    "anodb_executions": ("counter", "Number of query and cursor executions."),
+    "anodb_pool_connections": ("gauge", "Number of pooled connections per state."),
+    "anodb_query_calls": ("counter", "Number of calls per query."),
+    "anodb_query_latency_seconds": ("histogram", "Query latency."),
+}
+
+_METRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _label(val: Any) -> str:
+    """Escape an OpenMetrics label value."""
+    return str(val).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def openmetrics(dbs=None) -> str:
+    """Render statistics of DB objects in OpenMetrics text format.
+
+    - :param dbs: DB objects to render, default is all live objects.
+    """
+    samples: dict[str, list[str]] = {name: [] for name in _METRICS}
+    for db in sorted(_DATABASES if dbs is None else dbs, key=lambda db: db._id):
+        labels = f'db="{db._id}",driver="{_label(db._db)}"'
+        totals = db._totals()
+        samples["anodb_connections"].append(f"anodb_connections_total{{{labels}}} {totals['connections']}")
+        samples["anodb_connection_attempts"].append(f"anodb_connection_attempts{{{labels}}} {totals['attempts']}")
+        samples["anodb_connection_failures"].append(f"anodb_connection_failures_total{{{labels}}} {totals['failures']}")
+        samples["anodb_connection_delay_seconds"].append(f"anodb_connection_delay_seconds{{{labels}}} {totals['delay']}")
+        samples["anodb_transactions"].append(f"anodb_transactions_total{{{labels}}} {totals['transactions']}")
+        samples["anodb_executions"].append(f"anodb_executions_total{{{labels}}} {totals['executions']}")
+        if db._pooled:
+            with db._pool_cond:
+                idle, busy = len(db._pool_idle), len(db._pool_all) - len(db._pool_idle)
+            samples["anodb_pool_connections"].append(f'anodb_pool_connections{{{labels},state="idle"}} {idle}')
+            samples["anodb_pool_connections"].append(f'anodb_pool_connections{{{labels},state="busy"}} {busy}')
+        calls, latency = samples["anodb_query_calls"], samples["anodb_query_latency_seconds"]
+        for q, n in list(db._count.items()):
+            qlabels = f'{labels},query="{_label(q)}"'
+            calls.append(f"anodb_query_calls_total{{{qlabels}}} {n}")
+            hist = db._latency.get(q)
+            if hist is None or not hist.count:
+                continue
+            with hist._lock:
+                hist._fold()
+                buckets, count, total = list(hist.buckets), hist._count, hist.sum
+            cumul = 0
+            for bound, n in zip(hist.bounds, buckets):
+                cumul += n
+                latency.append(f'anodb_query_latency_seconds_bucket{{{qlabels},le="{bound}"}} {cumul}')
+            latency.append(f'anodb_query_latency_seconds_bucket{{{qlabels},le="+Inf"}} {count}')
+            latency.append(f"anodb_query_latency_seconds_count{{{qlabels}}} {count}")
+            latency.append(f"anodb_query_latency_seconds_sum{{{qlabels}}} {total}")
+    lines = []
+    for name, (kind, help) in _METRICS.items():
+        if samples[name]:
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"# HELP {name} {help}")
+            lines.extend(samples[name])
+    lines.append("# EOF\n")
+    return "\n".join(lines)
+
+
+def metrics_wsgi(environ, start_response):
+    """WSGI application serving OpenMetrics statistics for all DB objects."""
+    body = openmetrics().encode("utf-8")
+    start_response("200 OK", [("Content-Type", _METRICS_CONTENT_TYPE), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+async def metrics_asgi(scope, receive, send):
+    """ASGI application serving OpenMetrics statistics for all DB objects."""
+    assert scope["type"] == "http"
+    body = openmetrics().encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", _METRICS_CONTENT_TYPE.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,239 @@
+#! /usr/bin/env python
+#
+# Benchmark anodb overhead against raw aiosql and DB-API calls.
+#
+# Usage: python bench_anodb.py [--drivers sqlite3,duckdb] [--sizes 1,100,10000] …
+#
+
+import sys
+import time
+import json
+import argparse
+import tempfile
+import statistics
+import importlib
+import logging
+from pathlib import Path
+
+import aiosql
+import anodb
+
+log = logging.getLogger("bench")
+
+BENCH_SQL = """
+-- name: create-bench#
+CREATE TABLE Bench(pk INTEGER PRIMARY KEY, val TEXT NOT NULL);
+CREATE TABLE Load(pk INTEGER, val TEXT);
+
+-- name: get-row(pk)^
+SELECT pk, val FROM Bench WHERE pk = :pk;
+
+-- name: get-row-cached(pk)^
+-- CACHED
+SELECT pk, val FROM Bench WHERE pk = :pk;
+
+-- name: get-val(pk)$
+SELECT val FROM Bench WHERE pk = :pk;
+
+-- name: get-val-cached(pk)$
+-- CACHED
+SELECT val FROM Bench WHERE pk = :pk;
+
+-- name: set-val(pk, val)!
+UPDATE Bench SET val = :val WHERE pk = :pk;
+
+-- name: load-rows*!
+INSERT INTO Load(pk, val) VALUES (:pk, :val);
+
+-- name: get-rows(n)
+SELECT pk, val FROM Bench WHERE pk < :n ORDER BY pk;
+
+-- name: get-rows-cached(n)
+-- CACHED
+SELECT pk, val FROM Bench WHERE pk < :n ORDER BY pk;
+"""
+
+# operation, query name, parameters for a result size, raw DB-API consumption
+OPERATIONS = {
+    "^": ("get_row", lambda n: {"pk": n // 2}, "fetchone"),
+    "$": ("get_val", lambda n: {"pk": n // 2}, "fetchone"),
+    "!": ("set_val", lambda n: {"pk": n // 2, "val": "bla"}, None),
+    "*!": ("load_rows", lambda n: [{"pk": i, "val": "bla"} for i in range(n)], "many"),
+    "": ("get_rows", lambda n: {"n": n}, "fetchall"),
+}
+
+DRIVERS = ("sqlite3", "duckdb")
+SIZES = (1, 100, 10000)
+
+
+def timeit(fun, rounds: int, repeat: int = 5) -> float:
+    """Return the median time per call of fun in seconds."""
+    fun()  # warm-up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            fun()
+        times.append((time.perf_counter() - start) / rounds)
+    return statistics.median(times)
+
+
+def connect(driver: str):
+    """Open an in-memory connection with the raw driver."""
+    return importlib.import_module(driver).connect(":memory:")
+
+
+def setup(driver: str, size: int, **options) -> anodb.DB:
+    """Create an anodb object on a populated in-memory database."""
+    db = anodb.DB(driver, ":memory:", [], **options)
+    db.add_queries_from_str(BENCH_SQL)
+    db.create_bench()
+    db.load_rows([{"pk": i, "val": str(i)} for i in range(size)])
+    cur = db.cursor()
+    cur.execute("INSERT INTO Bench(pk, val) SELECT pk, val FROM Load")
+    cur.execute("DELETE FROM Load")
+    cur.close()
+    db.commit()
+    return db
+
+
+def bench_calls(driver: str, sizes: list[int], rounds: int) -> list[dict]:
+    """Measure per-call time of each operation with each caller."""
+    results = []
+    for size in sizes:
+        # setup all variants on the same data, queries are shared for raw calls
+        dbs = {
+            "anodb": setup(driver, size),
+            "anodb-fast": setup(driver, size, timing=False, last_calls=0),
+            "anodb-cached": setup(driver, size, cacher=True),
+        }
+        base = dbs["anodb-fast"]
+        queries, conn = base._queries[0], base._conn
+        for op, (name, params_of, fetch) in OPERATIONS.items():
+            params = params_of(size)
+            aio_fn, sql = getattr(queries, name), getattr(queries, name).sql
+            # raw DB-API
+            def raw():
+                cur = conn.cursor()
+                if fetch == "many":
+                    cur.executemany(sql, params)
+                else:
+                    cur.execute(sql, params)
+                    if fetch == "fetchone":
+                        cur.fetchone()
+                    elif fetch == "fetchall":
+                        cur.fetchall()
+                cur.close()
+
+            def call(fn):
+                if op == "*!":
+                    return lambda: fn(params)
+                elif op == "":
+                    return lambda: list(fn(**params))
+                else:
+                    return lambda: fn(**params)
+
+            # fewer rounds on large results
+            n = max(1, rounds // max(1, size // 100)) if op in ("", "*!") else rounds
+            timings = {
+                "dbapi": timeit(raw, n),
+                "aiosql": timeit(call(lambda *a, **kw: aio_fn(conn, *a, **kw)), n),
+            }
+            for variant, db in dbs.items():
+                fn = getattr(db, name)
+                if variant == "anodb-cached":
+                    if op in ("!", "*!"):
+                        continue
+                    fn = getattr(db, f"{name}_cached")
+                timings[variant] = timeit(call(fn), n)
+            for db in dbs.values():
+                db.commit()
+            results.append({
+                "driver": driver,
+                "op": op or "select",
+                "size": size,
+                "rounds": n,
+                "timings": timings,
+                "overhead": timings["anodb"] - timings["aiosql"],
+                "overhead-fast": timings["anodb-fast"] - timings["aiosql"],
+            })
+        for db in dbs.values():
+            db.close()
+    return results
+
+
+def bench_load(driver: str, nqueries: int) -> dict:
+    """Measure startup and query loading time on a large SQL file."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "large.sql"
+        path.write_text("".join(
+            f"-- name: query-{i}(pk)^\n-- query number {i}\nSELECT {i} AS n, :pk AS pk;\n\n"
+            for i in range(nqueries)))
+        cache = str(Path(tmp) / "cache")
+
+        def load(**options):
+            start = time.perf_counter()
+            db = anodb.DB(driver, ":memory:", str(path), **options)
+            elapsed = time.perf_counter() - start
+            db.close()
+            return elapsed
+
+        start = time.perf_counter()
+        aiosql.from_path(path, driver)
+        timings = {"aiosql": time.perf_counter() - start}
+        timings["anodb"] = load()
+        timings["anodb-lazy"] = load(lazy_queries=True)
+        load(query_cache=cache)  # fill cache
+        timings["anodb-cache"] = load(query_cache=cache)
+        start = time.perf_counter()
+        connect(driver).close()
+        timings["connect"] = time.perf_counter() - start
+    return {"driver": driver, "queries": nqueries, "timings": timings}
+
+
+def run(drivers: list[str] = list(DRIVERS), sizes: list[int] = list(SIZES),
+        rounds: int = 1000, nqueries: int = 1000) -> dict:
+    """Run all benchmarks on available drivers."""
+    report: dict = {"calls": [], "load": []}
+    for driver in drivers:
+        try:
+            importlib.import_module(driver)
+        except ImportError:
+            log.warning(f"skipping unavailable driver {driver}")
+            continue
+        report["calls"].extend(bench_calls(driver, sizes, rounds))
+        report["load"].append(bench_load(driver, nqueries))
+    return report
+
+
+def show(report: dict):
+    """Print a readable summary, timings in microseconds."""
+    print(f"{'driver':8} {'op':7} {'size':>6} {'dbapi':>9} {'aiosql':>9} {'anodb':>9} {'fast':>9} "
+          f"{'cached':>9} {'overhead':>9} {'fast':>9}")
+    for r in report["calls"]:
+        t = {k: f"{v * 1e6:9.2f}" for k, v in r["timings"].items()}
+        print(f"{r['driver']:8} {r['op']:7} {r['size']:6} {t['dbapi']} {t['aiosql']} {t['anodb']} "
+              f"{t['anodb-fast']} {t.get('anodb-cached', ' ' * 9)} "
+              f"{r['overhead'] * 1e6:9.2f} {r['overhead-fast'] * 1e6:9.2f}")
+    for r in report["load"]:
+        t = ", ".join(f"{k}={v * 1e3:.1f}ms" for k, v in r["timings"].items())
+        print(f"{r['driver']:8} load {r['queries']} queries: {t}")
+
+
+def main(args: list[str] = sys.argv[1:]):
+    ap = argparse.ArgumentParser(description="benchmark anodb overhead")
+    ap.add_argument("--drivers", default=",".join(DRIVERS), help="comma-separated drivers")
+    ap.add_argument("--sizes", default=",".join(map(str, SIZES)), help="comma-separated result sizes")
+    ap.add_argument("--rounds", type=int, default=1000, help="calls per measure")
+    ap.add_argument("--queries", type=int, default=1000, help="number of queries for load time")
+    ap.add_argument("--json", action="store_true", help="output raw results as JSON")
+    opts = ap.parse_args(args)
+    report = run(opts.drivers.split(","), [int(s) for s in opts.sizes.split(",")], opts.rounds, opts.queries)
+    if opts.json:
+        print(json.dumps(report, indent=2))
+    else:
+        show(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -24,3 +24,7 @@ SELECT i, i*(i+1)/2, i*(i+1)*(i+2)/6
 -- CACHED should be ignored for a non-select
 CREATE TABLE IF NOT EXISTS should_not_cache_non_select(id INTEGER);
 DROP TABLE IF EXISTS should_not_cache_non_select;
+
+-- name: sq(n)$
+-- CACHED ttl=0.05 maxsize=2
+SELECT :n * :n;
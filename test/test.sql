@@ -22,6 +22,16 @@ SELECT val FROM Foo WHERE pk = :pk;
 -- extract all values from foo
 SELECT pk, val FROM Foo ORDER BY 1;
 
+-- name: select-foo-stream()
+-- extract all values from foo, by small batches
+-- STREAM fetch=1
+SELECT pk, val FROM Foo ORDER BY 1;
+
+-- name: select-foo-columns()
+-- extract all values from foo, by columns
+-- COLUMNAR format=lists
+SELECT pk, val FROM Foo ORDER BY 1;
+
 -- name: update-foo-pk(pk, val)!
 -- update a value in foo
 UPDATE Foo SET val = :val WHERE pk = :pk;
@@ -69,3 +79,7 @@ SELECT * FROM Stuff ORDER BY 1;
 
 -- name: compute-norm(c)$
 SELECT SQRT(:c.real * :c.real + :c.imag * :c.imag);
+
+-- name: insert-foo-many*!
+-- insert many items into foo
+INSERT INTO Foo(pk, val) VALUES (:pk, :val);
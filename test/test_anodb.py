@@ -1,12 +1,16 @@
 import pytest  # type: ignore
 import anodb
 import sqlite3
+import sys
 import re
 from os import environ as ENV
 import logging
 from pathlib import Path
 import shutil
+import types
+import contextlib
 import datetime as dt
+import time
 
 log = logging.getLogger(__name__)
 
@@ -42,6 +46,18 @@ def run_stuff(db: anodb.DB, skip_dot=False):
     # more checks
     assert list(db.count_foo())[0] == 2
     assert re.search(r"two", list(db.select_foo_pk(pk=2))[0][0])
+    # streaming selects
+    assert [row[0] for row in db.select_foo_stream()] == [1, 2]
+    assert list(db.stream("select_foo_pk", fetch=10)(pk=2))[0][0] == "two"
+    assert db.select_foo_columns() == {"pk": [1, 2], "val": ["one", "two"]}
+    db.commit()
+    # pipelined queries
+    with db.pipeline():
+        deleted = db.delete_foo_pk(pk=3)
+        count = db.count_foo()
+        rows = db.select_foo_all()
+    assert deleted.result() == 0 and count.result()[0] == 2 and len(rows.result()) == 2
+    db.commit()
     db.update_foo_pk(pk=2, val="deux")
     db.delete_foo_pk(pk=1)
     db.commit()
@@ -205,6 +221,35 @@ def test_psycopg(pg_dsn):
     run_postgres("psycopg", pg_dsn)
 
 
+PREPARE_SQL = """
+-- name: answer(n)$
+SELECT 42 + :n;
+
+-- name: prepared()
+SELECT statement FROM pg_prepared_statements;
+"""
+
+
+@pytest.mark.skipif(
+    not has_module("pytest_postgresql"), reason="missing pytest_postgresql for test"
+)
+@pytest.mark.skipif(not has_module("psycopg"), reason="missing psycopg for test")
+def test_psycopg_prepare(pg_dsn):
+    db = anodb.DB("psycopg", pg_dsn, prepare_threshold=1)
+    db.add_queries_from_str(PREPARE_SQL)
+    assert db._conn.prepare_threshold is None, "no automatic preparation"
+    assert [db.answer(n=n) for n in range(3)] == [42, 43, 44]
+    assert db._prepares == {"answer": 1} and db._prepared_hits == {"answer": 1}
+    # only the hot query is prepared on the server
+    statements = db.prepared()
+    assert len(statements) == 1 and "42" in statements[0][0]
+    db.close()
+    # the driver own setting is kept
+    db = anodb.DB("psycopg", pg_dsn, prepare_threshold=1, conn_kwargs={"prepare_threshold": 0})
+    assert db._conn.prepare_threshold == 0
+    db.close()
+
+
 @pytest.mark.skipif(
     not has_module("pytest_postgresql"), reason="missing pytest_postgresql for test"
 )
@@ -437,3 +482,1744 @@ def test_cache():
     # expected cache stats
     assert len(cache) == 3, "3 inputs in cache"
     assert cache.hits() > 0.66  # expecting ⅔
+
+
+def test_pool(tmp_path):
+    import threading
+    dbfile = str(tmp_path / "pool.db")
+    db = anodb.DB("sqlite3", dbfile, "test.sql", check_same_thread=False, pool_size=2, pool_max=3)
+    assert db._stats()["pool"]["open"] == 2
+    db.create_foo()
+    db.commit()
+    errors = []
+
+    def worker(i: int):
+        try:
+            for j in range(10):
+                db.insert_foo(pk=100 * i + j, val=f"{i}-{j}")
+                db.commit()
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    assert db.count_foo()[0] == 60
+    db.rollback()
+    stats = db._stats()["pool"]
+    assert stats["open"] <= 3 and stats["idle"] == stats["open"] and stats["busy"] == 0
+    assert db._ntx + sum(c["ntx"] + c["conn"]["ntx"] for c in stats["conns"]) == 62
+    assert db._count["insert_foo"] == 60
+    # error releases the connection
+    try:
+        db.syntax_error(s="oops")
+        pytest.fail("syntax error should fail")
+    except sqlite3.Error:
+        assert db._stats()["pool"]["busy"] == 0
+    try:
+        db.insert_foo(pk=0, val="zero")
+        db.insert_foo(pk=0, val="zero")
+        pytest.fail("duplicate should fail")  # pragma: no cover
+    except sqlite3.Error:
+        assert db._stats()["pool"]["busy"] == 0
+    # cursor and connect bind a connection to the thread
+    cur = db.cursor()
+    cur.execute("SELECT 1")
+    assert db.connect() is not None
+    assert db._stats()["pool"]["busy"] == 1
+    db.commit()
+    db.commit()  # nothing to commit
+    # exhaustion
+    small = anodb.DB("sqlite3", dbfile, "test.sql", check_same_thread=False, pool_max=1, pool_timeout=0.01)
+    assert small._stats()["pool"]["open"] == 0
+    assert small.count_foo()[0] == 60 and small._stats()["pool"]["busy"] == 0, "single read"
+    small.cursor().close()
+
+    def other():
+        try:
+            small.count_foo()
+            errors.append("should have timed out")  # pragma: no cover
+        except anodb.AnoDBException:
+            pass
+
+    t = threading.Thread(target=other)
+    t.start()
+    t.join()
+    assert not errors and small._stats()["pool"]["waits"] == 1
+    small.rollback()
+    # reads outside of transactions give their connection back right away
+    readers = anodb.DB("sqlite3", dbfile, "test.sql", check_same_thread=False, pool_size=1, pool_max=1,
+                       pool_timeout=0.01)
+    counts = []
+
+    def reader():
+        counts.append(readers.count_foo()[0])
+        counts.append(len(readers.select_foo_all()))
+
+    for _ in range(3):
+        t = threading.Thread(target=reader)
+        t.start()
+        t.join()
+    assert counts == [60] * 6 and readers._stats()["pool"]["busy"] == 0
+    assert [cx._conn_nstat for cx in readers._pool_all] == [0], "read transactions ended"
+    # within a transaction, reads stay on the thread connection
+    readers.insert_foo(pk=1000, val="mine")
+    assert readers.count_foo()[0] == 61 and readers._stats()["pool"]["busy"] == 1
+    readers.rollback()
+    # rollback failures of single reads are only logged
+    class BadConn:
+        def rollback(self):
+            raise sqlite3.OperationalError("gone")
+
+        def close(self):
+            pass
+
+    cx = readers._pool_all[0]
+    conn, cx._conn = cx._conn, BadConn()
+    cx._conn_nstat = 1
+    readers._pool_idle.remove(cx)  # checked out for a single read
+    cx._inflight += 1
+    readers._read_end(cx)
+    assert cx._reconn and readers._pool_idle == [cx] and cx._inflight == 0
+    cx._conn = conn
+    readers.close()
+    assert small._stats()["pool"]["open"] == 0, "extra connection closed"
+    # connection failures do not lose pool slots
+    small._db_pkg = ThriceFail()
+    for _ in range(3):
+        try:
+            small.count_foo()
+            pytest.fail("connection should fail")  # pragma: no cover
+        except sqlite3.Error:
+            assert small._stats()["pool"]["idle"] == 1
+    small._CONNECTION_MIN_DELAY = 0.0
+    small._pool_all[0]._conn_delay = None
+    assert small.count_foo()[0] == 60
+    small.close()
+    # dropped connections keep their counters
+    totals = small._totals()
+    assert small._pool_all == [] and totals["connections"] == 3 and totals["failures"] == 3
+    assert f'anodb_connections_total{{db="{small._id}",driver="sqlite3"}} 3\n' in small.openmetrics()
+    transient = anodb.DB("sqlite3", dbfile, "test.sql", check_same_thread=False, pool_size=0, pool_max=2)
+    for _ in range(3):
+        assert transient.count_foo()[0] == 60
+        transient.rollback()
+    totals = transient._totals()
+    assert transient._pool_all == [] and totals["connections"] == 3 and totals["transactions"] == 3
+    transient.close()
+    db.drop_foo()
+    db.close()
+    db.close()
+    assert db._stats()["pool"]["busy"] == 0
+    # connections are reopened on demand
+    assert db.hello_world()[0] == "hello world!"
+    db.__del__()
+    # bad settings
+    try:
+        anodb.DB("sqlite3", dbfile, pool_size=3, pool_max=2)
+        pytest.fail("should reject inconsistent pool settings")
+    except anodb.AnoDBException:
+        assert True, "bad pool settings rejected"
+
+
+class AsyncThriceFail(ThriceFail):
+    """Always fails thrice before connecting, asynchronously."""
+
+    def connect(self, *args, **kwargs):
+        if self._fails < 3:
+            self._fails += 1
+            raise sqlite3.Error(f"connect intentional failure #{self._fails}")
+        else:
+            self._fails = 0
+            import aiosqlite
+            return aiosqlite.connect(*args, **kwargs)
+
+
+@pytest.mark.skipif(not has_module("aiosqlite"), reason="missing aiosqlite for test")
+def test_async():
+    import asyncio
+
+    cache: dict = {}
+
+    def cacher(name, fun):
+        async def cached(*args, **kwargs):
+            key = (name, args, tuple(sorted(kwargs.items())))
+            if key not in cache:
+                cache[key] = await fun(*args, **kwargs)
+            return cache[key]
+        return cached
+
+    async def run():
+        db = anodb.AsyncDB("aiosqlite", ":memory:", [TEST_SQL, "caching.sql"], last_calls=3,
+                           cacher=cacher, exception=MyException)
+        try:
+            await check(db)
+        finally:  # do not leave aiosqlite threads behind
+            await db.close()
+
+    async def check(db):
+        # built-in cacher with async queries
+        adb = anodb.AsyncDB("aiosqlite", ":memory:", "caching.sql", cacher=True)
+        assert await adb.ran() == await adb.ran() and adb._count["ran"] == 1
+        # rollback invalidates results cached within the transaction
+        adb.add_queries_from_str("-- name: mk-t#\nCREATE TABLE T(k INTEGER);\n\n-- name: ins-t(k)!\n"
+                                 "INSERT INTO T(k) VALUES (:k);\n\n-- name: count-t()$\n-- CACHED\nSELECT COUNT(*) FROM T;\n")
+        await adb.mk_t()
+        await adb.commit()
+        await adb.ins_t(k=1)
+        assert await adb.count_t() == 1
+        await adb.rollback()
+        assert adb._tx_dirty == set() and await adb.count_t() == 0
+        calls = []
+
+        async def fun(**kwargs):
+            calls.append(kwargs)
+        fun = anodb.QueryCacher()("fun", fun)
+        await fun(l=[])
+        await fun(l=[])
+        assert len(calls) == 2
+        await adb.close()
+        # background connection, shared with a concurrent first call
+        adb = anodb.AsyncDB("aiosqlite", ":memory:", TEST_SQL)
+        task = adb.warmup()
+        assert (await adb.hello_world())[0] == "hello world!"
+        await task
+        assert adb._conn_count == 1
+        await adb.close()
+        adb._db_pkg = AsyncThriceFail()
+        await adb.warmup()
+        assert adb._conn is None and adb._conn_failures == 1
+        await adb.commit()
+        assert db._conn is None
+        await db.create_foo()
+        assert (await db.count_foo())[0] == 0
+        await db.insert_foo(pk=1, val="one")
+        await db.insert_foo(pk=2, val="two")
+        assert db._tx_dirty == {"foo"}
+        await db.commit()
+        assert db._tx_dirty == set()
+        assert [r async for r in db.select_foo_all()] == [(1, "one"), (2, "two")]
+        assert [r async for r in db.select_foo_stream()] == [(1, "one"), (2, "two")]
+        assert [r async for r in db.select_foo_columns()] == [(1, "one"), (2, "two")]
+        try:
+            db.columnar("select_foo_all")
+            pytest.fail("no async columnar mode")  # pragma: no cover
+        except anodb.AnoDBException as e:
+            assert "not supported" in str(e)
+        try:
+            db.stream("select_foo_all")
+            pytest.fail("no async streaming")  # pragma: no cover
+        except anodb.AnoDBException as e:
+            assert "not supported" in str(e)
+        try:
+            db.pipeline()
+            pytest.fail("no async pipeline")  # pragma: no cover
+        except anodb.AnoDBException as e:
+            assert "not supported" in str(e)
+        async with db.select_foo_all_cursor() as cur:
+            assert len(await cur.fetchall()) == 2
+        assert await db.module(x=3+4j) == 5.0
+        await db.insert_foo(pk=3, val="three")
+        await db.rollback()
+        assert (await db.count_foo())[0] == 2
+        # bulk
+        progress: list[dict] = []
+        stats = await db.bulk("insert_foo_many", ({"pk": i, "val": str(i)} for i in range(10, 35)), chunk_size=10,
+                              commit_every=2, progress=progress.append)
+        assert stats["chunks"] == 3 and stats["committed"] == 25
+        assert [p["committed"] for p in progress] == [20, 25], "partial last chunk committed"
+        stats = await db.bulk("insert_foo", [{"pk": 50, "val": "x"}, {"pk": 51, "val": "y"}], commit_every=0,
+                              progress=lambda s: None)
+        assert stats["rows"] == 2
+        try:
+            await db.bulk("insert_foo", [{"pk": 50, "val": "x"}])
+            pytest.fail("should fail on duplicate")  # pragma: no cover
+        except MyException:
+            pass
+        assert (await db.count_foo())[0] == 27
+        # caching
+        assert await db.ran() == await db.ran()
+        assert await db.gen(n=3) == await db.gen(n=3)
+        assert db._count["ran"] == 1 and db._count["gen"] == 1
+        # errors
+        try:
+            await db.syntax_error(s="2024-12-34")
+            pytest.fail("syntax error should fail")  # pragma: no cover
+        except MyException:
+            assert True, "exception was raised"
+        try:
+            async for _ in db.get_all_stuff():  # no such table
+                pytest.fail("should fail")  # pragma: no cover
+        except MyException:
+            assert True, "exception was raised"
+        # cursor
+        cur = await db.cursor()
+        await cur.execute("SELECT 42")
+        assert (await cur.fetchone())[0] == 42
+        # stats
+        stats = db._stats()
+        assert stats["calls"]["insert_foo"] == 6 and len(stats["lasts"]) == 3
+        assert stats["latency"]["select_foo_all"]["count"] == 1
+        assert stats["conn"]["ntx"] == 4
+        # transaction memo
+        mdb = anodb.AsyncDB("aiosqlite", ":memory:", TEST_SQL, tx_memo=True)
+        await mdb.create_foo()
+        assert await mdb.count_foo() == await mdb.count_foo() == (0,) and mdb._count["count_foo"] == 1
+        await mdb.insert_foo(pk=1, val="one")
+        assert await mdb.count_foo() == (1,) and mdb._count["count_foo"] == 2
+        await mdb.count_foo(), await mdb.rollback()
+        assert await mdb.count_foo() == (0,) and mdb._stats()["memo"]["hits"]["count_foo"] == 2
+        cur = await mdb.cursor()
+        await cur.execute("INSERT INTO Foo(pk, val) VALUES (2, 'two')")
+        assert await mdb.count_foo() == (1,) and mdb._count["count_foo"] == 4
+        nohash = type("NoHash", (), {"__hash__": None, "real": 3, "imag": 4})()
+        assert await mdb.compute_norm(c=nohash) == await mdb.compute_norm(c=nohash) == 5.0
+        assert mdb._count["compute_norm"] == 2
+        try:
+            await mdb.syntax_error(s="2024-12-34")
+            pytest.fail("syntax error should fail")  # pragma: no cover
+        except Exception:
+            assert not mdb._memo
+        await mdb.close()
+        # replayed transactions
+        calls = []
+
+        async def work(adb, pk):
+            calls.append(pk)
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("database is locked")
+            return await adb.insert_foo(pk=pk, val="tx")
+
+        assert await db.run_in_transaction(work, db, 60, backoff=0.001) == 1 and calls == [60, 60]
+        try:
+            await db.run_in_transaction(work, db, 60)
+            pytest.fail("should fail on duplicate")  # pragma: no cover
+        except MyException:
+            pass
+        assert db._stats()["transactions"] == {"count": 2, "retries": {"transaction": 1}, "exhausted": 0}
+        try:
+            db.transaction()
+            pytest.fail("no async transaction scope")  # pragma: no cover
+        except anodb.AnoDBException as e:
+            assert "not supported" in str(e)
+        # reconnection with async delays
+        await db.close()
+        await db.close()
+        db._CONNECTION_MIN_DELAY = 0.01
+        db._db_pkg = AsyncThriceFail()
+        errors = 0
+        for _ in range(4):
+            try:
+                await db.connect()
+            except sqlite3.Error:
+                errors += 1
+        assert errors == 3 and db._conn is not None
+        assert await db.hello_world() == ("hello world!",)
+        db._db_pkg = __import__("aiosqlite")
+        db._reconn = True  # forced reconnection
+        assert await db.hello_world() == ("hello world!",)
+        assert db._stats()["count"] == 3
+        await db.close()
+        del db
+
+    asyncio.run(run())
+    # some unsupported settings
+    try:
+        anodb.AsyncDB("sqlite3", ":memory:")
+        pytest.fail("sqlite3 is not async")
+    except anodb.AnoDBException:
+        assert True, "sync driver rejected"
+    for options in ({"pool_size": 2}, {"pre_ping": 0.0}, {"prepare_threshold": 5}):
+        try:
+            anodb.AsyncDB("aiosqlite", ":memory:", **options)
+            pytest.fail(f"not supported with async: {options}")
+        except anodb.AnoDBException:
+            assert True, "unsupported option rejected"
+    # unclosed object
+    db = anodb.AsyncDB("aiosqlite", ":memory:")
+    db._conn = True
+    db.__del__()
+    db._conn = None
+
+
+def test_query_cacher():
+    import time
+    db = anodb.DB("sqlite3", ":memory:", "caching.sql", cacher=True)
+    assert db.ran() == db.ran()
+    assert db.ran.cache_in() and db._count["ran"] == 1
+    assert db.gen(n=3) == db.gen(n=3) == [(1, 1, 1), (2, 3, 4), (3, 6, 10)]
+    assert db.bad() == "DONE" and "bad" not in db._caches
+    # per-query settings from doc string
+    assert db.sq.cache.stats()["maxsize"] == 2 and db.sq.cache.stats()["ttl"] == 0.05
+    assert db.sq(n=2) == 4 and db.sq(n=3) == 9 and db.sq(n=2) == 4
+    assert db.sq(n=4) == 16  # evicts 3
+    assert not db.sq.cache_in(n=3) and db.sq.cache_in(n=2)
+    assert len(db.sq.cache) == 2
+    time.sleep(0.06)
+    assert db.sq(n=2) == 4  # expired
+    stats = db._stats()["caches"]
+    assert stats["ran"]["hits"] == 1 and stats["ran"]["misses"] == 1
+    assert stats["sq"] == {"size": 2, "maxsize": 2, "ttl": 0.05, "hits": 1,
+                           "misses": 4, "evictions": 1, "expired": 1,
+                           "stale": None, "stale_hits": 0, "coalesced": 0}
+    assert db._count["sq"] == 4
+    db.sq.cache_clear()
+    assert len(db.sq.cache) == 0
+    db.close()
+    # unhashable parameters are not cached
+    calls = []
+    fun = anodb.QueryCacher()("fun", lambda **kw: calls.append(kw))
+    fun(l=[1])
+    fun(l=[1])
+    assert len(calls) == 2 and len(fun.cache) == 0
+    # bad settings
+    for doc in ("CACHED foo=1", "CACHED ttl=soon"):
+        try:
+            anodb.QueryCacher()._settings("q", doc)
+            pytest.fail("should reject bad cache settings")  # pragma: no cover
+        except anodb.AnoDBException:
+            assert True, "bad settings rejected"
+
+
+def test_single_flight():
+    import gc
+    import time
+    import asyncio
+    import threading
+    calls, gate = [], threading.Event()
+
+    def slow(n):
+        calls.append(n)
+        gate.wait(1.0)
+        if n < 0:
+            raise anodb.AnoDBException(f"bad {n}")
+        return n * n
+
+    fun = anodb.QueryCacher(ttl=0.05, stale=10.0)("slow", slow)
+    results, errors = [], []
+    gc.collect()  # so that left over objects are not finalized in threads
+
+    def run(n):
+        try:
+            results.append(fun(n))
+        except anodb.AnoDBException as e:
+            errors.append(e)
+
+    def burst(n, count=5):
+        threads = [threading.Thread(target=run, args=(n,)) for _ in range(count)]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)
+        gate.set()
+        for t in threads:
+            t.join()
+        gate.clear()
+
+    # concurrent misses share one execution
+    burst(3)
+    assert results == [9] * 5 and calls == [3]
+    assert fun.cache.stats()["coalesced"] == 4
+    # errors are shared as well, and not cached
+    burst(-1)
+    assert len(errors) == 5 and calls == [3, -1] and not fun.cache_in(-1)
+    assert len(set(map(id, errors))) == 1
+    # expired entry is served stale to followers while the leader refreshes
+    time.sleep(0.06)
+    results.clear()
+    burst(3)
+    assert results == [9] * 5 and calls == [3, -1, 3]
+    stats = fun.cache.stats()
+    assert stats["stale_hits"] == 4 and stats["coalesced"] == 8 and stats["expired"] == 0
+    # without single flight, each call runs
+    calls.clear()
+    gate.set()
+    nosf = anodb.QueryCacher(single_flight=False)("slow", slow)
+    assert nosf(2) == 4 and nosf(2) == 4 and calls == [2]
+    assert anodb.QueryCacher()._settings("q", "CACHED stale=2.5")["stale"] == 2.5
+
+    # async variant
+    acalls = []
+
+    async def aslow(n):
+        acalls.append(n)
+        await asyncio.sleep(0.02)
+        if n < 0:
+            raise anodb.AnoDBException(f"bad {n}")
+        return n + 1
+
+    async def main():
+        afun = anodb.QueryCacher()("aslow", aslow)
+        assert await asyncio.gather(*(afun(1) for _ in range(4))) == [2] * 4
+        assert acalls == [1] and afun.cache.stats()["coalesced"] == 3
+        res = await asyncio.gather(*(afun(-1) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(e, anodb.AnoDBException) for e in res) and acalls == [1, -1]
+        astale = anodb.QueryCacher(ttl=0.01, stale=10.0)("aslow", aslow)
+        assert await astale(2) == 3
+        await asyncio.sleep(0.02)
+        assert await asyncio.gather(astale(2), astale(2)) == [3, 3]
+        assert astale.cache.stats()["stale_hits"] == 1 and acalls == [1, -1, 2, 2]
+        anosf = anodb.QueryCacher(single_flight=False)("aslow", aslow)
+        assert await anosf(5) == 6 and await anosf(5) == 6 and acalls == [1, -1, 2, 2, 5]
+
+    asyncio.run(main())
+
+
+def test_shared_cache(tmp_path):
+    import os
+    import time
+    import threading
+    path = str(tmp_path / "cache.db")
+    # two "workers" with their own cacher on the same file
+    db1 = anodb.DB("sqlite3", ":memory:", "caching.sql", cacher=anodb.SharedQueryCacher(path))
+    db2 = anodb.DB("sqlite3", ":memory:", "caching.sql", cacher=anodb.SharedQueryCacher(path))
+    ran = db1.ran()
+    assert db2.ran() == ran and db2._count.get("ran", 0) == 0
+    assert db1.gen(n=3) == db2.gen(n=3) == [(1, 1, 1), (2, 3, 4), (3, 6, 10)]
+    assert db2.len(s="abc") == (3, "abc", 1) and db1.ran.cache_in() and not db1.len.cache_in(s="x")
+    # per-query settings, with eviction and expiration
+    assert db1.sq.cache.stats()["maxsize"] == 2 and db1.sq.cache.stats()["ttl"] == 0.05
+    assert db1.sq(n=2) == 4 and db2.sq(n=3) == 9 and db1.sq(n=4) == 16
+    assert len(db2.sq.cache) == 2 and not db2.sq.cache_in(n=2) and db2.sq.cache_in(n=4)
+    assert db1.sq.cache.stats()["evictions"] == 1
+    time.sleep(0.06)
+    assert not db2.sq.cache_in(n=4) and db2.sq(n=4) == 16 and db2.sq.cache.stats()["expired"] == 1
+    stats = db2._stats()["caches"]["ran"]
+    assert stats["hits"] == 1 and stats["misses"] == 0 and stats["size"] == 1
+    assert stats["path"] == path and stats["errors"] == 0
+    # invalidation is shared
+    db1.ran.cache_clear()
+    assert not db2.ran.cache_in() and len(db2.ran.cache) == 0
+    # distinct databases sharing a file use namespaces
+    db3 = anodb.DB("sqlite3", ":memory:", "caching.sql", cacher=anodb.SharedQueryCacher(path, namespace="other"))
+    db4 = anodb.DB("sqlite3", ":memory:", "caching.sql", cacher=anodb.SharedQueryCacher(path, namespace="other"))
+    ran = db1.ran()
+    assert not db3.ran.cache_in() and db3.ran() != ran and db4.ran() == db3.ran() and db2.ran() == ran
+    assert db3.ran.cache.stats()["size"] == 1 and db3.ran.cache._name == "other:ran"
+    db3.ran.cache_clear()
+    assert db1.ran.cache_in() and not db4.ran.cache_in()
+    db3.close()
+    db4.close()
+    # keys are stable between processes, unserializable keys and values are not cached
+    cacher = anodb.SharedQueryCacher(path, ttl=0.01, stale=10.0)
+    assert cacher._key((1, "a"), {"b": None}) == cacher._key((1, "a"), {"b": None})
+    assert cacher._key((1.5j,), {}) != cacher._key((2.5j,), {})
+    calls = []
+    fun = cacher("fun", lambda *a, **kw: calls.append(a) or a[0])
+    lock = threading.Lock()
+    assert fun(lock) is lock and fun(lock) is lock and len(calls) == 2
+    unpicklable = cacher("unpicklable", lambda n: calls.append(n) or lock)
+    assert unpicklable(1) is lock and unpicklable(1) is lock and len(calls) == 4
+    assert unpicklable.cache_info()["errors"] == 2 and fun.cache_info()["errors"] == 0
+    # stale entries
+    assert fun(7) == 7 and fun(7) == 7 and len(calls) == 5
+    time.sleep(0.02)
+    assert fun.cache.get_stale(cacher._key((7,), {})) == (True, 7)
+    assert fun.cache.get_stale(cacher._key((70,), {})) == (False, None)
+    assert fun(7) == 7 and len(calls) == 6
+    # values written by a forked child are visible
+    if hasattr(os, "fork"):
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            try:
+                fun(8)
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        assert fun.cache.get_stale(cacher._key((8,), {})) == (True, 8) and len(calls) == 6
+    # a new process reopens the file
+    conn, cacher._store._pid = cacher._store._conn, -1
+    assert len(fun.cache) >= 1 and cacher._store._conn is not conn and anodb._FORK_ORPHANS[-1] is conn
+    # storage errors are misses
+    cacher.close()
+    bad = anodb.SharedQueryCacher(str(tmp_path / "no" / "such.db"))("fun", lambda n: calls.append(n) or n)
+    assert bad(1) == 1 and bad(1) == 1 and len(calls) == 8 and len(bad.cache) == 0
+    assert bad.cache_info()["errors"] >= 3 and not bad.cache_in(1)
+    (tmp_path / "text.db").write_text("not a database, " * 100)
+    bad = anodb.SharedQueryCacher(str(tmp_path / "text.db"))("fun", lambda n: calls.append(n) or n)
+    assert bad(1) == 1 and bad.cache_info()["errors"] >= 2 and len(calls) == 9
+    # corrupted values are misses
+    cacher = anodb.SharedQueryCacher(path)
+    fun = cacher("fun", lambda n: calls.append(n) or n)
+    assert fun(3) == 3 and fun(3) == 3 and len(calls) == 10
+    cacher._store.execute("UPDATE AnoDBCache SET value = x'00' WHERE name = 'fun'")
+    assert fun(3) == 3 and len(calls) == 11 and fun.cache_info()["errors"] == 1
+    cacher.close()
+    db1.close()
+    db2.close()
+
+
+INVALIDATION_SQL = """
+-- name: create-t#
+CREATE TABLE T(k INTEGER PRIMARY KEY, v TEXT NOT NULL);
+CREATE TABLE Other(k INTEGER PRIMARY KEY);
+
+-- name: ins-t(k, v)!
+INSERT INTO T(k, v) VALUES (:k, :v);
+
+-- name: ins-many-t*!
+INSERT INTO T(k, v) VALUES (:k, :v);
+
+-- name: ins-other(k)!
+INSERT INTO Other(k) VALUES (:k);
+
+-- name: get-t(k)$
+-- CACHED
+SELECT v FROM T WHERE k = :k AND v <> 'FROM Nowhere';
+
+-- name: count-t()$
+-- CACHED
+SELECT COUNT(*) FROM "T" AS x, Other o;
+
+-- name: count-other()$
+-- CACHED
+-- TABLES: other
+SELECT COUNT(*) FROM T, Other;
+
+-- name: len-t()$
+SELECT COUNT(*) FROM T;
+
+-- name: del-main-t()!
+DELETE FROM main.t WHERE k > 1;
+
+-- name: set-version()!
+PRAGMA user_version = 1;
+"""
+
+
+def test_invalidation():
+    db = anodb.DB("sqlite3", ":memory:", cacher=True)
+    db.add_queries_from_str(INVALIDATION_SQL)
+    assert db._table_deps == {"t": {"get_t", "count_t"}, "other": {"count_t", "count_other"}}
+    assert db._query_tables(db.create_t) == {"t", "other"}
+    db.create_t()
+    assert db._tx_dirty == {"t", "other"}
+    db.commit()
+    assert db._tx_dirty == set()
+    assert db.get_t(k=1) is None and db.count_t() == 0 and db.count_other() == 0
+    db.ins_t(k=1, v="one")
+    assert db._tx_dirty == {"t"}
+    assert db.get_t(k=1) is None, "still cached before commit"
+    db.commit()
+    assert db.get_t(k=1) == "one" and db.count_t() == 0
+    assert db.count_other() == 0, "not invalidated as it only depends on other"
+    db.ins_other(k=1)
+    db.commit()
+    assert db.count_t() == 1 and db.count_other() == 1
+    # rollback invalidates results cached after the rolled back writes
+    db.ins_many_t([{"k": 2, "v": "two"}, {"k": 3, "v": "three"}])
+    assert db.len_t() == 3 and db.count_t() == 1 and db.get_t(k=2) == "two", "cached within the transaction"
+    db.rollback()
+    assert db._tx_dirty == set() and db.get_t(k=2) is None and db.count_t() == 1 and db.count_other() == 1
+    assert db._stats()["invalidations"] == {"get_t": 3, "count_t": 4, "count_other": 2}
+    # schema-qualified names match on their last component
+    db.ins_t(k=2, v="two")
+    db.commit()
+    assert db.count_t() == 2
+    db.del_main_t()
+    assert db._tx_dirty == {"t"}
+    db.commit()
+    assert db.count_t() == 1
+    # unknown written tables invalidate all cached queries
+    db.set_version()
+    assert db._tx_dirty == {"*"}
+    db.commit()
+    assert db._stats()["invalidations"] == {"get_t": 6, "count_t": 7, "count_other": 3}
+    # truncate is a write
+    assert db._query_tables(types.SimpleNamespace(sql="TRUNCATE TABLE ONLY public.T, o", __doc__="")) == {"t", "o"}
+    db.close()
+
+
+def test_latency():
+    h = anodb.LatencyHistogram()
+    assert h.stats()["p50"] == 0.0
+    for ms in range(1, 101):
+        h.add(ms / 1000)
+    assert h.quantile(0.5) == 0.05 and h.quantile(0.95) == 0.1 and h.quantile(0.01) == 0.001
+    h.add(20.0)
+    stats = h.stats()
+    assert stats["count"] == 101 and stats["min"] == 0.001 and stats["max"] == 20.0
+    assert stats["p50"] == 0.1 and stats["p95"] == 0.1 and stats["p99"] == 0.1
+    assert h.quantile(1.0) == 20.0
+    assert abs(stats["sum"] - 25.05) < 1e-9
+    # measures are folded in batches
+    for _ in range(h.BATCH):
+        h.add(0.001)
+    assert len(h._pending) == 0 and h._count == 101 + h.BATCH
+    # query latencies
+    db = anodb.DB("sqlite3", ":memory:", "test.sql")
+    db.create_foo()
+    db.insert_foo(pk=1, val="one")
+    assert list(db.select_foo_all()) == [(1, "one")]
+    rows = db.select_foo_all()
+    next(rows)
+    del rows  # interrupted generator
+    try:
+        db.syntax_error(s="")
+        pytest.fail("should raise")  # pragma: no cover
+    except sqlite3.Error:
+        pass
+    latency = db._stats()["latency"]
+    assert sorted(latency.keys()) == ["create_foo", "insert_foo", "select_foo_all", "syntax_error"]
+    assert latency["select_foo_all"]["count"] == 2
+    assert all(0.0 < h["min"] <= h["p50"] <= h["max"] for h in latency.values())
+    assert "latency" in str(db)
+    db.close()
+    db = anodb.DB("sqlite3", ":memory:", "test.sql", timing=False)
+    assert db.hello_world() == ("hello world!",)
+    assert "latency" not in db._stats()
+    db.close()
+
+
+def test_openmetrics():
+    import asyncio
+    db = anodb.DB("sqlite3", ":memory:", "test.sql", pool_size=1)
+    assert db.hello_world() == ("hello world!",)
+    db.commit()
+    text = db.openmetrics()
+    assert text.endswith("# EOF\n")
+    labels = f'db="{db._id}",driver="sqlite3"'
+    assert f"anodb_connections_total{{{labels}}} 1\n" in text
+    assert f"anodb_transactions_total{{{labels}}} 1\n" in text
+    assert f'anodb_pool_connections{{{labels},state="idle"}} 1\n' in text
+    assert f'anodb_query_calls_total{{{labels},query="hello_world"}} 1\n' in text
+    assert f'anodb_query_latency_seconds_bucket{{{labels},query="hello_world",le="+Inf"}} 1\n' in text
+    assert f'anodb_query_latency_seconds_count{{{labels},query="hello_world"}} 1\n' in text
+    assert 'query="count_foo",le=' not in text
+    assert text.count("# TYPE anodb_query_calls counter") == 1
+    # several objects are aggregated in one output
+    db2 = anodb.DB("sqlite3", ":memory:", "test.sql")
+    text = anodb.openmetrics()
+    assert text.count("# TYPE anodb_connections counter") == 1
+    assert f'db="{db._id}"' in text and f'db="{db2._id}"' in text
+    assert anodb._label('a"b\\c\nd') == 'a\\"b\\\\c\\nd'
+    # wsgi
+    started = []
+    body = b"".join(anodb.metrics_wsgi({}, lambda status, headers: started.append((status, headers))))
+    assert started[0][0] == "200 OK" and b"# EOF\n" in body
+    assert ("Content-Type", anodb._METRICS_CONTENT_TYPE) in started[0][1]
+    # asgi
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(anodb.metrics_asgi({"type": "http"}, None, send))
+    assert sent[0]["status"] == 200 and sent[1]["body"].endswith(b"# EOF\n")
+    db.close()
+    db2.close()
+
+
+def test_slow_queries(caplog):
+    assert anodb.redact_params((1, "secret"), {"pwd": "secret", "n": None}) == "(int, str, pwd: str, n: NoneType)"
+    db = anodb.DB("sqlite3", ":memory:", "test.sql", slow_query_threshold=0.0, slow_queries=2, timing=False)
+    db.create_foo()
+    db.insert_foo(pk=1, val="secret")
+    with caplog.at_level(logging.WARNING, logger="anodb"):
+        assert list(db.select_foo_pk(pk=1)) == [("secret",)]
+    assert "slow query select_foo_pk on connection" in caplog.text
+    assert "(pk: int)" in caplog.text and "secret" not in caplog.text
+    stats = db._stats()
+    assert "latency" not in stats
+    assert [s["query"] for s in stats["slow"]] == ["insert_foo", "select_foo_pk"]
+    assert stats["slow"][1]["params"] == "(pk: int)" and stats["slow"][1]["conn"] == db._id
+    db.close()
+    # custom rendering
+    db = anodb.DB("sqlite3", ":memory:", "test.sql", slow_query_threshold=0.0, slow_query_params=lambda a, kw: kw)
+    assert db.module(x=3+4j) == 5.0
+    assert db._stats()["slow"][0]["params"]["x"] == 3+4j
+    db._slow_params = lambda a, kw: 1 / 0
+    db.hello_world()
+    assert "cannot render" in db._stats()["slow"][-1]["params"]
+    db.close()
+    # not slow
+    db = anodb.DB("sqlite3", ":memory:", "test.sql", slow_query_threshold=10.0)
+    db.hello_world()
+    assert db._stats()["slow"] == []
+    db.close()
+
+
+def test_bulk():
+    db = anodb.DB("sqlite3", ":memory:", "test.sql", kwargs_only=False)
+    db.create_foo()
+    db.commit()
+    progress = []
+    rows = ({"pk": i, "val": str(i)} for i in range(2500))
+    stats = db.bulk("insert_foo_many", rows, chunk_size=1000, progress=progress.append)
+    assert stats["rows"] == 2500 and stats["chunks"] == 3 and stats["committed"] == 2500
+    assert [p["committed"] for p in progress] == [1000, 2000, 2500]
+    assert db.count_foo()[0] == 2500 and db._count["insert_foo_many"] == 3
+    # failure on third chunk, first two are kept
+    rows = [{"pk": i, "val": str(i)} for i in range(3000, 5000)] + [{"pk": 0, "val": "dup"}]
+    try:
+        db.bulk("insert_foo_many", rows, chunk_size=800, progress=progress.append)
+        pytest.fail("duplicate should fail")  # pragma: no cover
+    except sqlite3.IntegrityError:
+        assert progress[-1]["committed"] == 1600
+    assert db.count_foo()[0] == 2500 + 1600
+    # one call per row, several chunks per commit
+    progress.clear()
+    stats = db.bulk("insert_foo", [{"pk": i, "val": str(i)} for i in range(10000, 10050)], chunk_size=10,
+                    commit_every=2, progress=progress.append)
+    assert stats["chunks"] == 5 and len(progress) == 3 and db._count["insert_foo"] == 50
+    # no commit
+    stats = db.bulk("insert_foo", [{"pk": 20000, "val": "x"}], commit_every=0)
+    assert stats["committed"] == 0 and stats["rows"] == 1
+    db.rollback()
+    assert db.count_foo()[0] == 2500 + 1600 + 50
+    # bad queries
+    for query in ("no_such_query", "count_foo"):
+        try:
+            db.bulk(query, [])
+            pytest.fail("should reject query")  # pragma: no cover
+        except anodb.AnoDBException:
+            assert True, "query rejected"
+    db.close()
+
+
+def test_stream():
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, stream_fetch=3)
+    assert db._streams == {"select_foo_stream": 1}
+    db.create_foo()
+    db.insert_foo_many([{"pk": i, "val": str(i)} for i in range(10)])
+    db.commit()
+    # streaming goes through the usual call path
+    rows = db.select_foo_stream()
+    assert next(rows) == (0, "0")
+    assert [pk for pk, _ in rows] == list(range(1, 10))
+    assert db._count["select_foo_stream"] == 1
+    assert db._latency["select_foo_stream"].count == 1
+    # on-demand streaming with default fetch size
+    select_all = db.stream("select_foo_all")
+    assert len(list(select_all())) == 10 and db._count["select_foo_all"] == 1
+    # early termination closes the cursor
+    gen = db.stream("select_foo_all", fetch=2)()
+    assert next(gen) == (0, "0")
+    gen.close()
+    # errors
+    for name in ("insert_foo", "count_foo", "no_such_query", "select_foo_all_cursor"):
+        try:
+            db.stream(name)
+            pytest.fail(f"cannot stream {name}")  # pragma: no cover
+        except anodb.AnoDBException as e:
+            assert "stream" in str(e)
+    db.close()
+
+
+@pytest.mark.skipif(not has_module("duckdb"), reason="missing duckdb for test")
+def test_stream_duckdb():
+    db = anodb.DB("duckdb", ":memory:", TEST_SQL)
+    db.create_foo()
+    db.insert_foo_many([{"pk": i, "val": str(i)} for i in range(5)])
+    assert [pk for pk, _ in db.select_foo_stream()] == list(range(5))
+    assert list(db.stream("select_foo_pk", fetch=2)(pk=3)) == [("3",)]
+    db.close()
+
+
+def test_columnar(monkeypatch):
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, stream_fetch=4)
+    db.create_foo()
+    db.insert_foo_many([{"pk": i, "val": str(i)} for i in range(10)])
+    db.commit()
+    cols = db.select_foo_columns()
+    assert cols["pk"] == list(range(10)) and cols["val"][-1] == "9"
+    assert db._count["select_foo_columns"] == 1
+    # on-demand, with optional dependencies
+    assert db.columnar("select_foo_pk", format="lists")(pk=42) == {"val": []}
+    if has_module("numpy"):
+        cols = db.columnar("select_foo_all")()
+        assert cols["pk"].dtype.kind == "i" and cols["pk"].sum() == 45
+    if has_module("pyarrow"):
+        table = db.columnar("select_foo_all", format="arrow", fetch=3)()
+        assert table.num_rows == 10 and table.column_names == ["pk", "val"]
+    # errors
+    try:
+        db.columnar("select_foo_all", format="pandas")
+        pytest.fail("unexpected format")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "format" in str(e)
+    try:
+        db.columnar("count_foo")
+        pytest.fail("not a plain select")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "columnar" in str(e)
+    monkeypatch.setitem(sys.modules, "numpy", None)
+    try:
+        db.columnar("select_foo_all")()
+        pytest.fail("missing numpy")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "requires numpy" in str(e)
+    db.close()
+
+
+@pytest.mark.skipif(not has_module("duckdb") or not has_module("pyarrow"), reason="missing duckdb or pyarrow for test")
+def test_columnar_duckdb():
+    db = anodb.DB("duckdb", ":memory:", TEST_SQL)
+    db.create_foo()
+    db.insert_foo_many([{"pk": i, "val": str(i)} for i in range(5)])
+    cols = db.columnar("select_foo_all")()
+    assert list(cols["pk"]) == list(range(5))
+    table = db.columnar("select_foo_pk", format="arrow")(pk=3)
+    assert table.num_rows == 1 and table.column("val").to_pylist() == ["3"]
+    assert db.select_foo_columns()["val"] == ["0", "1", "2", "3", "4"]
+    db.close()
+
+
+def test_prepare(monkeypatch, tmp_path):
+    # sqlite3 has no explicit prepared statements, just check the proxy and counters
+    monkeypatch.setitem(anodb._PREPARE_OPTIONS, "sqlite3", {})
+    db = anodb.DB("sqlite3", str(tmp_path / "prepare.db"), TEST_SQL, prepare_threshold=2)
+    assert "select_foo_pk" in db._preparable and "create_foo" not in db._preparable
+    db.create_foo()
+    for i in range(5):
+        db.insert_foo(pk=i, val=str(i))
+    assert db._prepares == {"insert_foo": 1} and db._prepared_hits == {"insert_foo": 2}
+    for i in range(4):
+        assert list(db.select_foo_pk(pk=i)) == [(str(i),)]
+    with db.select_foo_all_cursor() as cur:
+        assert len(cur.fetchall()) == 5
+    for _ in range(3):
+        assert len(list(db.select_foo_all())) == 5
+    assert db._prepares["select_foo_pk"] == 1 and db._prepared_hits["select_foo_pk"] == 1
+    stats = db._stats()
+    assert stats["prepared"]["threshold"] == 2 and stats["conn"]["prepared"] == 3
+    assert db._prepare("insert_foo", db).total_changes == db._conn.total_changes, "connection proxy"
+    # prepared statements are forgotten on reconnect
+    db.commit()
+    db._reconnect()
+    assert db._conn_stats()["prepared"] == 0
+    db.insert_foo(pk=10, val="ten")
+    assert db._prepares["insert_foo"] == 2
+    db.close()
+    # not available with this driver
+    monkeypatch.delitem(anodb._PREPARE_OPTIONS, "sqlite3")
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, prepare_threshold=0)
+    assert not db._preparable
+    db.close()
+
+
+def test_lazy_queries(tmp_path):
+    db = anodb.DB("sqlite3", ":memory:", [TEST_SQL, "caching.sql"], lazy_queries=True, cacher=True)
+    assert not db._queries and "select_foo_all_cursor" in db._lazy and "sq" in db._lazy
+    assert "create_foo" not in db.__dict__ and db._count["create_foo"] == 0
+    db.create_foo()
+    assert "create_foo" in db.__dict__ and "create_foo" not in db._lazy and len(db._queries) == 1
+    # plain selects come with their cursor variant
+    db.insert_foo(pk=1, val="one")
+    assert list(db.select_foo_all()) == [(1, "one")]
+    assert "select_foo_all_cursor" in db.__dict__
+    with db.select_foo_all_cursor() as cur:
+        assert len(cur.fetchall()) == 1
+    # other entry points
+    assert db.bulk("insert_foo_many", [{"pk": 2, "val": "two"}])["rows"] == 1
+    assert list(db.stream("select_foo_pk")(pk=2)) == [("two",)]
+    assert db.sq(n=3) == 9 and db.sq(n=3) == 9 and db._count["sq"] == 1
+    assert not hasattr(db, "no_such_query")
+    assert db._calls[-1] == "sq"
+    db.close()
+    # duplicates are detected on scan
+    try:
+        anodb.DB("sqlite3", ":memory:", [TEST_SQL, TEST_SQL], lazy_queries=True)
+        pytest.fail("duplicate query names")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "override" in str(e)
+    (tmp_path / "close.sql").write_text("-- name: close#\nSELECT 1;\n")
+    try:
+        anodb.DB("sqlite3", ":memory:", str(tmp_path / "close.sql"), lazy_queries=True)
+        pytest.fail("existing method")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "override" in str(e)
+    (tmp_path / "close.sql").unlink()
+    # directories and pooled connections
+    (tmp_path / "a.sql").write_text("-- name: one()$\nSELECT 1;\n/* -- name: hidden$ */\n")
+    (tmp_path / "b.sql").write_text("-- name: two()^\nSELECT 2;\n")
+    (tmp_path / "c.txt").write_text("-- name: three$\nSELECT 3;\n")
+    db = anodb.DB("sqlite3", ":memory:", str(tmp_path), lazy_queries=True, pool_size=1)
+    assert sorted(db._lazy) == ["one", "two"]
+    assert db.one() == 1 and db.two() == (2,)
+    db.commit()
+    db.close()
+
+
+def test_query_cache(tmp_path):
+    cache = tmp_path / "cache"
+    queries = tmp_path / "queries.sql"
+    shutil.copy(TEST_SQL, queries)
+    db = anodb.DB("sqlite3", ":memory:", [str(queries), "caching.sql"], query_cache=str(cache))
+    assert db._stats()["query_cache"] == {"hits": 0, "misses": 2} and len(list(cache.iterdir())) == 2
+    db.close()
+    # second start loads parsed queries
+    db = anodb.DB("sqlite3", ":memory:", [str(queries), "caching.sql"], query_cache=str(cache))
+    assert db._query_cache_hits == 2 and db._query_cache_misses == 0
+    db.create_foo()
+    db.insert_foo(pk=1, val="one")
+    assert list(db.select_foo_all()) == [(1, "one")] and db.sq(n=4) == 16
+    db.close()
+    # options and file changes lead to another key
+    db = anodb.DB("sqlite3", ":memory:", str(queries), query_cache=str(cache), kwargs_only=False)
+    assert db._query_cache_misses == 1
+    db.close()
+    with open(queries, "a") as f:
+        f.write("\n-- name: forty-two()$\nSELECT 42;\n")
+    db = anodb.DB("sqlite3", ":memory:", str(queries), query_cache=str(cache))
+    assert db._query_cache_misses == 1 and db.forty_two() == 42
+    db.close()
+    # broken cache files are ignored
+    for file in cache.iterdir():
+        file.write_bytes(b"not a pickle")
+    db = anodb.DB("sqlite3", ":memory:", str(queries), query_cache=str(cache))
+    assert db._query_cache_misses == 1 and db.forty_two() == 42
+    db.close()
+    # directories, and unwritable cache
+    (tmp_path / "dir").mkdir()
+    (tmp_path / "dir" / "one.sql").write_text("-- name: one()$\nSELECT 1;\n")
+    db = anodb.DB("sqlite3", ":memory:", str(tmp_path / "dir"), query_cache=str(queries))
+    assert db.one() == 1 and db._query_cache_misses == 1
+    db.close()
+    try:
+        anodb.DB("sqlite3", ":memory:", str(tmp_path / "none.sql"), query_cache=str(cache))
+        pytest.fail("missing file")  # pragma: no cover
+    except Exception as e:
+        assert "does not exist" in str(e)
+
+
+def test_lazy_connect(tmp_path):
+    import threading
+    dbfile = str(tmp_path / "lazy.db")
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, lazy_connect=True, auto_reconnect=False)
+    assert db._conn is None and db._conn_count == 0
+    db.commit()
+    db.rollback()
+    db.create_foo()
+    assert db._conn is not None and db._conn_count == 1
+    db.commit()
+    db.close()
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, lazy_connect=True)
+    db.cursor().close()
+    assert db._conn_count == 1
+    db.close()
+    # background connection, with failures
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, lazy_connect=True, check_same_thread=False)
+    db._db_pkg = ThriceFail()
+    for failures in (1, 2, 3):
+        db.warmup().join()
+        assert db._conn is None and db._conn_failures == failures
+    db.warmup().join()
+    assert db._conn is not None and db._conn_count == 1
+    assert db.count_foo()[0] == 0 and db._conn_count == 1
+    db._db_pkg = sqlite3
+    db.close()
+    assert db.connect() is not None and db._conn_count == 2
+    db.close()
+    # pool
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, lazy_connect=True, pool_size=2, check_same_thread=False)
+    assert not db._pool_all
+    db.warmup().join()
+    assert len(db._pool_all) == 2 and all(cx._conn is not None for cx in db._pool_all)
+    assert db.count_foo()[0] == 0
+    db.commit()
+    db.close()
+    # pooled connections are available while others are still connecting
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, lazy_connect=True, pool_size=3, check_same_thread=False)
+    first, gate = threading.Event(), threading.Event()
+
+    class SlowConnect:
+        Error = sqlite3.Error
+
+        def connect(self, *args, **kwargs):
+            if first.is_set():
+                gate.wait(5.0)
+            first.set()
+            return sqlite3.connect(*args, **kwargs)
+
+    db._db_pkg = SlowConnect()
+    warm = db.warmup()
+    while not db._pool_idle:
+        time.sleep(0.001)
+    assert db.count_foo()[0] == 0 and warm.is_alive()
+    db.commit()
+    gate.set()
+    warm.join()
+    assert len(db._pool_all) == 3 and all(cx._conn is not None for cx in db._pool_all)
+    # failed connections keep their slot
+    db.close()
+    db._pool_all, db._pool_idle = [], []
+    db._db_pkg = ThriceFail()
+    warm = db.warmup()
+    warm.join()
+    assert len(db._pool_all) == 1 and db._pool_idle[0]._conn is None
+    db.close()
+
+
+def test_health_checks(tmp_path):
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, pre_ping=0.0)
+    db.create_foo()
+    db.insert_foo(pk=1, val="one")
+    db.insert_foo(pk=2, val="two")
+    db.commit()
+    assert db.count_foo()[0] == 2
+    assert db._stats()["health"] == {"pings": 2, "failures": 0, "reconnects": 0}
+    db.close()
+    # dead connections are replaced before use
+    dbfile = str(tmp_path / "health.db")
+    failures = []
+
+    def ping(conn):
+        if not failures:
+            failures.append(conn)
+            raise sqlite3.OperationalError("connection is dead")
+        anodb._ping_select(conn)
+
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, pre_ping=0.0, ping=ping)
+    conn = db._conn
+    db.create_foo()
+    assert db._conn is not conn and db._health == {"pings": 1, "failures": 1, "reconnects": 1}
+    db.commit()
+    # only after idle periods
+    db._pre_ping = 60.0
+    assert db.count_foo()[0] == 0 and db._health["pings"] == 1
+    db.close()
+    failures.clear()
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, pre_ping=0.0, ping=ping, auto_reconnect=False)
+    try:
+        db.count_foo()
+        pytest.fail("ping should fail")  # pragma: no cover
+    except sqlite3.OperationalError as e:
+        assert "dead" in str(e)
+    db.close()
+    # keepalive on idle pooled connections
+    pings = []
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, pool_size=2, keepalive=0.01, check_same_thread=False,
+                  ping=lambda conn: pings.append(conn))
+    assert db.count_foo()[0] == 0
+    while len(pings) < 4:
+        time.sleep(0.01)
+    db.commit()
+    assert db._stats()["health"]["pings"] >= 4
+    db.close()
+    assert db._keepalive_thread is None and db._keepalive_stop.is_set()
+    # failures are logged and the connection is kept
+    db = anodb.DB("sqlite3", dbfile, TEST_SQL, pool_size=1, keepalive=60.0, check_same_thread=False,
+                  ping=ping, auto_reconnect=False)
+    failures.clear()
+    db._keepalive = 0.0
+    db._keepalive_round()
+    assert db._health["failures"] == 1 and len(db._pool_idle) == 1
+    db.close()
+    try:
+        anodb.DB("sqlite3", ":memory:", keepalive=1.0)
+        pytest.fail("keepalive requires a pool")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "pool" in str(e)
+    # other driver checks
+    pinged = []
+
+    class Pingable:
+        def ping(self):
+            pinged.append(True)
+
+    anodb._ping_method(Pingable())
+    assert pinged
+    if has_module("duckdb"):
+        db = anodb.DB("duckdb", ":memory:", TEST_SQL, pre_ping=0.0)
+        assert db.hello_world()[0] == "hello world!" and db._health["pings"] == 1
+        db.close()
+
+
+def test_circuit_breaker():
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, circuit_breaker=True,
+                  connect_min_delay=0.05, connect_max_delay=0.2, connect_jitter=0.5)
+    assert db._stats()["breaker"]["state"] == "closed"
+    db.close()
+    db._db_pkg = ThriceFail()
+
+    def fails(error):
+        try:
+            db.connect()
+            pytest.fail("connection should fail")  # pragma: no cover
+        except error:
+            pass
+
+    # a failure opens the circuit
+    fails(sqlite3.Error)
+    breaker = db._stats()["breaker"]
+    assert breaker["state"] == "open" and breaker["failures"] == 1
+    assert 0.0 < breaker["retry-in"] <= 0.075
+    # calls fail fast while it is open
+    start = time.monotonic()
+    try:
+        db.hello_world()
+        pytest.fail("circuit is open")  # pragma: no cover
+    except anodb.CircuitOpenError as e:
+        assert "retry in" in str(e)
+    assert time.monotonic() - start < 0.05 and db._breaker._rejects == 1
+    # a failed probe re-opens it for a longer delay
+    time.sleep(0.08)
+    fails(sqlite3.Error)
+    assert db._breaker._delay == 0.1 and db._conn_failures == 2
+    # only one probe while half-open, unless it never reports
+    time.sleep(0.16)
+    db._breaker.enter(1.0)
+    fails(anodb.CircuitOpenError)
+    assert db._stats()["breaker"]["state"] == "half-open"
+    db._breaker._until = 0.0
+    fails(sqlite3.Error)
+    assert db._breaker._delay == 0.2
+    # successful probe closes it
+    time.sleep(0.31)
+    assert db.hello_world()[0] == "hello world!"
+    breaker = db._stats()["breaker"]
+    assert breaker["state"] == "closed" and breaker["opens"] == 3 and breaker["rejects"] == 2
+    db.close()
+    # jitter and delays also apply without the breaker
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, connect_min_delay=0.02, connect_jitter=1.0)
+    db.close()
+    db._db_pkg = ThriceFail()
+    fails(sqlite3.Error)
+    assert db._conn_delay == 0.02 and 0.0 < db._connect_wait() <= 0.04
+    db.close()
+
+
+def test_fast_path():
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, timing=False, last_calls=0, exception=MyException)
+    assert db.insert_foo.__code__.co_name == "fast"
+    db.create_foo()
+    db.insert_foo(pk=1, val="one")
+    assert list(db.select_foo_all()) == [(1, "one")]
+    assert db._count["insert_foo"] == 1 and db._conn_nstat == 3 and not db._calls
+    try:
+        db.insert_foo(pk=1, val="un")
+        pytest.fail("duplicate should fail")  # pragma: no cover
+    except MyException as e:
+        assert "UNIQUE" in str(e)
+    assert db.count_foo()[0] == 0  # rolled back
+    # reconnections go through the full caller
+    db.close()
+    assert db.hello_world()[0] == "hello world!" and db._conn_count == 2
+    db.close()
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, timing=False, last_calls=2)
+    db.hello_world()
+    assert list(db._calls) == ["hello_world"] and db.hello_world.__code__.co_name == "fast"
+    db.close()
+    # timed lean callers
+    for options in ({}, {"slow_query_threshold": 0.0, "timing": False}):
+        db = anodb.DB("sqlite3", ":memory:", TEST_SQL, **options)
+        assert db.insert_foo.__code__.co_name == "timed"
+        db.create_foo()
+        db.insert_foo(pk=1, val="one")
+        assert list(db.select_foo_all()) == [(1, "one")]
+        try:
+            db.insert_foo(pk=1, val="un")
+            pytest.fail("duplicate should fail")  # pragma: no cover
+        except sqlite3.Error:
+            pass
+        if options:
+            assert [s["query"] for s in db._slow] == ["create_foo", "insert_foo", "select_foo_all", "insert_foo"]
+        else:
+            assert db._latency["insert_foo"].count == 2 and db._stats()["latency"]["select_foo_all"]["count"] == 1
+        db.close()
+        assert db.hello_world()[0] == "hello world!" and db._conn_count == 2
+        db.close()
+    # full-featured callers
+    for options in ({"timing": False, "fast_path": False}, {"fast_path": False}, {"timing": False, "debug": True}):
+        db = anodb.DB("sqlite3", ":memory:", TEST_SQL, **options)
+        assert db.hello_world.__code__.co_name == "fn"
+        db.close()
+
+
+def test_bench(capsys):
+    import bench_anodb
+
+    report = bench_anodb.run(["sqlite3", "no-such-driver"], [3], rounds=2, nqueries=5)
+    assert len(report["calls"]) == 5 and len(report["load"]) == 1
+    select = report["calls"][-1]
+    assert select["op"] == "select" and set(select["timings"]) == {"dbapi", "aiosql", "anodb", "anodb-fast", "anodb-cached"}
+    assert "anodb-cached" not in report["calls"][2]["timings"]  # "!"
+    assert set(report["load"][0]["timings"]) == {"aiosql", "anodb", "anodb-lazy", "anodb-cache", "connect"}
+    bench_anodb.show(report)
+    bench_anodb.main(["--drivers", "sqlite3", "--sizes", "2", "--rounds", "1", "--queries", "2", "--json"])
+    out = capsys.readouterr().out
+    assert "load 5 queries" in out and '"op": "*!"' in out
+
+
+def test_replicas(tmp_path):
+    paths = [str(tmp_path / f"{name}.db") for name in ("primary", "r1", "r2")]
+    for pk, path in enumerate(paths):
+        db = anodb.DB("sqlite3", path, TEST_SQL)
+        db.create_foo()
+        db.insert_foo(pk=pk, val=path)
+        db.commit()
+        db.close()
+    db = anodb.DB("sqlite3", paths[0], TEST_SQL, replicas=paths[1:])
+    assert db.count_foo.__code__.co_name == "fn"
+    # reads outside of transactions are spread round-robin
+    assert [list(db.select_foo_all())[0][0] for _ in range(4)] == [1, 2, 1, 2]
+    assert db.count_foo()[0] == 1 and db._conn_nstat == 0
+    # replica read transactions are ended after each read
+    assert [cx._conn_nstat for cx in db._replicas] == [0, 0] and [cx._conn_ntx for cx in db._replicas] == [3, 2]
+    assert [cx._inflight for cx in db._replicas] == [0, 0]
+    # commit stays on the primary, and ends streaming replica read transactions
+    assert next(db.select_foo_stream())[0] == 2 and db._replicas[1]._conn_nstat == 1
+    db.commit()
+    assert db._conn_ntx == 1 and [cx._conn_ntx for cx in db._replicas] == [3, 3]
+    # reads inside a primary transaction go to the primary
+    db.insert_foo(pk=10, val="ten")
+    assert db.count_foo()[0] == 2 and list(db.select_foo_pk(pk=10)) == [("ten",)]
+    db.rollback()
+    # reads inside a transaction scope go to the primary, even before writing
+    with db.transaction():
+        assert list(db.select_foo_all()) == [(0, paths[0])] and db._conn_nstat == 1
+        with db.transaction():
+            assert db.count_foo()[0] == 1
+        assert db.count_foo()[0] == 1 and db._tx_local.primary
+    assert not db._tx_local.primary and list(db.select_foo_all())[0][0] in (1, 2)
+    db.rollback()
+    assert db.run_in_transaction(lambda: db.count_foo()[0] + list(db.select_foo_all())[0][0]) == 1
+    cur = db.cursor()
+    cur.execute("SELECT pk FROM Foo")
+    assert cur.fetchall() == [(0,)]
+    cur.close()
+    db.rollback()
+    # per endpoint stats
+    stats = db._stats()["replicas"]
+    assert stats["policy"] == "round-robin" and stats["fallbacks"] == 0
+    assert [e["info"] for e in stats["endpoints"]] == [[paths[1]], [paths[2]]]
+    assert db._totals()["connections"] == 3
+    # replicas reconnect after close
+    db.close()
+    assert list(db.select_foo_all())[0][0] in (1, 2)
+    assert sum(cx._conn_count for cx in db._replicas) == 3
+    # replica rollback failures are only logged
+    cx = db._replicas[0]
+    cx._close_quietly()
+
+    class BadConn:
+        def rollback(self):
+            raise sqlite3.OperationalError("gone")
+
+        def close(self):
+            pass
+
+    cx._conn, cx._conn_nstat = BadConn(), 1
+    db.commit()
+    assert cx._reconn and list(db.select_foo_all())[0][0] in (1, 2)
+    db.close()
+    # unavailable replicas are skipped while waiting, then reads fall back to the primary
+    db = anodb.DB("sqlite3", paths[0], TEST_SQL, replicas=[str(tmp_path / "no" / "r.db"), {"timeout": 1.0}],
+                  replica_policy="least-loaded", connect_min_delay=60.0)
+    bad, good = db._replicas
+    assert bad._conn is None and bad._conn_failures == 1 and good._conn_kwargs == {"timeout": 1.0}
+    assert db.count_foo()[0] == 1 and good._conn_ntx == 1 and db._conn_nstat == 0
+    good._conn_last_fail, good._conn_delay = dt.datetime.now(dt.timezone.utc), 60.0
+    assert db.count_foo()[0] == 1 and db._conn_ntx == 1 and db._replica_fallbacks == 1
+    db.rollback()
+    bad._conn_delay = 0.0  # ready again, but still failing
+    assert db.count_foo()[0] == 1 and db._replica_fallbacks == 2 and bad._conn_failures == 2
+    assert db._stats()["replicas"]["endpoints"][0]["conn"]["failures"] == 2
+    db.close()
+    # load is the work in flight, not the lifetime executions
+    db = anodb.DB("sqlite3", paths[0], TEST_SQL, replicas=paths[1:], replica_policy="least-loaded")
+    r1, r2 = db._replicas
+    r1._total = 1000  # e.g. r2 is back after an outage
+    assert sorted(list(db.select_foo_all())[0][0] for _ in range(2)) == [1, 2]
+    assert r1._conn_nstat == r2._conn_nstat == 0 and r1._inflight == r2._inflight == 0
+    r1._inflight = 5  # busy with reads from other threads
+    assert [list(db.select_foo_all())[0][0] for _ in range(3)] == [2, 2, 2]
+    r1._inflight = 0
+    stream = db.select_foo_stream()  # open streaming read transaction
+    busy = db._replicas[next(stream)[0] - 1]
+    idle, ntx = r2 if busy is r1 else r1, r1._conn_ntx + r2._conn_ntx
+    assert busy._conn_nstat == 1 and [db.count_foo()[0] for _ in range(2)] == [1, 1]
+    assert idle._conn_ntx + busy._conn_ntx == ntx + 2 and busy._conn_nstat == 1
+    db._replica_policy = "round-robin"
+    assert [db.count_foo()[0] for _ in range(2)] == [1, 1] and busy._conn_nstat == 2, "stream not ended"
+    stream.close()
+    db.commit()
+    assert r1._conn_nstat == r2._conn_nstat == 0
+    db.close()
+    # deferred connections and warmup
+    db = anodb.DB("sqlite3", paths[0], TEST_SQL, replicas=[paths[1], str(tmp_path / "no" / "r.db")],
+                  lazy_connect=True, circuit_breaker=True, check_same_thread=False)
+    assert all(cx._conn is None for cx in db._replicas)
+    db.warmup().join()
+    assert db._replicas[0]._conn is not None and db._replicas[1]._conn_failures == 1
+    assert db._stats()["replicas"]["endpoints"][1]["breaker"]["state"] == "open"
+    db.close()
+    # bad settings
+    for options in ({"replica_policy": "random"}, {"pool_size": 1}):
+        try:
+            anodb.DB("sqlite3", paths[0], TEST_SQL, replicas=paths[1:], **options)
+            pytest.fail("bad settings")  # pragma: no cover
+        except anodb.AnoDBException as e:
+            assert "replica" in str(e)
+    try:
+        anodb.AsyncDB("aiosqlite", paths[0], TEST_SQL, replicas=paths[1:])
+        pytest.fail("not supported")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "replicas" in str(e)
+
+
+class PipeCursor:
+    """Cursor which only runs queries on pipeline syncs."""
+
+    def __init__(self, cur, pipe):
+        self._cur, self._pipe = cur, pipe
+        self.statusmessage = "DONE"
+
+    def execute(self, *args):
+        self._pipe.queue.append((self._cur.execute, args))
+
+    def executemany(self, *args):
+        self._pipe.queue.append((self._cur.executemany, args))
+
+    def __iter__(self):
+        if self._pipe.queue:
+            self._pipe.sync()
+        return iter(self._cur)
+
+    def __getattr__(self, name):
+        if name.startswith("fetch") and self._pipe.queue:  # results are waited for
+            self._pipe.sync()
+        return getattr(self._cur, name)
+
+
+class PipeConn:
+    """Simulate psycopg pipeline mode on a sqlite3 connection."""
+
+    def __init__(self, conn):
+        self._conn, self._pipe, self.syncs = conn, None, 0
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        self._pipe = self
+        self.queue = []
+        try:
+            yield self
+            self.sync()
+        finally:
+            self._pipe = None
+
+    def sync(self):
+        self.syncs += 1
+        queue, self.queue = self.queue, []
+        for execute, args in queue:
+            execute(*args)
+
+    def cursor(self):
+        cur = self._conn.cursor()
+        return PipeCursor(cur, self) if self._pipe else cur
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def test_pipeline():
+    # eager without driver support
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, exception=MyException)
+    db.create_foo()
+    with db.pipeline() as p:
+        assert p is db
+        inserted = db.insert_foo(pk=1, val="one")
+        rows = db.select_foo_all()
+        assert inserted.done and inserted.result() == 1 and rows.result() == [(1, "one")]
+        assert [pk for pk, _ in db.select_foo_stream()] == [1]
+        try:
+            with db.pipeline():
+                pytest.fail("cannot nest")  # pragma: no cover
+        except anodb.AnoDBException as e:
+            assert "nested" in str(e)
+        try:
+            db.insert_foo(pk=1, val="un")
+            pytest.fail("duplicate should fail")  # pragma: no cover
+        except MyException:
+            pass
+    assert db.count_foo()[0] == 0 and db._pipeline is None
+    db.close()
+    with db.pipeline():  # reconnects
+        assert db.hello_world().result() == ("hello world!",)
+    db.close()
+    # simulated psycopg pipeline mode
+    db = anodb.DB("sqlite3", ":memory:", TEST_SQL, exception=MyException, timing=False, last_calls=0)
+    db.add_queries_from_str("-- name: insert-foo-returning(pk, val)<!\nINSERT INTO Foo(pk, val) VALUES (:pk, :val) RETURNING pk;\n"
+                            "-- name: get-val(pk)$\nSELECT val FROM Foo WHERE pk = :pk;\n")
+    db._db, db._conn = "psycopg", PipeConn(db._conn)
+    with db.pipeline():
+        script = db.create_foo()
+        many = db.insert_foo_many([{"pk": 1, "val": "one"}, {"pk": 2, "val": "two"}])
+        returning = db.insert_foo_returning(pk=3, val="three")
+        value, one = db.hello_world(), db.select_foo_columns()
+        rows, count = db.select_foo_all(), db.count_foo()
+        # columnar queries are run eagerly, and fetching waits for pending results
+        assert one.done and db._conn.syncs == 1
+        assert not count.done and "pending" in repr(count)
+        assert count.result() == (3,) and db._conn.syncs == 2 and "done" in repr(count)
+        assert rows.result() == [(1, "one"), (2, "two"), (3, "three")] and one.done
+        val = db.update_foo_pk(pk=3, val="trois")
+        # cursor queries are iterated as usual
+        with db.select_foo_all_cursor() as cur:
+            assert len(list(cur)) == 3
+    assert val.done
+    assert script.result() == "DONE" and many.result() == 2 and returning.result() == 3
+    assert value.result() == ("hello world!",) and val.result() == 1
+    assert one.result() == {"pk": [1, 2, 3], "val": ["one", "two", "three"]}
+    db.commit()
+    # errors fail pending results and rollback
+    try:
+        with db.pipeline():
+            db.insert_foo(pk=4, val="four")
+            dup = db.insert_foo(pk=1, val="un")
+            count = db.count_foo()
+            count.result()
+            pytest.fail("duplicate should fail")  # pragma: no cover
+    except MyException as e:
+        assert "UNIQUE" in str(e)
+    assert isinstance(dup._error, MyException) and "failed" in repr(count)
+    for res in (dup, count):
+        try:
+            res.result()
+            pytest.fail("pipeline failed")  # pragma: no cover
+        except MyException:
+            pass
+    assert db.count_foo()[0] == 3
+    with db.pipeline():
+        assert db.get_val(pk=2).result() == "two" and db.get_val(pk=5).result() is None
+        try:
+            db.get_val(2)
+            pytest.fail("positional parameters")  # pragma: no cover
+        except ValueError:
+            pass
+    try:
+        with db.pipeline():
+            db.insert_foo(pk=1, val="un")
+        pytest.fail("duplicate should fail")  # pragma: no cover
+    except MyException:
+        pass
+    # other errors abort pending results
+    try:
+        with db.pipeline():
+            count = db.count_foo()
+            raise ValueError("oops")
+    except ValueError:
+        pass
+    try:
+        count.result()
+        pytest.fail("pipeline aborted")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "aborted" in str(e)
+    db.close()
+    # cached and memoized queries are not cached in pipeline mode
+    db = anodb.DB("sqlite3", ":memory:", "caching.sql", cacher=True, tx_memo=True)
+    with db.pipeline():
+        sq, ln, gen = db.sq(n=3), db.len(s="abc"), db.gen(n=2)
+        assert sq.result() == 9 and ln.result()[0] == 3 and list(gen.result()) == [(1, 1, 1), (2, 3, 4)]
+        assert db.sq.cache_info()["size"] == 0
+    assert db.sq(n=3) == 9 and db.len(s="abc")[0] == 3 and list(db.gen(n=2)) == [(1, 1, 1), (2, 3, 4)]
+    assert db.sq.cache_info()["size"] == 1 and db._caches["sq"] is not db.sq
+    db.close()
+
+
+def test_transaction(tmp_path):
+    path = str(tmp_path / "tx.db")
+    db = anodb.DB("sqlite3", path, TEST_SQL, timeout=0.0, exception=MyException)
+    db.create_foo()
+    db.commit()
+    # plain scope
+    with db.transaction() as tx:
+        assert tx is db
+        db.insert_foo(pk=1, val="one")
+    assert db._conn_nstat == 0 and db.count_foo()[0] == 1
+    try:
+        with db.transaction():
+            db.insert_foo(pk=2, val="two")
+            raise ValueError("oops")
+    except ValueError:
+        pass
+    assert db.count_foo()[0] == 1
+    # replays while another connection holds the lock
+    other = sqlite3.connect(path)
+    other.execute("BEGIN IMMEDIATE")
+    calls = []
+
+    def work(pk, val):
+        calls.append(pk)
+        if len(calls) == 2:
+            other.rollback()
+        return db.insert_foo(pk=pk, val=val)
+
+    assert db.run_in_transaction(work, 2, val="two", backoff=0.001) == 1
+    assert calls == [2, 2] and db.count_foo()[0] == 2
+    db.rollback()
+    # not transient errors are not replayed
+    try:
+        db.run_in_transaction(work, 2, val="deux")
+        pytest.fail("duplicate should fail")  # pragma: no cover
+    except MyException as e:
+        assert "UNIQUE" in str(e) and len(calls) == 3
+    # too many retries
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        for attempt in db.transaction(retries=2, backoff=0.001, max_backoff=0.002):
+            with attempt:
+                db.insert_foo(pk=3, val="three")
+        pytest.fail("database is locked")  # pragma: no cover
+    except MyException as e:
+        assert "locked" in str(e) and attempt.attempt == 2
+    other.rollback()
+    # commit failures are replayed too
+    commit, failures = db.commit, []
+
+    def failing_commit():
+        if not failures:
+            failures.append(1)
+            raise sqlite3.OperationalError("database is locked")
+        commit()
+
+    db.commit = failing_commit
+    assert db.run_in_transaction(db.insert_foo, pk=3, val="three", backoff=0.001) == 1
+    failures.clear()
+    try:
+        with db.transaction():
+            db.insert_foo(pk=4, val="four")
+        pytest.fail("commit should fail")  # pragma: no cover
+    except sqlite3.OperationalError:
+        pass
+    del db.commit
+    assert db.count_foo()[0] == 3
+    db.rollback()
+    stats = db._stats()["transactions"]
+    assert stats == {"count": 7, "retries": {"insert_foo": 3, "commit": 1}, "exhausted": 1}
+    # attempts must be entered
+    try:
+        for _ in db.transaction():
+            pass
+        pytest.fail("attempt not entered")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "context managers" in str(e)
+    # plain scopes are not replayed
+    try:
+        with db.transaction(retries=5):
+            pytest.fail("not replayed")  # pragma: no cover
+    except anodb.AnoDBException as e:
+        assert "iterating" in str(e)
+    # error detection
+    E = sqlite3.OperationalError
+    errors = [E("could not serialize"), E("deadlock detected"), E({"C": "40001", "M": "serialize"}),
+              E(1213, "Deadlock found"), E("database table is locked"), MyException("wrapped")]
+    errors[0].sqlstate, errors[1].pgcode = "40001", "40P01"  # type: ignore
+    errors[-1].__cause__ = E("database is busy")
+    assert all(db._retryable(e) for e in errors)
+    assert not any(db._retryable(e) for e in (E("no such table"), E({"C": "42P01"}), ValueError("locked"), None))
+    db.close()
+    other.close()
+
+
+def test_tx_memo(tmp_path):
+    db = anodb.DB("sqlite3", str(tmp_path / "memo.db"), TEST_SQL, tx_memo=True, exception=MyException)
+    db.create_foo()
+    db.insert_foo(pk=1, val="one")
+    # repeated reads in a transaction
+    assert db.count_foo() == db.count_foo() == (1,) and db._count["count_foo"] == 1
+    assert db.compute_norm(c=3) == db.compute_norm(c=3) and db._count["compute_norm"] == 1
+    assert db.compute_norm(c=4) != db.compute_norm(c=3) and db._count["compute_norm"] == 2
+    assert db._stats()["memo"]["hits"] == {"count_foo": 1, "compute_norm": 2, "hello_world": 0,
+                                           "syntax_error": 0, "module": 0, "get_stuff": 0}
+    # plain selects are not memoized
+    assert list(db.select_foo_all()) == list(db.select_foo_all()) and db._count["select_foo_all"] == 2
+    # writes, commits, rollbacks, cursors and errors end the memo
+    db.insert_foo(pk=2, val="two")
+    assert db.count_foo() == (2,) and db._count["count_foo"] == 2
+    db.commit()
+    assert db.count_foo() == (2,) and db._count["count_foo"] == 3
+    db.count_foo()
+    db.rollback()
+    assert db.count_foo() == (2,) and db._count["count_foo"] == 4
+    cur = db.cursor()
+    cur.execute("DELETE FROM Foo")
+    cur.close()
+    assert db.count_foo() == (0,) and db._count["count_foo"] == 5
+    try:
+        db.syntax_error(s="2024-12-34")
+        pytest.fail("syntax error should fail")  # pragma: no cover
+    except MyException:
+        assert not db._memo
+    db.close()  # uncommitted delete is lost
+    assert db.count_foo() == (2,) and db._count["count_foo"] == 6
+    # unhashable parameters and pipelines are not memoized
+    class Complex:
+        __hash__ = None  # type: ignore
+        real, imag = 3, 4
+
+    assert db.compute_norm(c=Complex()) == db.compute_norm(c=Complex()) == 5.0 and db._count["compute_norm"] == 4
+    with db.pipeline():
+        assert db.count_foo().result() == (2,) and db._count["count_foo"] == 7
+    db.close()
+    # per pooled connection
+    db = anodb.DB("sqlite3", str(tmp_path / "memo.db"), TEST_SQL, tx_memo=True, pool_size=1, check_same_thread=False)
+    assert db.count_foo() == db.count_foo() == (2,) and db._count["count_foo"] == 2, "single reads"
+    db.delete_foo_pk(pk=1)
+    assert db.count_foo() == db.count_foo() == (1,) and db._pool_all[0]._memo and not db._memo
+    db.commit()
+    assert not db._pool_all[0]._memo
+    db.close()
+
+
+def test_fork(tmp_path):
+    import os
+    path = str(tmp_path / "fork.db")
+    db = anodb.DB("sqlite3", path, TEST_SQL)
+    db.create_foo()
+    db.insert_foo(pk=1, val="one")
+    db.commit()
+    conn, fns = db._conn, dict(db._query_fns)
+    assert db._stats()["pid"] == os.getpid()
+    # simulate a child process, which drops but does not close the connection
+    db._pid = -1
+    anodb._after_fork()
+    assert db._pid == os.getpid() and db._conn is None and db._reconn
+    assert anodb._FORK_ORPHANS[-1] is conn and db._query_fns == fns
+    conn.execute("SELECT 1")  # still usable by the "parent"
+    assert db.count_foo()[0] == 1 and db._conn is not conn and db._conn_count == 2
+    db.close()
+    # pooled connections and replicas are dropped as well
+    pdb = anodb.DB("sqlite3", path, TEST_SQL, pool_size=2, pool_max=3, keepalive=60.0)
+    rdb = anodb.DB("sqlite3", path, TEST_SQL, replicas=[path])
+    assert len(pdb._pool_all) == 2 and pdb.count_foo()[0] == 1
+    thread, stop = pdb._keepalive_thread, pdb._keepalive_stop
+    assert list(rdb.select_foo_all()) == [(1, "one")]
+    pdb._pid = rdb._pid = -1
+    anodb._after_fork()
+    assert pdb._pool_all == [] and pdb._pool_idle == [] and getattr(pdb._pool_local, "cx", None) is None
+    assert pdb._keepalive_thread not in (None, thread)
+    stop.set()  # the inherited thread would not exist in an actual child
+    thread.join()
+    assert rdb._replicas[0]._conn is None and rdb._replicas[0]._reconn
+    assert pdb.count_foo()[0] == 1 and len(pdb._pool_all) == 1
+    assert list(rdb.select_foo_all()) == [(1, "one")] and rdb._replicas[0]._conn is not None
+    pdb.close()
+    rdb.close()
+    # actual fork, if available
+    if not hasattr(os, "fork"):  # pragma: no cover
+        return
+    db = anodb.DB("sqlite3", path, TEST_SQL)
+    assert db.count_foo()[0] == 1
+    db.commit()
+    conn = db._conn
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        try:
+            ok = db._conn is None and db.count_foo()[0] == 1 and db._conn is not conn
+            db.insert_foo(pk=2, val="two")
+            db.commit()
+            os.write(wfd, b"ok" if ok else b"ko")
+        finally:
+            os._exit(0)
+    os.close(wfd)
+    assert os.read(rfd, 2) == b"ok"
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    # parent connection is still alive and sees the child's commit
+    assert db._conn is conn and db.count_foo()[0] == 2
+    db.close()